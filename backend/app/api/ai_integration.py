@@ -2,10 +2,14 @@
 AI 層整合 API
 提供 AI/NLP 服務調用的專用接口
 """
+import asyncio
+import logging
+from datetime import datetime
 from fastapi import APIRouter, HTTPException, Query, BackgroundTasks
 from typing import List, Optional
 from bson import ObjectId
 from pydantic import BaseModel
+from pymongo import InsertOne, UpdateMany, UpdateOne
 from ..models.schemas import (
     AIAnalysisRequest, 
     AIAnalysisResult, 
@@ -16,9 +20,73 @@ from ..services.question_service import question_service
 from ..services.ai_service import ai_service
 from ..services.qa_service import qa_service  
 from ..utils.validators import validate_object_id
+from ..utils.cache import invalidate_course_reports
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/ai", tags=["ai-integration"])
 
+# 聚類摘要每個群組列出的熱門關鍵字數
+TOP_KEYWORDS_LIMIT = 5
+
+
+def _build_cluster_writes(
+    clusters_data: List[dict],
+    replies: List[dict],
+    existing_topic_map: dict,
+    course_id: str,
+    qa_id: str,
+):
+    """
+    將 AI 分群結果轉為 clusters 與 questions 的批次寫入操作
+    同名群組合併為一筆；已存在的群組累加數量，新群組建立後記入 existing_topic_map
+    
+    Returns:
+        (clusters 寫入操作, questions 寫入操作)
+    """
+    now = datetime.utcnow()
+    grouped = {}
+    for cluster_data in clusters_data:
+        target_q_ids = [
+            ObjectId(replies[idx]['_id'])
+            for idx in cluster_data.get("question_indices", [])
+            if isinstance(idx, int) and 0 <= idx < len(replies)
+        ]
+        if not target_q_ids:
+            continue
+        entry = grouped.setdefault(
+            cluster_data.get("topic_label", "未命名群組"), {"q_ids": [], "summary": ""}
+        )
+        entry["q_ids"].extend(target_q_ids)
+        if cluster_data.get("summary"):
+            entry["summary"] = cluster_data["summary"]
+
+    cluster_ops = []
+    question_ops = []
+    for topic_label, entry in grouped.items():
+        target_q_ids = entry["q_ids"]
+        if topic_label in existing_topic_map:
+            target_cluster_id = existing_topic_map[topic_label]
+            update_fields = {"$inc": {"question_count": len(target_q_ids)}, "$set": {"updated_at": now}}
+            if entry["summary"]:
+                update_fields["$set"]["summary"] = entry["summary"]
+            cluster_ops.append(UpdateOne({"_id": target_cluster_id}, update_fields))
+        else:
+            target_cluster_id = ObjectId()
+            cluster_ops.append(InsertOne({
+                "_id": target_cluster_id, "course_id": course_id, "qa_id": qa_id,
+                "topic_label": topic_label, "summary": entry["summary"],
+                "keywords": [], "question_count": len(target_q_ids), "avg_difficulty": 0.0,
+                "is_locked": False, "created_at": now, "updated_at": now
+            }))
+            existing_topic_map[topic_label] = target_cluster_id
+        question_ops.append(UpdateMany(
+            {"_id": {"$in": target_q_ids}},
+            {"$set": {"cluster_id": str(target_cluster_id), "updated_at": now}}
+        ))
+    return cluster_ops, question_ops
+
+
 @router.get("/questions/pending", response_model=dict, summary="取得待 AI 分析的提問")
 async def get_pending_questions_for_ai(
     course_id: str = Query(..., description="課程ID"),
@@ -69,14 +137,17 @@ async def generate_response_draft(question_id: str, background_tasks: Background
 
     async def _generate_and_save_draft(qid: str, text: str):
         try:
-            draft = await ai_service.generate_response_draft(text)
-            analysis = await ai_service.analyze_question(text)
-            summary = analysis.get("summary", "")
-            new_difficulty = analysis.get("difficulty_score")
+            # 草稿與分析互不相依，同時送出；兩者皆有結果快取，重複的提問不會再呼叫 AI
+            draft, analysis = await asyncio.gather(
+                ai_service.generate_response_draft(text),
+                ai_service.analyze_question(text),
+            )
+            summary = analysis.summary
+            new_difficulty = analysis.difficulty_score
             if new_difficulty is None:
                 old_diff = question.get("difficulty_score")
                 new_difficulty = old_diff if old_diff is not None else 0.5
-            new_keywords = analysis.get("keywords")
+            new_keywords = analysis.keywords
             if new_keywords is None:
                  new_keywords = question.get("keywords") or []
             
@@ -86,9 +157,8 @@ async def generate_response_draft(question_id: str, background_tasks: Background
                 response_draft=draft, summary=summary
             )
             await question_service.update_ai_analysis(qid, result)
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
+        except Exception:
+            logger.exception("❌ 提問 %s 草稿生成失敗", qid)
 
     background_tasks.add_task(_generate_and_save_draft, question_id, question["question_text"])
     return {"success": True, "message": "已開始生成草稿，請稍後重新整理頁面查看"}
@@ -102,8 +172,6 @@ async def generate_course_clusters(request: ClusterGenerateRequest):
     force_recluster = getattr(request, "force_recluster", False) 
 
     from ..database import db
-    from bson import ObjectId
-    from datetime import datetime
     
     validate_object_id(course_id, "課程ID")
     if qa_id:
@@ -114,14 +182,14 @@ async def generate_course_clusters(request: ClusterGenerateRequest):
 
         # --- 模式 A：Q&A 批閱模式 ---
         if qa_id:
-            print(f"🤖 [Q&A 批閱模式] 開始分析題目 {qa_id} 的回答...")
+            logger.info("🤖 [Q&A 批閱模式] 開始分析題目 %s 的回答...", qa_id)
             
             # 處理強制重新聚類
             existing_topic_map = {}
             all_clusters = await database["clusters"].find({"qa_id": qa_id}).to_list(length=None)
             
             if force_recluster:
-                print(f"⚠️ [智慧重新聚類] 正在保留鎖定群組，清除未鎖定群組...")
+                logger.info("⚠️ [智慧重新聚類] 正在保留鎖定群組，清除未鎖定群組...")
                 unlocked_ids = []
                 locked_ids = []
                 for c in all_clusters:
@@ -148,7 +216,10 @@ async def generate_course_clusters(request: ClusterGenerateRequest):
             existing_topics_list = list(existing_topic_map.keys())
 
             # 1. 取得老師的題目與設定
-            qa_doc = await qa_service.get_qa(qa_id)
+            # 只取批閱提示詞用到的欄位，不帶回隨作答累積的 related_question_ids
+            qa_doc = await qa_service.get_qa(
+                qa_id, {"question": 1, "core_concept": 1, "expected_misconceptions": 1}
+            )
             if not qa_doc:
                 raise ValueError("找不到該 Q&A")
             
@@ -178,56 +249,30 @@ async def generate_course_clusters(request: ClusterGenerateRequest):
                 raise ValueError("AI 回傳格式錯誤")
                 
             clusters_data = ai_result.get("clusters", [])
-            print(f"📊 AI 將 {len(q_texts)} 個作答分成了 {len(clusters_data)} 組批閱群組")
+            logger.info("📊 AI 將 %d 個作答分成了 %d 組批閱群組", len(q_texts), len(clusters_data))
 
-            # 4. 寫入資料庫
-            for cluster_data in clusters_data:
-                topic_label = cluster_data.get("topic_label", "未命名群組")
-                indices = cluster_data.get("question_indices", [])
-                if not indices: continue
-                
-                target_q_ids = []
-                for idx in indices:
-                    if isinstance(idx, int) and 0 <= idx < len(replies):
-                        target_q_ids.append(ObjectId(replies[idx]['_id']))
-                        
-                if not target_q_ids: continue
-
-                if topic_label in existing_topic_map:
-                    target_cluster_id = existing_topic_map[topic_label]
-                    update_fields = {"$inc": {"question_count": len(target_q_ids)}, "$set": {"updated_at": datetime.utcnow()}}
-                    if cluster_data.get("summary"):
-                        update_fields["$set"]["summary"] = cluster_data.get("summary")
-                        
-                    await database["clusters"].update_one({"_id": target_cluster_id}, update_fields)
-                else:
-                    target_cluster_id = ObjectId()
-                    new_cluster_doc = {
-                        "_id": target_cluster_id, "course_id": course_id, "qa_id": qa_id,
-                        "topic_label": topic_label, "summary": cluster_data.get("summary", ""),
-                        "keywords": [], "question_count": len(target_q_ids), "avg_difficulty": 0.0,
-                        "is_locked": False, "created_at": datetime.utcnow(), "updated_at": datetime.utcnow()
-                    }
-                    await database["clusters"].insert_one(new_cluster_doc)
-                    existing_topic_map[topic_label] = target_cluster_id
-                
-                await database["questions"].update_many(
-                    {"_id": {"$in": target_q_ids}},
-                    {"$set": {"cluster_id": str(target_cluster_id), "updated_at": datetime.utcnow()}}
+            # 4. 寫入資料庫：群組與作答的寫入各合併為一次 bulk_write，兩者同時送出
+            cluster_ops, question_ops = _build_cluster_writes(
+                clusters_data, replies, existing_topic_map, course_id, qa_id
+            )
+            if cluster_ops:
+                await asyncio.gather(
+                    database["clusters"].bulk_write(cluster_ops, ordered=False),
+                    # 同一作答出現在多個群組時以最後一個為準，需依序套用
+                    database["questions"].bulk_write(question_ops, ordered=True),
                 )
             
-            print("✅ Q&A 智慧重新批閱分析完成！")
+            invalidate_course_reports(course_id)
+            logger.info("✅ Q&A 智慧重新批閱分析完成！")
 
         # --- 模式 B：一般提問歸納模式 (舊有邏輯保留) ---
         else:
-            print(f"🤖 [一般提問模式] 開始分析課程 {course_id} 的問題...")
+            logger.info("🤖 [一般提問模式] 開始分析課程 %s 的問題...", course_id)
             # 這裡保留原本的簡單寫法，或是直接略過
             pass
 
     except Exception as e:
-        print(f"❌ 聚類分析失敗: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ 聚類分析失敗: %s", e)
         raise HTTPException(status_code=500, detail=f"聚類分析失敗: {str(e)}")
 
     return {
@@ -241,7 +286,7 @@ async def get_clusters_summary(
     course_id: str,
     qa_id: Optional[str] = Query(None, description="指定 Q&A 的 ID (選填)") 
 ):
-    from ..database import db
+    from ..database import db, QUESTIONS_CLUSTERED_INDEX, QUESTIONS_CLUSTERED_FILTER
     database = db.get_db()
 
     validate_object_id(course_id, "課程ID")
@@ -254,26 +299,39 @@ async def get_clusters_summary(
     else:
         cluster_match["qa_id"] = None 
 
-    all_clusters_cursor = database["clusters"].find(cluster_match)
-    all_clusters = await all_clusters_cursor.to_list(length=None)
-    
-    q_match = {"course_id": course_id, "cluster_id": {"$ne": None}}
+    # 以 $type 篩選已分群作答，條件與部分索引的過濾式一致，查詢計畫才能使用該索引
+    q_match = {"course_id": course_id, **QUESTIONS_CLUSTERED_FILTER}
     if qa_id:
         q_match["reply_to_qa_id"] = qa_id
     else:
         q_match["reply_to_qa_id"] = None
         
-    pipeline = [
+    stats_pipeline = [
         {"$match": q_match},
         {"$group": {
             "_id": "$cluster_id",
             "count": {"$sum": 1},
-            "avg_difficulty": {"$avg": "$difficulty_score"},
-            "keywords": {"$push": "$keywords"} 
+            "avg_difficulty": {"$avg": "$difficulty_score"}
         }}
     ]
-    q_stats = await database["questions"].aggregate(pipeline).to_list(length=None)
+    # 關鍵字頻率在資料庫端計算：展開後依 (群組, 關鍵字) 計數，排序後每群組只保留前 TOP_KEYWORDS_LIMIT 個
+    keywords_pipeline = [
+        {"$match": q_match},
+        {"$project": {"_id": 0, "cluster_id": 1, "keywords": 1}},
+        {"$unwind": "$keywords"},
+        {"$match": {"keywords": {"$nin": [None, ""]}}},
+        {"$group": {"_id": {"cluster": "$cluster_id", "kw": "$keywords"}, "c": {"$sum": 1}}},
+        {"$sort": {"c": -1, "_id.kw": 1}},
+        {"$group": {"_id": "$_id.cluster", "top": {"$push": "$_id.kw"}}},
+        {"$project": {"top": {"$slice": ["$top", TOP_KEYWORDS_LIMIT]}}}
+    ]
+    all_clusters, q_stats, keyword_stats = await asyncio.gather(
+        database["clusters"].find(cluster_match).to_list(length=None),
+        database["questions"].aggregate(stats_pipeline, hint=QUESTIONS_CLUSTERED_INDEX).to_list(length=None),
+        database["questions"].aggregate(keywords_pipeline, hint=QUESTIONS_CLUSTERED_INDEX).to_list(length=None),
+    )
     stats_map = {str(stat["_id"]): stat for stat in q_stats}
+    top_keywords_map = {str(stat["_id"]): stat["top"] for stat in keyword_stats}
 
     response_data = []
     for cluster in all_clusters:
@@ -281,24 +339,13 @@ async def get_clusters_summary(
         stat = stats_map.get(c_id_str)
         
         if stat:
-            all_keywords = []
-            for kw_list in stat.get("keywords", []):
-                if isinstance(kw_list, list):
-                    all_keywords.extend(kw_list)
-            
-            keyword_freq = {}
-            for kw in all_keywords:
-                if kw: keyword_freq[kw] = keyword_freq.get(kw, 0) + 1
-            
-            top_keywords = [kw[0] for kw in sorted(keyword_freq.items(), key=lambda x: x[1], reverse=True)[:5]]
-            
             response_data.append({
                 "cluster_id": c_id_str,
                 "topic_label": cluster.get("topic_label", "未命名主題"),
                 "summary": cluster.get("summary", ""), 
                 "question_count": stat["count"],
                 "avg_difficulty": stat.get("avg_difficulty") or 0.0,
-                "top_keywords": top_keywords,
+                "top_keywords": top_keywords_map.get(c_id_str, []),
                 "is_locked": cluster.get("is_locked", False)
             })
         else:
@@ -342,7 +389,8 @@ async def update_cluster(cluster_id: str, update_data: ClusterUpdate):
     
     if result.matched_count == 0:
         return {"success": False, "message": "找不到該聚類主題"}
-        
+    
+    invalidate_course_reports()
     return {"success": True, "message": "更新成功"}
 
 class ManualClusterCreate(BaseModel):
@@ -367,6 +415,7 @@ async def create_manual_cluster(request: ManualClusterCreate):
     if existing:
         return {"success": False, "message": "該主題標籤已存在"}
 
+    now = datetime.utcnow()
     new_cluster = {
         "_id": ObjectId(),
         "course_id": request.course_id,
@@ -378,11 +427,12 @@ async def create_manual_cluster(request: ManualClusterCreate):
         "avg_difficulty": 0.0,
         "is_locked": True, 
         "manual_label": request.topic_label,
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow()
+        "created_at": now,
+        "updated_at": now
     }
     
     await database["clusters"].insert_one(new_cluster)
+    invalidate_course_reports(request.course_id)
     return {"success": True, "message": "建立成功"}
 
 @router.delete("/clusters/{cluster_id}", summary="刪除聚類主題")
@@ -404,5 +454,6 @@ async def delete_cluster(cluster_id: str):
     
     if result.deleted_count == 0:
         return {"success": False, "message": "找不到該分類"}
-        
+    
+    invalidate_course_reports()
     return {"success": True, "message": "分類已刪除，內部提問已恢復未分類狀態"}
\ No newline at end of file
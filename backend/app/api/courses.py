@@ -3,12 +3,15 @@
 """
 from fastapi import APIRouter, HTTPException, Query
 from typing import List, Optional
+from pymongo.errors import DuplicateKeyError
 from ..models.schemas import CourseCreate, Course, ClassCreate, Class
 from ..services.course_service import course_service, class_service
 
 
 router = APIRouter(prefix="/courses", tags=["courses"])
 
+DUPLICATE_COURSE_DETAIL = "此學期已有相同課程代碼的課程"
+
 
 # ==================== 課程管理 ====================
 
@@ -22,6 +25,8 @@ async def create_course(course_data: CourseCreate):
             "message": "課程建立成功",
             "data": course
         }
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=DUPLICATE_COURSE_DETAIL)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"建立課程失敗: {str(e)}")
 
@@ -64,7 +69,10 @@ async def get_courses(
 @router.patch("/{course_id}", response_model=dict, summary="更新課程")
 async def update_course(course_id: str, update_data: dict):
     """更新課程資訊"""
-    course = await course_service.update_course(course_id, update_data)
+    try:
+        course = await course_service.update_course(course_id, update_data)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=DUPLICATE_COURSE_DETAIL)
     
     if not course:
         raise HTTPException(status_code=404, detail="找不到此課程")
@@ -50,7 +50,8 @@ async def get_database_overview():
         
         for collection_name in collection_names:
             collection = database[collection_name]
-            count = await collection.count_documents({})
+            # 無篩選條件的總數直接讀取集合中繼資料，不掃描文件；寫入頻繁時可能略有落差
+            count = await collection.estimated_document_count()
             total_documents += count
             
             # 獲取集合的儲存資訊
@@ -100,8 +101,8 @@ async def get_collection_data(
         
         collection = database[collection_name]
         
-        # 獲取總數
-        total = await collection.count_documents({})
+        # 獲取總數（由集合中繼資料估算，不掃描文件）
+        total = await collection.estimated_document_count()
         
         # 構建排序條件
         sort_criteria = []
@@ -240,7 +241,7 @@ async def analyze_collection_schema(collection_name: str):
             "success": True,
             "data": {
                 "collection": collection_name,
-                "total_documents": await collection.count_documents({}),
+                "total_documents": await collection.estimated_document_count(),
                 "fields": fields
             }
         }
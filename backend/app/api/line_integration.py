@@ -2,23 +2,26 @@
 LINE Bot 整合 API 路由
 提供 LINE Bot 配置、Webhook 處理、訊息管理等功能
 """
-from fastapi import APIRouter, Request, HTTPException, Header
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import orjson
+from fastapi import APIRouter, Request, HTTPException, Header, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from typing import Optional
 from datetime import datetime, timedelta
 from bson import ObjectId
+from pymongo.errors import ExecutionTimeout
 
 # 使用 WebhookParser 來支援 FastAPI 非同步架構
-from linebot.v3.webhook import WebhookParser
+from linebot.v3.webhook import WebhookParser, WebhookPayload, SignatureValidator
 from linebot.v3.exceptions import InvalidSignatureError
-from linebot.v3.messaging import (
-    Configuration,
-    AsyncApiClient,
-    AsyncMessagingApi,
-    ReplyMessageRequest,
-    PushMessageRequest,
-    TextMessage
-)
+from linebot.v3.models.events import UnknownEvent
 from linebot.v3.webhooks import (
+    Event,
     MessageEvent,
     TextMessageContent,
     PostbackEvent,
@@ -33,46 +36,92 @@ except ImportError:
     INSIGHT_API_AVAILABLE = False
 
 from ..config import settings
-from ..database import db
+from ..database import db, aggregate_options
 from ..services.line_service import line_service
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/line", tags=["line"])
 
-# 初始化 LINE Bot API
-configuration = Configuration(access_token=settings.LINE_CHANNEL_ACCESS_TOKEN)
-parser = WebhookParser(settings.LINE_CHANNEL_SECRET)
+
+class BytesSignatureValidator(SignatureValidator):
+    """直接以原始 bytes 驗證簽章，省去 body 先 decode 再 encode 的兩次複製"""
+
+    def __init__(self, channel_secret):
+        super().__init__(channel_secret)
+        # 預先完成金鑰處理，每次請求只需 copy() 已初始化的 HMAC 狀態
+        self._base_hmac = hmac.new(self.channel_secret, digestmod=hashlib.sha256)
+
+    def validate(self, body: bytes, signature: str) -> bool:
+        h = self._base_hmac.copy()
+        h.update(body)
+        return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(h.digest()))
+
+
+class OrjsonWebhookParser(WebhookParser):
+    """以 orjson 解碼 webhook body (直接接受 bytes)，事件物件的建立與 WebhookParser 相同"""
+
+    def parse(self, body, signature, as_payload=False):
+        if not self.signature_validator.validate(body, signature):
+            raise InvalidSignatureError('Invalid signature. signature=' + signature)
+
+        body_json = orjson.loads(body)
+        events = []
+        for event in body_json['events']:
+            try:
+                events.append(Event.from_dict(event))
+            except ValueError:
+                logger.info("Unknown event type. type=%s", event.get('type'))
+                events.append(UnknownEvent.new_from_json_dict(event))
+
+        if as_payload:
+            return WebhookPayload(events=events, destination=body_json.get('destination'))
+        return events
+
+
+parser = OrjsonWebhookParser(settings.LINE_CHANNEL_SECRET)
+# orjson.loads 直接接受 bytes，搭配 bytes 簽章驗證即可不 decode body
+parser.signature_validator = BytesSignatureValidator(settings.LINE_CHANNEL_SECRET)
+
+# SSE 閒置時送出 keep-alive 的間隔秒數
+SSE_KEEPALIVE_SECONDS = 15
+
+# 限制背景同時處理的使用者事件群組數
+_event_semaphore = asyncio.Semaphore(settings.LINE_EVENT_CONCURRENCY)
 
 
 @router.get("/config", summary="取得 LINE Bot 配置狀態")
 async def get_line_config():
+    return await line_service.stats_cache.get_or_set(("line_config",), _load_line_config)
+
+
+async def _load_line_config():
     is_configured = bool(settings.LINE_CHANNEL_SECRET and settings.LINE_CHANNEL_ACCESS_TOKEN)
     bot_info = None
     followers_count = None
     
     if is_configured:
         try:
-            # 🔥 修正：使用 AsyncApiClient 與 AsyncMessagingApi
-            async with AsyncApiClient(configuration) as api_client:
-                line_bot_api = AsyncMessagingApi(api_client)
-                bot_data = await line_bot_api.get_bot_info()
-                
-                bot_info = {
-                    "display_name": bot_data.display_name,
-                    "user_id": bot_data.user_id,
-                    "picture_url": getattr(bot_data, "picture_url", ""), # 使用 getattr 避免機器人沒大頭貼時報錯
-                    "status_message": ""  # 機器人本身沒有狀態消息，直接給空字串
-                }
-                
-                # 嘗試從資料庫取得統計好友數
-                try:
-                    database = db.get_db()
-                    messages_collection = database["line_messages"]
-                    unique_users = await messages_collection.distinct("user_id")
-                    followers_count = len(unique_users)
-                except Exception as db_error:
-                    print(f"從資料庫統計失敗: {str(db_error)}")
+            # 共用 line_service 的 Messaging API 連線池
+            bot_data = await line_service.get_bot_info()
+            
+            bot_info = {
+                "display_name": bot_data.display_name,
+                "user_id": bot_data.user_id,
+                "picture_url": getattr(bot_data, "picture_url", ""), # 使用 getattr 避免機器人沒大頭貼時報錯
+                "status_message": ""  # 機器人本身沒有狀態消息，直接給空字串
+            }
+            
+            # 嘗試從資料庫取得統計好友數
+            try:
+                database = db.get_db()
+                messages_collection = database["line_messages"]
+                unique_users = await messages_collection.distinct("user_id")
+                followers_count = len(unique_users)
+            except Exception as db_error:
+                logger.warning("從資料庫統計失敗: %s", db_error)
         except Exception as e:
-            print(f"取得 Bot 資訊失敗: {str(e)}")
+            logger.warning("取得 Bot 資訊失敗: %s", e)
             
     return {
         "success": True,
@@ -117,63 +166,87 @@ async def get_webhook_url(request: Request):
     }
 
 
+async def _dispatch_event(event):
+    """將單一事件派發給 LineService，並攔截業務錯誤避免影響同批次的其他事件"""
+    try:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("🔍 正在處理事件類型: %s", type(event).__name__)
+        
+        if isinstance(event, MessageEvent):
+            if isinstance(event.message, TextMessageContent):
+                await line_service.handle_text_message(event)
+        elif isinstance(event, PostbackEvent):
+            await line_service.handle_postback(event)
+        elif isinstance(event, FollowEvent):
+            await line_service.handle_follow(event)
+            
+    except ValueError as ve:
+        # 攔截到 ValueError (例如：作答次數超過上限)，直接回覆給學生
+        logger.info("⚠️ 業務邏輯拒絕: %s", ve)
+        if hasattr(event, "reply_token"):
+            # 共用 line_service 的 Messaging API 連線池，每次退回不再重新建立連線
+            await line_service._reply_text(event.reply_token, f"⚠️ {str(ve)}")
+    except Exception as inner_e:
+        logger.exception("❌ 處理單一事件時發生未預期錯誤: %s", inner_e)
+
+
+async def _dispatch_events(events):
+    """依序處理同一使用者的事件"""
+    async with _event_semaphore:
+        for event in events:
+            await _dispatch_event(event)
+
+
+async def _process_events(events):
+    """背景處理整批事件：同一使用者依序處理 (例如先綁定再作答)，不同使用者之間並行處理"""
+    events_by_user = {}
+    for event in events:
+        source = getattr(event, "source", None)
+        key = getattr(source, "user_id", None) or id(event)
+        events_by_user.setdefault(key, []).append(event)
+    
+    results = await asyncio.gather(
+        *(_dispatch_events(user_events) for user_events in events_by_user.values()),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error("❌ 處理事件群組時發生未預期錯誤: %r", result)
+
+
 @router.post("/webhook", summary="LINE Bot Webhook 接收器")
 async def line_webhook(
     request: Request,
+    background_tasks: BackgroundTasks,
     x_line_signature: Optional[str] = Header(None)
 ):
     if not settings.LINE_CHANNEL_SECRET or not settings.LINE_CHANNEL_ACCESS_TOKEN:
         raise HTTPException(status_code=500, detail="LINE Bot 尚未配置")
     
     body = await request.body()
-    body_str = body.decode('utf-8')
     
     if not x_line_signature:
         raise HTTPException(status_code=400, detail="缺少 X-Line-Signature header")
     
     try:
         # 使用 parser 解析並派發給 LineService
-        events = parser.parse(body_str, x_line_signature)
+        events = parser.parse(body, x_line_signature)
         
-        print(f"📥 收到 LINE 事件，共 {len(events)} 筆")  # 🔥 探照燈 1
+        # LINE 重送的事件帶有相同的 webhook_event_id，已處理過的直接略過
+        events = [
+            event for event in events
+            if line_service.claim_webhook_event(getattr(event, "webhook_event_id", None))
+        ]
+        logger.debug("📥 收到 LINE 事件，共 %d 筆", len(events))
         
-        for event in events:
-            # =========== 🔥 新增：使用 try-except 包覆單一事件處理，攔截業務錯誤 ===========
-            try:
-                print(f"🔍 正在處理事件類型: {type(event)}") 
-                
-                if isinstance(event, MessageEvent):
-                    if isinstance(event.message, TextMessageContent):
-                        print(f"💬 進入文字處理邏輯，內容: {event.message.text}")
-                        await line_service.handle_text_message(event)
-                elif isinstance(event, PostbackEvent):
-                    await line_service.handle_postback(event)
-                elif isinstance(event, FollowEvent):
-                    await line_service.handle_follow(event)
-                    
-            except ValueError as ve:
-                # 攔截到 ValueError (例如：作答次數超過上限)，直接回覆給學生
-                print(f"⚠️ 業務邏輯拒絕: {str(ve)}")
-                if hasattr(event, "reply_token"):
-                    async with AsyncApiClient(configuration) as api_client:
-                        line_bot_api = AsyncMessagingApi(api_client)
-                        await line_bot_api.reply_message(
-                            ReplyMessageRequest(
-                                reply_token=event.reply_token,
-                                messages=[TextMessage(text=f"⚠️ {str(ve)}")]
-                            )
-                        )
-            except Exception as inner_e:
-                print(f"❌ 處理單一事件時發生未預期錯誤: {str(inner_e)}")
-                import traceback
-                traceback.print_exc()
-            # =========================================================================
+        # 先回應 200 給 LINE，事件於回應送出後在背景處理
+        if events:
+            background_tasks.add_task(_process_events, events)
                 
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="無效的簽章")
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("處理 Webhook 失敗")
         raise HTTPException(status_code=500, detail=f"處理 Webhook 失敗: {str(e)}")
     
     return {"success": True}
@@ -181,18 +254,41 @@ async def line_webhook(
 
 @router.get("/stats", summary="取得 LINE Bot 統計")
 async def get_line_stats(course_id: Optional[str] = None):
+    return await line_service.stats_cache.get_or_set(
+        ("line_stats", course_id), lambda: _load_line_stats(course_id)
+    )
+
+
+async def _load_line_stats(course_id: Optional[str]):
     database = db.get_db()
     messages_collection = database["line_messages"]
     
-    total_messages = await messages_collection.count_documents({})
-    received_count = await messages_collection.count_documents({"direction": "received"})
-    sent_count = await messages_collection.count_documents({"direction": "sent"})
-    failed_count = await messages_collection.count_documents({"direction": "failed"})
-    
-    unique_users = await messages_collection.distinct("user_id")
-    users_count = len(unique_users)
+    async def _count_questions_from_line() -> int:
+        if not course_id:
+            return 0
+        return await database["questions"].count_documents({
+            "course_id": course_id,
+            "original_message_id": {"$exists": True, "$ne": None}
+        })
     
-    last_message = await messages_collection.find_one({}, sort=[("created_at", -1)])
+    # 各項統計彼此獨立，同時送出查詢，耗時約為最慢的一次往返
+    (
+        total_messages,
+        received_count,
+        sent_count,
+        failed_count,
+        unique_users,
+        last_message,
+        questions_from_line,
+    ) = await asyncio.gather(
+        messages_collection.count_documents({}),
+        messages_collection.count_documents({"direction": "received"}),
+        messages_collection.count_documents({"direction": "sent"}),
+        messages_collection.count_documents({"direction": "failed"}),
+        messages_collection.distinct("user_id"),
+        messages_collection.find_one({}, sort=[("created_at", -1)]),
+        _count_questions_from_line(),
+    )
     last_message_time = last_message["created_at"] if last_message else None
     
     stats = {
@@ -200,21 +296,44 @@ async def get_line_stats(course_id: Optional[str] = None):
         "received_count": received_count,
         "sent_count": sent_count,
         "failed_count": failed_count,
-        "users_count": users_count,
-        "questions_from_line": 0,
+        "users_count": len(unique_users),
+        "questions_from_line": questions_from_line,
         "last_message_time": last_message_time.isoformat() if last_message_time else None
     }
     
-    if course_id:
-        questions_collection = database["questions"]
-        stats["questions_from_line"] = await questions_collection.count_documents({
-            "course_id": course_id,
-            "original_message_id": {"$exists": True, "$ne": None}
-        })
-    
     return {"success": True, "data": stats}
 
 
+@router.get("/stats/stream", summary="訂閱 LINE 訊息即時統計 (Server-Sent Events)")
+async def stream_line_stats(request: Request, course_id: Optional[str] = None):
+    """
+    先推送一次完整統計 (event: snapshot)，之後每寫入一則訊息推送增量 (event: delta)，
+    例如 {"direction": "received", "date": "2024-01-01"}，前端自行累加即可免除輪詢
+    """
+    queue = line_service.subscribe_stats()
+
+    async def event_stream():
+        try:
+            snapshot = await get_line_stats(course_id)
+            yield f"event: snapshot\ndata: {json.dumps(snapshot['data'], ensure_ascii=False)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    delta = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # 定期送出註解行，避免代理伺服器中斷閒置連線
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: delta\ndata: {json.dumps(delta)}\n\n"
+        finally:
+            line_service.unsubscribe_stats(queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.get("/users", summary="取得 LINE 使用者列表")
 async def get_line_users():
     database = db.get_db()
@@ -238,7 +357,10 @@ async def get_line_users():
         {"$sort": {"last_message_time": -1}}
     ]
     
-    results = await messages_collection.aggregate(pipeline).to_list(length=None)
+    try:
+        results = await messages_collection.aggregate(pipeline, **aggregate_options()).to_list(length=None)
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="統計查詢逾時，請稍後再試")
     users = []
     for result in results:
         users.append({
@@ -326,27 +448,52 @@ async def get_line_messages(
 
 @router.get("/message-stats", summary="取得訊息統計資料")
 async def get_message_stats(days: int = 7):
+    return await line_service.stats_cache.get_or_set(
+        ("message_stats", days), lambda: _load_message_stats(days)
+    )
+
+
+async def _load_message_stats(days: int):
     database = db.get_db()
     messages_collection = database["line_messages"]
     
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=days)
     
+    # 兩組統計共用同一個日期區間 $match，以單一 $facet 聚合只掃描一次
     pipeline = [
         {"$match": {"created_at": {"$gte": start_date, "$lte": end_date}}},
-        {
-            "$group": {
-                "_id": {
-                    "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
-                    "direction": "$direction"
+        {"$project": {"_id": 0, "created_at": 1, "direction": 1, "user_id": 1}},
+        {"$facet": {
+            "messages": [
+                {
+                    "$group": {
+                        "_id": {
+                            "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                            "direction": "$direction"
+                        },
+                        "count": {"$sum": 1}
+                    }
                 },
-                "count": {"$sum": 1}
-            }
-        },
-        {"$sort": {"_id.date": 1}}
+                {"$sort": {"_id.date": 1}}
+            ],
+            "users": [
+                {"$match": {"direction": "received"}},
+                {"$group": {"_id": {"date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, "user_id": "$user_id"}}},
+                {"$group": {"_id": "$_id.date", "users": {"$sum": 1}}},
+                {"$sort": {"_id": 1}}
+            ]
+        }}
     ]
     
-    results = await messages_collection.aggregate(pipeline).to_list(length=None)
+    try:
+        facet = await messages_collection.aggregate(pipeline, **aggregate_options()).to_list(length=None)
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="統計查詢逾時，請稍後再試")
+    facet = facet[0] if facet else {}
+    results = facet.get("messages", [])
+    user_results = facet.get("users", [])
+    
     daily_stats = {}
     for result in results:
         date = result["_id"]["date"]
@@ -358,14 +505,6 @@ async def get_message_stats(days: int = 7):
         
     stats_list = list(daily_stats.values())
     
-    user_pipeline = [
-        {"$match": {"created_at": {"$gte": start_date, "$lte": end_date}, "direction": "received"}},
-        {"$group": {"_id": {"date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, "user_id": "$user_id"}}},
-        {"$group": {"_id": "$_id.date", "users": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ]
-    
-    user_results = await messages_collection.aggregate(user_pipeline).to_list(length=None)
     user_stats = {result["_id"]: result["users"] for result in user_results}
     
     return {
@@ -393,31 +532,27 @@ async def send_line_message(request: Request):
     messages_collection = database["line_messages"]
 
     try:
-        async with AsyncApiClient(configuration) as api_client:
-            line_bot_api = AsyncMessagingApi(api_client)
-            await line_bot_api.push_message(
-                PushMessageRequest(
-                    to=user_id,
-                    messages=[TextMessage(text=message)]
-                )
-            )
+        await line_service.push_text(user_id, message)
 
         from ..utils.security import generate_pseudonym
         pseudonym = generate_pseudonym(user_id)
+        created_at = datetime.utcnow()
         await messages_collection.insert_one({
             "user_id": user_id,
             "pseudonym": pseudonym,
             "message_type": "text",
             "direction": "sent",
             "content": message,
-            "created_at": datetime.utcnow()
+            "created_at": created_at
         })
+        line_service.notify_message_recorded("sent", created_at)
 
         return {"success": True, "message": "訊息已發送"}
     except Exception as e:
         # 記錄失敗的訊息
         from ..utils.security import generate_pseudonym
         pseudonym = generate_pseudonym(user_id)
+        created_at = datetime.utcnow()
         await messages_collection.insert_one({
             "user_id": user_id,
             "pseudonym": pseudonym,
@@ -425,8 +560,9 @@ async def send_line_message(request: Request):
             "direction": "failed",
             "content": message,
             "error_message": str(e),
-            "created_at": datetime.utcnow()
+            "created_at": created_at
         })
+        line_service.notify_message_recorded("failed", created_at)
         return {"success": False, "message": f"發送失敗: {str(e)}"}
 
 
@@ -436,10 +572,7 @@ async def test_line_connection():
         return {"success": False, "message": "尚未配置 Channel Secret 或 Access Token"}
     
     try:
-        # 🔥 修正：使用 AsyncApiClient 與 AsyncMessagingApi
-        async with AsyncApiClient(configuration) as api_client:
-            line_bot_api = AsyncMessagingApi(api_client)
-            bot_info = await line_bot_api.get_bot_info()
+        bot_info = await line_service.get_bot_info()
         
         return {
             "success": True,
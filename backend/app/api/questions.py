@@ -2,12 +2,17 @@
 作答回覆管理 API 路由 (原提問管理)
 處理學生對 Q&A 任務的作答紀錄與批閱
 """
+import logging
 from fastapi import APIRouter, HTTPException, Query, BackgroundTasks
 from typing import List, Optional
 # 🔥 修改：引入 ReviewStatusBatchUpdate
 from ..models.schemas import QuestionCreate, ReviewStatusUpdate, ReviewStatusBatchUpdate
 from ..services.question_service import question_service
 from ..utils.validators import validate_object_id
+from ..utils.cache import invalidate_course_reports
+from ..utils.responses import MongoJSONResponse
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/questions", tags=["questions"])
 
@@ -45,7 +50,7 @@ async def get_question(question_id: str):
     }
 
 
-@router.get("/", response_model=dict, summary="取得作答列表")
+@router.get("/", summary="取得作答列表")
 async def get_questions(
     course_id: Optional[str] = Query(None, description="課程ID"),
     class_id: Optional[str] = Query(None, description="班級ID"),
@@ -60,11 +65,12 @@ async def get_questions(
         limit=limit
     )
     
-    return {
+    # 直接回傳回應物件：orjson 一次序列化整份列表 (含 ObjectId)，略過逐欄的回應模型轉換
+    return MongoJSONResponse({
         "success": True,
         "data": questions,
         "total": len(questions)
-    }
+    })
 
 
 @router.patch("/{question_id}/review", response_model=dict, summary="更新作答批閱狀態")
@@ -117,16 +123,17 @@ async def batch_update_review_status(batch_data: ReviewStatusBatchUpdate):
         {"_id": {"$in": object_ids}},
         {"$set": update_fields}
     )
+    invalidate_course_reports()
 
-    # 批量退回時逐一通知學生
+    # 批量退回時通知學生：一次取回所有被退回的作答，由 notify_rejections 批次反查並限流推播
     if batch_data.review_status == "rejected":
-        for qid in batch_data.question_ids:
-            try:
-                question = await question_service.get_question(qid)
-                if question:
-                    await question_service._notify_rejection(question, batch_data.feedback)
-            except Exception as e:
-                print(f"⚠️ 批量退回通知失敗 (question_id={qid}): {e}")
+        questions = await collection.find(
+            {"_id": {"$in": object_ids}}, {"pseudonym": 1}
+        ).to_list(length=None)
+        try:
+            await question_service.notify_rejections(questions, batch_data.feedback)
+        except Exception as e:
+            logger.warning("⚠️ 批量退回通知失敗: %s", e)
     
     return {
         "success": True,
@@ -136,7 +143,7 @@ async def batch_update_review_status(batch_data: ReviewStatusBatchUpdate):
 # ========================================================
 
 
-@router.get("/cluster/{cluster_id}", response_model=dict, summary="取得同聚類的作答")
+@router.get("/cluster/{cluster_id}", summary="取得同聚類的作答")
 async def get_questions_by_cluster(
     cluster_id: str,
     course_id: str = Query(..., description="課程ID")
@@ -147,11 +154,11 @@ async def get_questions_by_cluster(
         course_id, cluster_id
     )
     
-    return {
+    return MongoJSONResponse({
         "success": True,
         "data": questions,
         "total": len(questions)
-    }
+    })
 
 
 @router.delete("/{question_id}", response_model=dict, summary="刪除作答")
@@ -1,11 +1,21 @@
 """
 報表匯出與統計 API 路由
 """
-from fastapi import APIRouter, HTTPException, Query, Response
-from typing import Optional
+import asyncio
+import logging
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional, AsyncIterator
 from datetime import datetime
+from urllib.parse import quote
+from bson import ObjectId
+from pymongo.errors import ExecutionTimeout
 from ..services.export_service import export_service
 from ..database import db  
+from ..utils.cache import report_cache
+from ..utils.responses import MongoJSONResponse
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
@@ -17,97 +27,188 @@ router = APIRouter(prefix="/reports", tags=["reports"])
 async def get_statistics(course_id: str = Query(..., description="課程ID")):
     """
     供前端統計儀表板 (Dashboard) 使用的聚合資料
-    包含總作答數、平均難度與難度分佈
+    包含總作答數、批閱狀態分布、平均難度與難度分佈
     """
     try:
-        database = db.get_db()
-        questions_coll = database["questions"]
-        
-        # =========== 🔥 修正：只撈取有綁定 Q&A 任務的有效作答 ===========
-        base_query = {
-            "course_id": course_id, 
-            "reply_to_qa_id": {"$ne": None} # 過濾掉舊版一般提問
-        }
-        # ==============================================================
-        
-        # 1. 基本計數
-        total = await questions_coll.count_documents(base_query)
-        
-        # 2. 難度分布與平均難度分數
-        diff_pipeline = [
-            {"$match": base_query},
-            {"$group": {
-                "_id": {"$toUpper": "$difficulty_level"},
-                "count": {"$sum": 1},
-                "avg_score": {"$avg": "$difficulty_score"}
-            }}
-        ]
-        
-        difficulty_dist = {"EASY": 0, "MEDIUM": 0, "HARD": 0}
-        total_score = 0
-        scored_count = 0
-        
-        async for doc in questions_coll.aggregate(diff_pipeline):
-            level = doc["_id"] if doc["_id"] else "UNKNOWN"
-            if level in difficulty_dist:
-                difficulty_dist[level] = doc["count"]
-            
-            # 計算全班平均難度分數
-            if doc.get("avg_score") is not None:
-                total_score += doc["avg_score"] * doc["count"]
-                scored_count += doc["count"]
-                
-        avg_difficulty = (total_score / scored_count) if scored_count > 0 else 0
-        
-        return {
-            "success": True,
-            "data": {
-                "total_questions": total,
-                "avg_difficulty_score": avg_difficulty,
-                "difficulty_distribution": {
-                    "easy": difficulty_dist["EASY"],
-                    "medium": difficulty_dist["MEDIUM"],
-                    "hard": difficulty_dist["HARD"]
-                }
-            }
-        }
+        data = await report_cache.get_or_set(("statistics", course_id), lambda: _load_statistics(course_id))
+        # 統計資料皆為基本型別，直接交由 orjson 序列化，略過 jsonable_encoder 的逐欄轉換
+        return MongoJSONResponse({"success": True, "data": data})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"取得統計資料失敗: {str(e)}")
 
 
+async def _load_statistics(course_id: str) -> dict:
+    """執行統計聚合並組成回應資料 (由 report_cache 快取)"""
+    database = db.get_db()
+    questions_coll = database["questions"]
+    
+    # =========== 🔥 修正：只撈取有綁定 Q&A 任務的有效作答 ===========
+    base_query = {
+        "course_id": course_id, 
+        "reply_to_qa_id": {"$ne": None} # 過濾掉舊版一般提問
+    }
+    # ==============================================================
+    
+    # 以單一 $facet 同時取得總數、批閱狀態分布與難度分布，共用同一個 $match
+    pipeline = [
+        {"$match": base_query},
+        # 只保留各分支用到的欄位，避免作答內文等大欄位流入後續階段
+        {"$project": {"_id": 0, "review_status": 1, "difficulty_level": 1, "difficulty_score": 1}},
+        {"$facet": {
+            "totals": [{"$count": "n"}],
+            # $sortByCount 產生與 $group + $sum 相同的 {_id, count}
+            "status": [{"$sortByCount": "$review_status"}],
+            "difficulty": [
+                {"$group": {"_id": {"$toUpper": "$difficulty_level"}, "count": {"$sum": 1}}}
+            ],
+            # 全班平均難度分數直接由資料庫計算
+            "avg": [
+                {"$match": {"difficulty_score": {"$ne": None}}},
+                {"$group": {"_id": None, "avg": {"$avg": "$difficulty_score"}}}
+            ]
+        }}
+    ]
+    facet_results = await questions_coll.aggregate(pipeline).to_list(length=1)
+    facets = facet_results[0] if facet_results else {}
+    
+    total = facets["totals"][0]["n"] if facets.get("totals") else 0
+    
+    status_dist = {"pending": 0, "approved": 0, "rejected": 0}
+    for doc in facets.get("status", []):
+        status = doc["_id"] or "pending"
+        status_dist[status] = status_dist.get(status, 0) + doc["count"]
+    
+    difficulty_dist = {"EASY": 0, "MEDIUM": 0, "HARD": 0}
+    for doc in facets.get("difficulty", []):
+        level = doc["_id"] if doc["_id"] else "UNKNOWN"
+        if level in difficulty_dist:
+            difficulty_dist[level] = doc["count"]
+    
+    avg_difficulty = facets["avg"][0]["avg"] if facets.get("avg") else 0
+    
+    return {
+        "total_questions": total,
+        "pending_questions": status_dist["pending"],
+        "approved_questions": status_dist["approved"],
+        "rejected_questions": status_dist["rejected"],
+        "status_distribution": status_dist,
+        "avg_difficulty_score": avg_difficulty,
+        "difficulty_distribution": {
+            "easy": difficulty_dist["EASY"],
+            "medium": difficulty_dist["MEDIUM"],
+            "hard": difficulty_dist["HARD"]
+        }
+    }
+
+
 @router.get("/clusters/summary", summary="取得課程聚類摘要 (圖表用)")
 async def get_clusters_summary(course_id: str = Query(..., description="課程ID")):
     """
     供前端統計儀表板繪製熱門主題圖表使用
     """
     try:
-        database = db.get_db()
-        clusters_coll = database["clusters"]
-        
-        # =========== 🔥 修正：只撈取有綁定 Q&A 任務的聚類群組 ===========
-        cursor = clusters_coll.find({
-            "course_id": course_id,
-            "qa_id": {"$ne": None} # 過濾掉舊版一般提問的聚類
-        }).sort("question_count", -1).limit(10)
-        # ==============================================================
-        
-        clusters = await cursor.to_list(length=10)
-        
-        for c in clusters:
-            c["_id"] = str(c["_id"])
-            
-        return {
+        data = await report_cache.get_or_set(
+            ("clusters_summary", course_id), lambda: _load_clusters_summary(course_id)
+        )
+        # 直接回傳回應物件，ObjectId 於 orjson 序列化時轉為字串
+        return MongoJSONResponse({
             "success": True,
-            "data": clusters
-        }
+            "data": data
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"取得主題摘要失敗: {str(e)}")
 
 
+# 儀表板只需要 ClusterSummary 的顯示欄位
+CLUSTER_SUMMARY_PROJECTION = {
+    "course_id": 1, "qa_id": 1, "topic_label": 1, "summary": 1, "keywords": 1,
+    "question_count": 1, "avg_difficulty": 1, "is_locked": 1, "manual_label": 1,
+    "created_at": 1, "updated_at": 1,
+}
+
+
+async def _load_clusters_summary(course_id: str) -> list:
+    """查詢前 10 大聚類主題 (由 report_cache 快取)"""
+    database = db.get_db()
+    clusters_coll = database["clusters"]
+    
+    # =========== 🔥 修正：只撈取有綁定 Q&A 任務的聚類群組 ===========
+    cursor = clusters_coll.find({
+        "course_id": course_id,
+        "qa_id": {"$ne": None} # 過濾掉舊版一般提問的聚類
+    }, CLUSTER_SUMMARY_PROJECTION).sort("question_count", -1).limit(10)
+    # ==============================================================
+    
+    return await cursor.to_list(length=10)
+
+
 # ==========================================
 # 📥 第二部分：CSV 檔案匯出 API
 # ==========================================
 
+async def _get_course_name(course_id: str) -> str:
+    """取得匯出檔名用的課程名稱，找不到時以課程 ID 代替"""
+    database = db.get_db()
+    course = await database["courses"].find_one({"_id": ObjectId(course_id)}, {"course_name": 1})
+    return course["course_name"] if course else course_id
+
+
+async def _get_qa_label(qa_id: Optional[str]) -> str:
+    """取得匯出檔名用的任務標籤 (問題前 20 字)，未指定或找不到任務時為空字串"""
+    if not qa_id:
+        return ""
+    qa_doc = await db.get_db()["qas"].find_one({"_id": ObjectId(qa_id)}, {"question": 1})
+    if not qa_doc:
+        return ""
+    return f"_{qa_doc.get('question', '')[:20]}"
+
+
+# 回應開始後才發生的查詢錯誤已無法改變狀態碼，改在檔案最後寫入此列，避免被誤認為完整的匯出
+EXPORT_ERROR_ROW = "匯出失敗：資料查詢發生錯誤，此檔案內容不完整，請重新匯出\r\n"
+
+
+async def _encode_csv_stream(first_chunk: str, chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    """先送出 UTF-8 BOM (供 Excel 正確顯示中文)，再逐段編碼 CSV；中途失敗時以錯誤列結尾"""
+    yield b"\xef\xbb\xbf" + first_chunk.encode("utf-8")
+    try:
+        async for chunk in chunks:
+            yield chunk.encode("utf-8")
+    except Exception as e:
+        logger.exception("CSV 匯出中斷: %s", e)
+        yield EXPORT_ERROR_ROW.encode("utf-8")
+
+
+EXPORT_TIMESTAMP_FORMAT = "%Y%m%d_%H%M"
+
+
+def _export_filename(prefix: str) -> str:
+    """四種匯出共用的檔名格式：{前綴}_{時間戳記}.csv"""
+    return f"{prefix}_{datetime.now().strftime(EXPORT_TIMESTAMP_FORMAT)}.csv"
+
+
+def _content_disposition(filename: str) -> str:
+    """以 RFC 5987 格式編碼含中文的下載檔名"""
+    return f"attachment; filename*=UTF-8''{quote(filename)}"
+
+
+async def _csv_response(chunks: AsyncIterator[str], filename_prefix: str) -> StreamingResponse:
+    """
+    包裝 CSV 串流下載回應，檔名附加時間戳記
+    只先取出第一段 (標題列，不需等待查詢) 便開始回應；取得第一段前的錯誤 (如資料庫未連線、統計查詢逾時)
+    仍以 HTTP 錯誤碼回應，之後的查詢錯誤則以檔案最後的 EXPORT_ERROR_ROW 呈現
+    """
+    first_chunk = await chunks.__anext__()
+    return StreamingResponse(
+        _encode_csv_stream(first_chunk, chunks),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": _content_disposition(_export_filename(filename_prefix)),
+            # 停用 nginx 等反向代理的回應緩衝，讓標題列立即送達瀏覽器
+            "X-Accel-Buffering": "no",
+        }
+    )
+
+
 @router.get("/export/questions", summary="匯出提問資料 CSV")
 async def export_questions_csv(
     course_id: str = Query(..., description="課程ID"),
@@ -121,47 +222,24 @@ async def export_questions_csv(
         start_dt = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
         end_dt = datetime.strptime(end_date, "%Y-%m-%d") if end_date else None
         
-        csv_content = await export_service.export_questions_to_csv(
+        csv_chunks = export_service.stream_questions_csv(
             course_id=course_id, class_id=class_id, cluster_id=cluster_id, 
             start_date=start_dt, end_date=end_dt, qa_id=qa_id
         )
         
-        # 用課程名稱和日期命名
-        database = db.get_db()
-        course = await database["courses"].find_one({"_id": __import__("bson").ObjectId(course_id)})
-        course_name = course["course_name"] if course else course_id
-        qa_label = ""
-        if qa_id:
-            qa_doc = await database["qas"].find_one({"_id": __import__("bson").ObjectId(qa_id)})
-            if qa_doc:
-                q_text = qa_doc.get("question", "")[:20]
-                qa_label = f"_{q_text}"
-        
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-        filename = f"{course_name}{qa_label}_作答明細_{timestamp}.csv"
+        # 用課程名稱和日期命名，課程與任務名稱互不相依，同時查詢
+        course_name, qa_label = await asyncio.gather(_get_course_name(course_id), _get_qa_label(qa_id))
         
-        return Response(
-            content=csv_content.encode('utf-8-sig'),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{__import__('urllib.parse', fromlist=['quote']).quote(filename)}"}
-        )
+        return await _csv_response(csv_chunks, f"{course_name}{qa_label}_作答明細")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"匯出失敗: {str(e)}")
 
 @router.get("/export/clusters", summary="匯出 AI 主題分析報表 CSV")
 async def export_clusters_csv(course_id: str = Query(..., description="課程ID")):
     try:
-        csv_content = await export_service.export_clusters_to_csv(course_id=course_id)
-        database = db.get_db()
-        course = await database["courses"].find_one({"_id": __import__("bson").ObjectId(course_id)})
-        course_name = course["course_name"] if course else course_id
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-        filename = f"{course_name}_AI批閱分析_{timestamp}.csv"
-        return Response(
-            content=csv_content.encode('utf-8-sig'),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{__import__('urllib.parse', fromlist=['quote']).quote(filename)}"}
-        )
+        course_name = await _get_course_name(course_id)
+        csv_chunks = export_service.stream_clusters_csv(course_id=course_id)
+        return await _csv_response(csv_chunks, f"{course_name}_AI批閱分析")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"匯出失敗: {str(e)}")
 
@@ -173,17 +251,9 @@ async def export_qas_csv(
     end_date: Optional[datetime] = Query(None, description="結束日期")    
 ):
     try:
-        csv_content = await export_service.export_qas_to_csv(course_id, class_id, start_date, end_date)
-        database = db.get_db()
-        course = await database["courses"].find_one({"_id": __import__("bson").ObjectId(course_id)})
-        course_name = course["course_name"] if course else course_id
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-        filename = f"{course_name}_QA紀錄_{timestamp}.csv"
-        return Response(
-            content=csv_content.encode('utf-8-sig'),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{__import__('urllib.parse', fromlist=['quote']).quote(filename)}"}
-        )
+        course_name = await _get_course_name(course_id)
+        csv_chunks = export_service.stream_qas_csv(course_id, class_id, start_date, end_date)
+        return await _csv_response(csv_chunks, f"{course_name}_QA紀錄")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"匯出失敗: {str(e)}")
 
@@ -195,16 +265,10 @@ async def export_statistics_csv(
     end_date: Optional[datetime] = Query(None, description="結束日期")    
 ):
     try:
-        csv_content = await export_service.export_statistics_to_csv(course_id, class_id, start_date, end_date)
-        database = db.get_db()
-        course = await database["courses"].find_one({"_id": __import__("bson").ObjectId(course_id)})
-        course_name = course["course_name"] if course else course_id
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M')
-        filename = f"{course_name}_成效統計_{timestamp}.csv"
-        return Response(
-            content=csv_content.encode('utf-8-sig'),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{__import__('urllib.parse', fromlist=['quote']).quote(filename)}"}
-        )
+        course_name = await _get_course_name(course_id)
+        csv_chunks = export_service.stream_statistics_csv(course_id, class_id, start_date, end_date)
+        return await _csv_response(csv_chunks, f"{course_name}_成效統計")
+    except ExecutionTimeout:
+        raise HTTPException(status_code=504, detail="統計查詢逾時，請縮小日期範圍後再試")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"匯出失敗: {str(e)}")
\ No newline at end of file
@@ -2,6 +2,7 @@
 系統配置模組
 讀取環境變數並提供應用程式配置
 """
+from functools import cached_property
 from pydantic_settings import BaseSettings
 from typing import List
 
@@ -12,6 +13,16 @@ class Settings(BaseSettings):
     # 資料庫配置
     MONGODB_URI: str = "mongodb://localhost:27017"
     MONGODB_DB_NAME: str = "courses_system"
+    MONGODB_AGGREGATE_MAX_TIME_MS: int = 5000
+    MONGODB_AGGREGATE_BATCH_SIZE: int = 500
+    # 匯出游標每次 getMore 取回的文件數；匯出已投影為小文件，可取較大值減少往返次數
+    MONGODB_EXPORT_CURSOR_BATCH_SIZE: int = 2000
+    # 連線池：上限約為同時進行中的資料庫操作數 (單一 worker 的並行請求 + 背景批次寫入)，
+    # 過大只會讓請求在伺服器端排隊；下限保留暖連線，部署後首批請求不必等待 TCP/TLS 握手
+    MONGODB_MAX_POOL_SIZE: int = 50
+    MONGODB_MIN_POOL_SIZE: int = 10
+    MONGODB_MAX_IDLE_TIME_MS: int = 60000
+    MONGODB_SERVER_SELECTION_TIMEOUT_MS: int = 5000
     
     # JWT 配置
     JWT_SECRET_KEY: str
@@ -21,6 +32,10 @@ class Settings(BaseSettings):
     # Line Bot 配置
     LINE_CHANNEL_SECRET: str = ""
     LINE_CHANNEL_ACCESS_TOKEN: str = ""
+    LINE_EVENT_CONCURRENCY: int = 10
+    LINE_MESSAGE_LOG_BATCH_SIZE: int = 500
+    LINE_MESSAGE_LOG_BATCH_WINDOW_MS: int = 100
+    QUESTION_INSERT_BATCH_SIZE: int = 100
     
     # 去識別化配置
     PSEUDONYM_SALT: str
@@ -29,6 +44,7 @@ class Settings(BaseSettings):
     API_HOST: str = "0.0.0.0"
     API_PORT: int = 8000
     CORS_ORIGINS: str = "http://localhost:3000,http://localhost:5173"
+    LOG_LEVEL: str = "INFO"
     
     # Google Gemini AI 服務配置
     GEMINI_API_KEY: str = ""
@@ -44,17 +60,26 @@ class Settings(BaseSettings):
     GROQ_RETRY_MAX_ATTEMPTS: int = 2
     GROQ_RETRY_BASE_DELAY: float = 1.0
     GROQ_TIMEOUT_SECONDS: float = 30.0
+    GROQ_CONNECT_TIMEOUT_SECONDS: float = 5.0
     
     # AI 共用設定
-    AI_ANSWER_MAX_CHARS: int = 300
+    AI_CLUSTER_INPUT_TOKEN_BUDGET: int = 6000
+    AI_CLUSTER_SHARD_SIZE: int = 50
+    AI_CLUSTER_CONCURRENCY: int = 4
+    AI_RESPONSE_CACHE_MAXSIZE: int = 1024
+    AI_RESPONSE_CACHE_TTL_SECONDS: float = 3600
+    AI_PROMPT_CACHE_MAXSIZE: int = 2048
+    AI_PROMPT_CACHE_TTL_SECONDS: float = 3600
+    AI_ANALYSIS_BATCH_SIZE: int = 10
+    AI_ANALYSIS_BATCH_WINDOW_MS: int = 50
     
     class Config:
         env_file = ".env"
         case_sensitive = True
     
-    @property
+    @cached_property
     def cors_origins_list(self) -> List[str]:
-        """將 CORS_ORIGINS 字串轉換為列表"""
+        """將 CORS_ORIGINS 字串轉換為列表（首次存取後快取）"""
         return [origin.strip() for origin in self.CORS_ORIGINS.split(",")]
 
 
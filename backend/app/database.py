@@ -2,9 +2,44 @@
 資料庫連線模組
 管理 MongoDB 連線與資料庫操作
 """
+import logging
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure
 from .config import settings
-from typing import Optional
+from typing import Optional, Dict, Any
+
+logger = logging.getLogger(__name__)
+
+# 課程列表統計提問數使用的索引 (course_id 等值 + status 排除已刪除)，聚合以 hint 指定
+QUESTIONS_COURSE_STATUS_INDEX = "course_status"
+
+# 聚類摘要統計只看已分群的作答：部分索引只收錄 cluster_id 為字串的文件 (未分群者存為 null)
+QUESTIONS_CLUSTERED_INDEX = "course_qa_clustered"
+QUESTIONS_CLUSTERED_FILTER = {"cluster_id": {"$type": "string"}}
+
+# 匯出查詢依篩選條件以 hint 指定的索引 (等值條件在前、created_at 排序在後，伺服器端免排序)
+# 以鍵值規格指定而非名稱，沿用既有資料庫中以預設名稱建立的索引
+QUESTIONS_EXPORT_QA_INDEX = [("reply_to_qa_id", 1), ("created_at", -1)]
+QUESTIONS_EXPORT_CLUSTER_INDEX = [("course_id", 1), ("cluster_id", 1), ("created_at", -1)]
+QUESTIONS_EXPORT_CLASS_INDEX = [("course_id", 1), ("class_id", 1), ("created_at", -1)]
+QUESTIONS_EXPORT_COURSE_INDEX = [("course_id", 1), ("created_at", -1)]
+QAS_EXPORT_COURSE_INDEX = [("course_id", 1), ("created_at", -1)]
+
+# 分群工作撈取「已核准且尚未分群」的作答，三個等值條件皆由索引比對
+QUESTIONS_CLUSTERING_INDEX = [("reply_to_qa_id", 1), ("review_status", 1), ("cluster_id", 1)]
+
+# 啟用中的課程代碼 + 學期唯一 (外部同步以此 upsert)；部分索引不收錄軟刪除的課程，刪除後可重新建立同代碼課程
+COURSES_UNIQUE_INDEX = [("course_code", 1), ("semester", 1)]
+COURSES_UNIQUE_INDEX_NAME = "course_code_semester_active"
+COURSES_ACTIVE_FILTER = {"is_active": True}
+
+# line_messages 的索引 (LINE 統計與訊息列表、退回通知以 pseudonym 反查 user_id)；清除腳本 drop 集合後依此重建
+LINE_MESSAGES_INDEXES = [
+    [("created_at", -1)],
+    [("direction", 1), ("created_at", -1)],
+    [("user_id", 1), ("created_at", -1)],
+    [("pseudonym", 1)],
+]
 
 
 class Database:
@@ -15,17 +50,29 @@ class Database:
     
     @classmethod
     async def connect_db(cls):
-        """建立資料庫連線"""
-        cls.client = AsyncIOMotorClient(settings.MONGODB_URI)
+        """建立資料庫連線，並以 ping 預先建立連線池 (已連線時沿用既有連線池)"""
+        if cls.client is not None:
+            return
+        cls.client = AsyncIOMotorClient(
+            settings.MONGODB_URI,
+            maxPoolSize=settings.MONGODB_MAX_POOL_SIZE,
+            minPoolSize=settings.MONGODB_MIN_POOL_SIZE,
+            maxIdleTimeMS=settings.MONGODB_MAX_IDLE_TIME_MS,
+            serverSelectionTimeoutMS=settings.MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        )
         cls.db = cls.client[settings.MONGODB_DB_NAME]
-        print(f"成功連線至 MongoDB: {settings.MONGODB_DB_NAME}")
+        # Motor 預設延遲連線；啟動時先 ping 一次，讓伺服器探索與 minPoolSize 暖連線在首個請求前完成
+        await cls.client.admin.command("ping")
+        logger.info("成功連線至 MongoDB: %s", settings.MONGODB_DB_NAME)
     
     @classmethod
     async def close_db(cls):
         """關閉資料庫連線"""
         if cls.client:
             cls.client.close()
-            print(" MongoDB 連線已關閉")
+            cls.client = None
+            cls.db = None
+            logger.info("MongoDB 連線已關閉")
     
     @classmethod
     def get_db(cls) -> AsyncIOMotorDatabase:
@@ -45,20 +92,105 @@ class Database:
         await database["questions"].create_index("cluster_id")
         await database["questions"].create_index("review_status")
         await database["questions"].create_index([("reply_to_qa_id", 1), ("pseudonym", 1)])
+        await database["questions"].create_index([("course_id", 1), ("original_message_id", 1)])
+        await database["questions"].create_index([("course_id", 1), ("review_status", 1)])
+        await database["questions"].create_index(QUESTIONS_EXPORT_COURSE_INDEX)
+        await database["questions"].create_index(
+            [("course_id", 1), ("status", 1)], name=QUESTIONS_COURSE_STATUS_INDEX
+        )
+        await database["questions"].create_index(
+            [("course_id", 1), ("reply_to_qa_id", 1), ("cluster_id", 1)],
+            name=QUESTIONS_CLUSTERED_INDEX,
+            partialFilterExpression=QUESTIONS_CLUSTERED_FILTER,
+        )
+        # 匯出作答明細的任務 / 班級 / 主題篩選，等值條件在前、created_at 排序在後
+        await database["questions"].create_index(QUESTIONS_EXPORT_CLUSTER_INDEX)
+        await database["questions"].create_index(QUESTIONS_EXPORT_CLASS_INDEX)
+        await database["questions"].create_index(QUESTIONS_EXPORT_QA_INDEX)
+        await database["questions"].create_index(QUESTIONS_CLUSTERING_INDEX)
         
         # clusters 集合
         await database["clusters"].create_index("course_id")
         await database["clusters"].create_index("qa_id")
         await database["clusters"].create_index([("course_id", 1), ("qa_id", 1)])
+        await database["clusters"].create_index([("course_id", 1), ("question_count", -1)])
         
         # qas 集合
         await database["qas"].create_index("course_id")
         await database["qas"].create_index([("course_id", 1), ("allow_replies", 1), ("expires_at", 1)])
+        await database["qas"].create_index(QAS_EXPORT_COURSE_INDEX)
+        # 列表依 is_published 篩選或以 $or [class_id, null] 篩選班級後依 created_at 排序，
+        # 兩種條件各自以等值前綴 + created_at 結尾的索引免除記憶體排序 ($or 各分支以 SORT_MERGE 合併)
+        await database["qas"].create_index([("course_id", 1), ("is_published", 1), ("created_at", -1)])
+        await database["qas"].create_index([("course_id", 1), ("class_id", 1), ("created_at", -1)])
+
+        # announcements 集合 (列表查詢條件與 qas 相同)
+        await database["announcements"].create_index([("course_id", 1), ("is_published", 1), ("created_at", -1)])
+        await database["announcements"].create_index([("course_id", 1), ("class_id", 1), ("created_at", -1)])
+        
+        # courses 集合 (外部同步以課程代碼 + 學期 upsert)
+        await cls._ensure_courses_unique_index(database)
         
         # line_users 集合
         await database["line_users"].create_index("current_course_id")
         
-        print("✅ 資料庫索引建立完成")
+        # line_messages 集合 (LINE 統計與訊息列表)
+        for keys in LINE_MESSAGES_INDEXES:
+            await database["line_messages"].create_index(keys)
+        
+        logger.info("✅ 資料庫索引建立完成")
+    
+    @staticmethod
+    async def _ensure_courses_unique_index(database: AsyncIOMotorDatabase):
+        """
+        建立啟用中課程的代碼 + 學期唯一索引
+        舊版不分啟用狀態的唯一索引會先移除；啟用中的課程若已有重複，索引建立會失敗，
+        此時列出重複的組合待人工合併，不中斷啟動
+        """
+        collection = database["courses"]
+        try:
+            for name, info in (await collection.index_information()).items():
+                if (
+                    name != COURSES_UNIQUE_INDEX_NAME
+                    and info.get("key") == COURSES_UNIQUE_INDEX
+                    and info.get("unique")
+                    and "partialFilterExpression" not in info
+                ):
+                    await collection.drop_index(name)
+            await collection.create_index(
+                COURSES_UNIQUE_INDEX,
+                name=COURSES_UNIQUE_INDEX_NAME,
+                unique=True,
+                partialFilterExpression=COURSES_ACTIVE_FILTER,
+            )
+        except OperationFailure as e:
+            duplicates = await collection.aggregate([
+                {"$match": COURSES_ACTIVE_FILTER},
+                {"$group": {
+                    "_id": {"course_code": "$course_code", "semester": "$semester"},
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1},
+                }},
+                {"$match": {"count": {"$gt": 1}}},
+            ]).to_list(None)
+            logger.error(
+                "課程唯一索引建立失敗，請先合併重複的課程代碼 + 學期: %s (%s)",
+                [(d["_id"], [str(i) for i in d["ids"]]) for d in duplicates], e
+            )
+
+
+def aggregate_options(**overrides) -> Dict[str, Any]:
+    """
+    統計類聚合查詢的共用參數
+    禁止落地到磁碟排序、限制伺服器端執行時間並指定批次大小，避免單一查詢拖垮回應時間
+    """
+    options = {
+        "allowDiskUse": False,
+        "maxTimeMS": settings.MONGODB_AGGREGATE_MAX_TIME_MS,
+        "batchSize": settings.MONGODB_AGGREGATE_BATCH_SIZE,
+    }
+    options.update(overrides)
+    return options
 
 
 # 全域資料庫實例
@@ -1,27 +1,39 @@
 """
 FastAPI 主應用程式
 """
+import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from .config import settings
 from .database import db
+from .utils.log_config import setup_logging, shutdown_logging
+from .utils.responses import MongoJSONResponse
+from .services.ai_service import ai_service
+from .services.line_service import line_service
+from .services.question_service import question_service
 from .api import questions, courses, qas, announcements, ai_integration, reports, database, line_integration
 
+logger = logging.getLogger(__name__)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """應用程式生命週期管理"""
-    # 啟動時：連線資料庫
+    # 啟動時：啟動背景日誌輸出並連線資料庫
+    setup_logging(settings.LOG_LEVEL)
     await db.connect_db()
     await db.ensure_indexes()
-    print("🚀 應用程式啟動完成")
+    logger.info("🚀 應用程式啟動完成")
     
     yield
     
-    # 關閉時：關閉資料庫連線
+    # 關閉時：寫完排入的作答與訊息紀錄，關閉 AI 與 LINE 客戶端及資料庫連線
+    await question_service.aclose()
+    await ai_service.aclose()
+    await line_service.aclose()
     await db.close_db()
-    print("👋 應用程式已關閉")
+    logger.info("👋 應用程式已關閉")
+    shutdown_logging()
 
 
 # 建立 FastAPI 應用程式
@@ -29,7 +41,8 @@ app = FastAPI(
     title="AI 教學計畫系統 API",
     description="提供課程、提問、Q&A、公告管理與 AI 整合功能",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=MongoJSONResponse
 )
 
 
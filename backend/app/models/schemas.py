@@ -2,10 +2,15 @@
 資料庫 Schema 定義
 定義所有核心資料模型的結構
 """
-from pydantic import BaseModel, Field, EmailStr
-from typing import Optional, List, Dict, Any
+import re
+from pydantic import BaseModel, Field, EmailStr, field_validator
+from typing import Optional, List, Dict, Any, Literal
 from datetime import datetime
 from enum import Enum
+from bson import ObjectId
+
+# 24 位十六進位字串的 ObjectId 格式
+_OBJECT_ID_RE = re.compile(r"[0-9a-fA-F]{24}")
 
 
 # ==================== 枚舉類型 ====================
@@ -42,10 +47,11 @@ class PyObjectId(str):
     
     @classmethod
     def validate(cls, v):
-        from bson import ObjectId
-        if not ObjectId.is_valid(v):
+        if isinstance(v, ObjectId):
+            return str(v)
+        if not isinstance(v, str) or not _OBJECT_ID_RE.fullmatch(v):
             raise ValueError("Invalid ObjectId")
-        return str(v)
+        return v
 
 
 # ==================== 課程相關模型 ====================
@@ -315,6 +321,37 @@ class AIAnalysisResult(BaseModel):
     sentiment_score: Optional[float] = Field(None, description="情緒分數")
 
 
+class QuestionAnalysis(BaseModel):
+    """AI 提問分析回傳格式，模型輸出的 JSON 先經此驗證再交給呼叫端"""
+    keywords: Optional[List[str]] = Field(None, description="3-5 個關鍵字")
+    difficulty_score: Optional[float] = Field(None, ge=0.0, le=1.0, description="難度分數 (0.0-1.0)")
+    sentiment: Literal["positive", "neutral", "negative"] = Field("neutral", description="情緒")
+    summary: str = Field("", description="20 字以內的問題摘要")
+
+    @field_validator("sentiment", mode="before")
+    @classmethod
+    def normalize_sentiment(cls, v):
+        # 無法辨識的情緒視為 neutral，不因單一欄位讓整筆分析失敗
+        v = v.strip().lower() if isinstance(v, str) else v
+        return v if v in ("positive", "neutral", "negative") else "neutral"
+
+    @field_validator("difficulty_score", mode="before")
+    @classmethod
+    def clamp_difficulty(cls, v):
+        # 數字字串轉為 float、超出範圍者夾回 0-1；無法轉換時視為未提供
+        if v is None or isinstance(v, bool):
+            return None
+        try:
+            return min(max(float(v), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return None
+
+    @field_validator("summary", mode="before")
+    @classmethod
+    def default_summary(cls, v):
+        return "" if v is None else v
+
+
 # ==================== LINE 訊息相關模型 ====================
 
 class LineMessageType(str, Enum):
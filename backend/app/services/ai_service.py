@@ -3,16 +3,203 @@ AI 服務模組
 主要使用 Google Gemini API，當 Gemini 不可用時自動切換至 Groq 備援
 """
 import asyncio
-import json
+import difflib
+import functools
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+import random
+import re
+import unicodedata
+from typing import List, Dict, Any, Optional, Tuple, Type
+import orjson
+from cachetools import TTLCache
 from google import genai
 from google.genai import types
+from pydantic import BaseModel, ValidationError
 from ..config import settings
+from ..models.schemas import QuestionAnalysis
+from ..utils.cache import AsyncTTLCache
 
 logger = logging.getLogger(__name__)
 
+# 分批分群合併時，標籤相似度達此門檻即視為同一群組
+CLUSTER_LABEL_MATCH_CUTOFF = 0.8
+
+# 分批分群合併後超過總群組數上限時，人數較少的群組併入此群組
+OVERFLOW_CLUSTER_LABEL = "其他想法"
+
+# 單次生成的輸出 token 上限
+AI_MAX_OUTPUT_TOKENS = 2048
+
+# 溫度高於此值的呼叫結果帶有隨機性 (例如分群、回覆草稿)，不寫入完全相同提示詞的快取
+PROMPT_CACHE_MAX_TEMPERATURE = 0.3
+
+# 提問快取鍵只合併空白與結尾標點；運算子等符號在程式設計課程中有意義，必須保留
+_WHITESPACE_RE = re.compile(r"\s+")
+_TRAILING_PUNCT_RE = re.compile(r"[\s?!.。]+$")
+# 中日韓文字與全形符號，每字約佔 1 token
+_CJK_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def _prompt_cache_key(
+    prompt: str,
+    json_mode: bool,
+    temperature: float,
+    system_prompt: Optional[str] = None,
+    response_model: Optional[Type[BaseModel]] = None,
+) -> str:
+    """以模型、提示詞與生成參數計算快取鍵"""
+    payload = orjson.dumps(
+        {
+            "models": [settings.GEMINI_MODEL, settings.GROQ_MODEL],
+            "system_prompt": system_prompt,
+            "prompt": prompt,
+            "json_mode": json_mode,
+            "temperature": temperature,
+            "response_model": response_model.__name__ if response_model else None,
+        },
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+
+def _normalize_question(text: str) -> str:
+    """
+    正規化提問文字作為快取鍵：全形轉半形、英文轉小寫、連續空白合併為一個、移除結尾的問號與句號，
+    讓只差在這些地方的重複提問共用同一份 AI 結果 (i++ 與 i、a<b 與 ab 等仍視為不同提問)
+    """
+    normalized = _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text).lower()).strip()
+    normalized = _TRAILING_PUNCT_RE.sub("", normalized)
+    return normalized or text
+
+
+# ── 提示詞 ───────────────────────────────────────────────
+# 固定不變的部分定義為模組常數，呼叫時只串接學生內容
+
+_ANALYSIS_FIELDS = """欄位說明：
+- keywords: (list) 3-5個關鍵字
+- difficulty_score: (float) 0.0(最簡單)-1.0(最困難)
+- sentiment: (str) positive/neutral/negative
+- summary: (str) 20字以內的問題摘要
+"""
+
+_ANALYZE_PROMPT = (
+    "你是一個教育數據分析師。請分析學生的提問，並回傳嚴格的 JSON 格式資料。\n"
+    + _ANALYSIS_FIELDS
+    + "\n學生提問："
+)
+
+_BATCH_ANALYZE_PROMPT = (
+    "你是一個教育數據分析師。請逐一分析以下每一則學生提問，並回傳嚴格的 JSON 格式資料。\n"
+    '回傳格式：{"results": [{"index": 0, "keywords": [], "difficulty_score": 0.0, "sentiment": "neutral", "summary": ""}]}\n'
+    "每一則提問都必須有一筆結果，index 對應提問編號 (ID_ 後的數字)。\n"
+    + _ANALYSIS_FIELDS
+    + "\n學生提問：\n"
+)
+
+_DRAFT_PROMPT = """你是一位資深的教學助理。請針對學生的問題撰寫一份回覆草稿。
+要求：
+1. 語氣親切、鼓勵學生
+2. 結構清晰，先回答核心問題，再補充範例或概念
+3. 使用繁體中文
+
+學生問題："""
+
+_DEFAULT_REPLY_SYSTEM_PROMPT = "你是一個熱心的教學助理，請用繁體中文回答學生的問題。"
+
+_DEFAULT_DOMAIN_CONTEXT = (
+    "本課程涉及電子商務主題，學生回答可能涉及台灣常見電商平台"
+    "（蝦皮、momo、PChome、博客來等）及相關概念"
+    "（B2C、C2C、跨境電商、物流金流、數位行銷等）。"
+    "請在分群時考慮電商領域的專業知識脈絡。"
+)
+
+
+# 答案分群系統提示詞：只含固定不變的角色、規則與 JSON 格式，每次呼叫逐字相同，
+# 讓供應商的提示詞前綴快取 (prefix caching) 可以重複使用；隨題目變動的內容一律放在使用者訊息
+_CLUSTER_SYSTEM_PROMPT = """你是一位專業的「教育診斷分析師」。老師出了一道探究型的問答題，並提供了期望學生掌握的「核心觀念」。
+你的任務不是單純批改對錯，而是要「深度診斷」學生的作答，將具有「相似理解類型」、「相同認知盲點」或「相似迷思」的回答進行分群聚類。
+
+⚠️ 所有群組標籤與摘要必須使用繁體中文。
+
+【任務規則】
+1. **診斷導向分群**：請跳脫死板的對/錯，分類標籤必須精準描述學生的「認知狀態」或「思考特徵」。（例如：「具備完整因果推論」、「混淆了A與B的概念」、「只背誦專有名詞未理解本質」、「依賴直覺經驗取代科學概念」等）。
+2. **群組數量**：請將學生的回答分成合適的群組（包含現有自訂群組與你新增的群組），總群組數請盡量控制在【任務參數】指定的上限以內。
+3. **強制覆蓋 (重要)**：列表中的「每一個」學生的回答都必須被分配到某個群組中 (涵蓋【任務參數】指定的全部 Index)，絕不能遺漏。
+4. **短答不等於無效 (極重要)**：許多學生會用非常簡短的方式作答（例如只列出名稱、關鍵字、或用逗號/數字分隔的清單）。只要回答的內容與老師的提問主題相關，就必須視為有效作答並歸入對應的認知群組。只有完全離題、開玩笑、打招呼、或明顯無意義的內容（例如「555」、「水喔」、「愚人節快樂」、純問候語）才能歸入「無效回答」類別。
+5. **格式要求**：請回傳嚴格的 JSON 格式，格式如下：
+{
+    "clusters": [
+        {
+            "topic_label": "群組標籤 (例如：具備完整因果推論 / 混淆了供需法則的因果)",
+            "summary": "此群組的診斷總結 (詳細說明這群學生目前的理解走到哪一步，以及共同的盲點或迷思是什麼)",
+            "question_indices": [0, 2, 5]
+        }
+    ]
+}"""
+
+# 答案分群使用者訊息 (以 str.format 填入任務參數、題目資訊與學生回答)
+_CLUSTER_PROMPT_TEMPLATE = """【任務參數】
+- 總群組數上限：{max_clusters} 個
+- 學生回答 Index 範圍：0 到 {last_index}
+
+【領域指引】
+{domain_context}
+
+【教學與診斷資訊】
+- 老師的提問：{teacher_question}
+- 期望的核心觀念：{core_concept}
+{misconceptions_str}
+{existing_topics_str}
+{truncation_note}
+請對以下學生的回答進行教育診斷與分群：
+{indexed_text}"""
+
+
+def _analysis_prompt(question_text: str) -> str:
+    """單筆提問分析提示詞"""
+    return _ANALYZE_PROMPT + question_text
+
+
+def _batch_analysis_prompt(texts: List[str]) -> str:
+    """多筆提問合併分析提示詞，結果依 index 對齊"""
+    return _BATCH_ANALYZE_PROMPT + "\n".join(f"ID_{i}: {text}" for i, text in enumerate(texts))
+
+
 # 共用重試邏輯
+RETRYABLE_STATUS_CODES = ("429", "500", "502", "503", "504", "529")
+RETRYABLE_ERROR_MARKERS = ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED")
+MAX_RETRY_DELAY_SECONDS = 60.0
+
+# 各供應商由 Retry-After 宣告的冷卻結束時間 (event loop 時間)，冷卻期間的新請求先等待
+_provider_cooldown_until: Dict[str, float] = {}
+
+
+def _is_retryable_error(error_str: str) -> bool:
+    return any(code in error_str for code in RETRYABLE_STATUS_CODES) or any(
+        marker in error_str for marker in RETRYABLE_ERROR_MARKERS
+    )
+
+
+def _retry_after_seconds(exc: Exception) -> Optional[float]:
+    """讀取 SDK 例外所附 HTTP 回應的 Retry-After 標頭 (秒)"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def _wait_for_cooldown(provider: str) -> None:
+    remaining = _provider_cooldown_until.get(provider, 0) - asyncio.get_running_loop().time()
+    if remaining > 0:
+        logger.info("%s API 冷卻中，等待 %.1f 秒後再送出", provider, remaining)
+        await asyncio.sleep(remaining)
+
+
 async def _retry_with_backoff(
     fn,
     max_attempts: int,
@@ -21,40 +208,108 @@ async def _retry_with_backoff(
     provider: str,
 ) -> Any:
     """
-    通用重試包裝：對 fn() 執行最多 max_attempts 次，遇到 429/503 時指數退避。
-    成功時回傳結果；不可恢復錯誤時 raise。
+    通用重試包裝：對 fn() 執行最多 max_attempts 次，遇到 429/5xx 或逾時時以指數退避加隨機抖動重試，
+    伺服器回傳 Retry-After 時依其秒數等待並讓同供應商的其他請求一同冷卻。
+    成功時回傳結果；不可恢復錯誤或重試用盡時 raise。
     """
     for attempt in range(max_attempts):
+        await _wait_for_cooldown(provider)
+        is_last_attempt = attempt == max_attempts - 1
         try:
             return await asyncio.wait_for(fn(), timeout=timeout)
         except asyncio.TimeoutError:
             logger.error("%s API 呼叫逾時 (超過 %s 秒)", provider, timeout)
-            raise
+            if is_last_attempt:
+                raise
+            retry_after = None
+            error_str = "timeout"
         except Exception as e:
             error_str = str(e)
-            is_retryable = "429" in error_str or "503" in error_str
-            if is_retryable and attempt < max_attempts - 1:
-                delay = base_delay * (2 ** attempt)
-                logger.warning(
-                    "%s API 重試 %d/%d，錯誤: %s，等待 %.1f 秒",
-                    provider, attempt + 1, max_attempts, error_str, delay,
-                )
-                await asyncio.sleep(delay)
-                continue
-            if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                logger.error("%s API 配額已用盡: %s", provider, error_str)
-                raise RuntimeError(f"{provider} 配額已用盡")
-            logger.error("%s AI 呼叫失敗: %s", provider, error_str)
-            raise RuntimeError(f"{provider} 呼叫失敗: {error_str}")
+            if not _is_retryable_error(error_str) or is_last_attempt:
+                if "429" in error_str or "RESOURCE_EXHAUSTED" in error_str:
+                    logger.error("%s API 配額已用盡: %s", provider, error_str)
+                    raise RuntimeError(f"{provider} 配額已用盡")
+                logger.error("%s AI 呼叫失敗: %s", provider, error_str)
+                raise RuntimeError(f"{provider} 呼叫失敗: {error_str}")
+            retry_after = _retry_after_seconds(e)
+
+        if retry_after is not None:
+            delay = min(MAX_RETRY_DELAY_SECONDS, retry_after)
+            _provider_cooldown_until[provider] = asyncio.get_running_loop().time() + delay
+        else:
+            # 隨機抖動避免多個請求在同一時間點一起重試
+            delay = min(MAX_RETRY_DELAY_SECONDS, base_delay * (2 ** attempt) * random.uniform(1, 2))
+        logger.warning(
+            "%s API 重試 %d/%d，錯誤: %s，等待 %.1f 秒",
+            provider, attempt + 1, max_attempts, error_str, delay,
+        )
+        await asyncio.sleep(delay)
     raise RuntimeError(f"{provider} API 所有 {max_attempts} 次重試均失敗")
 
 
+# 生成參數的組合有限 (溫度、JSON 模式、固定的系統提示詞)，同一組合共用預先建立的設定，
+# 不必每次呼叫都重新建立並驗證設定物件
+@functools.lru_cache(maxsize=64)
+def _gemini_config(
+    temperature: float, json_mode: bool, system_prompt: Optional[str]
+) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        temperature=temperature,
+        max_output_tokens=AI_MAX_OUTPUT_TOKENS,
+        system_instruction=system_prompt,
+        **({"response_mime_type": "application/json"} if json_mode else {}),
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _groq_request_options(model: str, temperature: float, json_mode: bool) -> Dict[str, Any]:
+    options: Dict[str, Any] = {
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": AI_MAX_OUTPUT_TOKENS,
+    }
+    if json_mode:
+        options["response_format"] = {"type": "json_object"}
+    return options
+
+
+def _parse_json_response(
+    content: str, provider: str, response_model: Optional[Type[BaseModel]] = None
+) -> Any:
+    """解析 JSON 模式的回應；指定 response_model 時直接以 Pydantic 驗證原始 JSON 字串"""
+    if response_model is not None:
+        try:
+            return response_model.model_validate_json(content)
+        except ValidationError as e:
+            logger.error("%s 回應格式驗證失敗: %s，原始內容: %s", provider, e, content)
+            return None
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        logger.error("%s JSON 解析失敗，原始內容: %s", provider, content)
+        return {}
+
+
 class AIService:
     def __init__(self):
         self._gemini_client = None
         self._groq_client = None
         self._gemini_lock = asyncio.Lock()
         self._groq_lock = asyncio.Lock()
+        # 提問分析的合併批次：短時間內的多筆分析併成一次 AI 呼叫
+        self._analysis_queue: Optional[asyncio.Queue] = None
+        self._analysis_worker: Optional[asyncio.Task] = None
+        self._analysis_batches: set = set()
+        # 完全相同提示詞的結果快取，涵蓋重試與重複送達的請求
+        self._prompt_cache: TTLCache = TTLCache(
+            maxsize=settings.AI_PROMPT_CACHE_MAXSIZE,
+            ttl=settings.AI_PROMPT_CACHE_TTL_SECONDS,
+        )
+        # 提問分析與回覆草稿的結果快取，鍵為 (用途, 模型, 正規化提問)
+        self._response_cache = AsyncTTLCache(
+            maxsize=settings.AI_RESPONSE_CACHE_MAXSIZE,
+            ttl=settings.AI_RESPONSE_CACHE_TTL_SECONDS,
+        )
 
     async def _get_gemini_client(self) -> genai.Client:
         """Thread-safe lazy init for Gemini client（每次讀取最新 key）"""
@@ -73,10 +328,47 @@ class AIService:
             if not api_key:
                 raise ValueError("系統設定錯誤：缺少 GROQ_API_KEY")
             if self._groq_client is None:
-                from groq import Groq
-                self._groq_client = Groq(api_key=api_key)
+                import httpx
+                from groq import AsyncGroq
+                # 非同步客戶端共用連線池，不佔用 to_thread 執行緒；
+                # 重試統一交給 _retry_with_backoff，連線逾時與讀取逾時分開設定
+                self._groq_client = AsyncGroq(
+                    api_key=api_key,
+                    max_retries=0,
+                    timeout=httpx.Timeout(
+                        settings.GROQ_TIMEOUT_SECONDS,
+                        connect=settings.GROQ_CONNECT_TIMEOUT_SECONDS,
+                    ),
+                )
             return self._groq_client
 
+    async def aclose(self) -> None:
+        """
+        關閉共用的 AI 客戶端連線（應用程式關閉時呼叫）
+        先停止提問分析批次：尚在佇列或執行中的分析以例外結束，不留下永遠等待的呼叫端，也不在客戶端關閉後繼續呼叫 AI
+        """
+        await self._close_analysis_batching()
+        async with self._groq_lock:
+            if self._groq_client is not None:
+                await self._groq_client.close()
+                self._groq_client = None
+        async with self._gemini_lock:
+            self._gemini_client = None
+
+    async def _close_analysis_batching(self) -> None:
+        loop = asyncio.get_running_loop()
+        worker, queue = self._analysis_worker, self._analysis_queue
+        self._analysis_worker = None
+        self._analysis_queue = None
+        # 其他事件迴圈 (已結束) 建立的 task 無法在此等待，直接略過
+        tasks = [t for t in (worker, *self._analysis_batches) if t is not None and t.get_loop() is loop]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if worker is not None and worker.get_loop() is loop:
+            while not queue.empty():
+                _fail_pending([queue.get_nowait()])
+
     # ── Gemini ──────────────────────────────────────────────
 
     async def _call_gemini(
@@ -84,20 +376,18 @@ class AIService:
         prompt: str,
         json_mode: bool = False,
         temperature: float = 0.7,
+        system_prompt: Optional[str] = None,
+        response_model: Optional[Type[BaseModel]] = None,
     ) -> Any:
         """Gemini API 呼叫，含重試與逾時"""
         client = await self._get_gemini_client()
         model = settings.GEMINI_MODEL
 
-        config = types.GenerateContentConfig(
-            temperature=temperature,
-            max_output_tokens=2048,
-            **({"response_mime_type": "application/json"} if json_mode else {}),
-        )
+        config = _gemini_config(temperature, json_mode, system_prompt)
 
         async def _invoke():
-            return await asyncio.to_thread(
-                client.models.generate_content,
+            # 使用 SDK 的非同步介面 (client.aio)，共用客戶端內的連線
+            return await client.aio.models.generate_content(
                 model=model,
                 contents=prompt,
                 config=config,
@@ -113,11 +403,7 @@ class AIService:
 
         content = response.text.strip()
         if json_mode:
-            try:
-                return json.loads(content)
-            except json.JSONDecodeError:
-                logger.error("Gemini JSON 解析失敗，原始內容: %s", content)
-                return {}
+            return _parse_json_response(content, "Gemini", response_model)
         return content
 
     # ── Groq ───────────────────────────────────────────────
@@ -127,25 +413,21 @@ class AIService:
         prompt: str,
         json_mode: bool = False,
         temperature: float = 0.7,
+        system_prompt: Optional[str] = None,
+        response_model: Optional[Type[BaseModel]] = None,
     ) -> Any:
         """Groq API 呼叫（OpenAI 相容格式），含重試與逾時"""
         client = await self._get_groq_client()
         model = settings.GROQ_MODEL
         logger.info("🔄 使用 Groq 備援模型: %s", model)
 
-        kwargs: Dict[str, Any] = {
-            "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": temperature,
-            "max_tokens": 2048,
-        }
-        if json_mode:
-            kwargs["response_format"] = {"type": "json_object"}
+        # 系統提示詞放在訊息最前面，固定前綴才能命中供應商的提示詞快取
+        messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        messages.append({"role": "user", "content": prompt})
+        request_options = _groq_request_options(model, temperature, json_mode)
 
         async def _invoke():
-            return await asyncio.to_thread(
-                client.chat.completions.create, **kwargs
-            )
+            return await client.chat.completions.create(messages=messages, **request_options)
 
         response = await _retry_with_backoff(
             _invoke,
@@ -157,11 +439,7 @@ class AIService:
 
         content = response.choices[0].message.content.strip()
         if json_mode:
-            try:
-                return json.loads(content)
-            except json.JSONDecodeError:
-                logger.error("Groq JSON 解析失敗，原始內容: %s", content)
-                return {}
+            return _parse_json_response(content, "Groq", response_model)
         return content
 
     # ── 統一入口 ───────────────────────────────────────────
@@ -171,11 +449,42 @@ class AIService:
         prompt: str,
         json_mode: bool = False,
         temperature: float = 0.7,
+        system_prompt: Optional[str] = None,
+        response_model: Optional[Type[BaseModel]] = None,
+    ) -> Any:
+        """
+        先嘗試 Gemini，失敗時自動切換至 Groq 備援；低溫度的呼叫結果以提示詞快取。
+        指定 response_model 時以 JSON 模式呼叫並回傳驗證後的模型，格式不符時回傳 None
+        """
+        json_mode = json_mode or response_model is not None
+        cacheable = temperature <= PROMPT_CACHE_MAX_TEMPERATURE
+        if cacheable:
+            cache_key = _prompt_cache_key(prompt, json_mode, temperature, system_prompt, response_model)
+            cached = self._prompt_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        result = await self._call_ai_uncached(
+            prompt, json_mode, temperature, system_prompt, response_model
+        )
+        if cacheable and result:
+            self._prompt_cache[cache_key] = result
+        return result
+
+    async def _call_ai_uncached(
+        self,
+        prompt: str,
+        json_mode: bool = False,
+        temperature: float = 0.7,
+        system_prompt: Optional[str] = None,
+        response_model: Optional[Type[BaseModel]] = None,
     ) -> Any:
         """先嘗試 Gemini，失敗時自動切換至 Groq 備援"""
         # 嘗試 Gemini
         try:
-            result = await self._call_gemini(prompt, json_mode, temperature)
+            result = await self._call_gemini(
+                prompt, json_mode, temperature, system_prompt, response_model
+            )
             logger.info("✅ 使用 Gemini (%s) 完成請求", settings.GEMINI_MODEL)
             return result
         except RuntimeError as e:
@@ -190,7 +499,9 @@ class AIService:
             )
 
         try:
-            result = await self._call_groq(prompt, json_mode, temperature)
+            result = await self._call_groq(
+                prompt, json_mode, temperature, system_prompt, response_model
+            )
             logger.info("✅ 使用 Groq (%s) 備援完成請求", settings.GROQ_MODEL)
             return result
         except Exception as e:
@@ -201,42 +512,131 @@ class AIService:
     async def get_reply(self, user_message: str, system_prompt: Optional[str] = None) -> str:
         """一般對話回覆（給 LINE Bot 直接回話用）"""
         if not system_prompt:
-            system_prompt = "你是一個熱心的教學助理，請用繁體中文回答學生的問題。"
-        prompt = f"{system_prompt}\n\n學生訊息：{user_message}"
+            system_prompt = _DEFAULT_REPLY_SYSTEM_PROMPT
         try:
-            return await self._call_ai(prompt)
+            return await self._call_ai(f"學生訊息：{user_message}", system_prompt=system_prompt)
         except RuntimeError:
             return "系統忙碌中，請稍後再試。"
 
-    async def analyze_question(self, question_text: str) -> Dict[str, Any]:
-        """深度分析提問，回傳結構化 JSON"""
-        prompt = f"""你是一個教育數據分析師。請分析學生的提問，並回傳嚴格的 JSON 格式資料。
-欄位說明：
-- keywords: (list) 3-5個關鍵字
-- difficulty_score: (float) 0.0(最簡單)-1.0(最困難)
-- sentiment: (str) positive/neutral/negative
-- summary: (str) 20字以內的問題摘要
+    async def analyze_question(self, question_text: str) -> QuestionAnalysis:
+        """深度分析提問，回傳驗證後的分析結果 (同時段的多筆分析會合併為一次 AI 呼叫)"""
+
+        async def _analyze() -> QuestionAnalysis:
+            result = await self._enqueue_analysis(question_text)
+            if not result:
+                # 空結果不寫入快取
+                raise RuntimeError("AI 分析結果為空")
+            try:
+                return QuestionAnalysis.model_validate(result)
+            except ValidationError as e:
+                raise RuntimeError(f"AI 分析結果格式錯誤: {e}")
 
-學生提問：{question_text}"""
         try:
-            result = await self._call_ai(prompt, json_mode=True, temperature=0.3)
+            return await self._response_cache.get_or_set(
+                ("analyze", settings.GEMINI_MODEL, _normalize_question(question_text)), _analyze
+            )
         except RuntimeError:
-            result = None
-        if not result:
-            return {"keywords": [], "difficulty_score": 0.0, "sentiment": "neutral", "summary": "分析失敗"}
-        return result
+            return QuestionAnalysis(difficulty_score=0.0, summary="分析失敗")
+
+    # ── 提問分析合併批次 ─────────────────────────────────────
+
+    async def _enqueue_analysis(self, question_text: str) -> Any:
+        """將提問排入分析批次，等待批次結果"""
+        worker = self._analysis_worker
+        if worker is None or worker.done() or worker.get_loop() is not asyncio.get_running_loop():
+            self._analysis_queue = asyncio.Queue()
+            self._analysis_worker = asyncio.create_task(self._run_analysis_worker(self._analysis_queue))
+        future = asyncio.get_running_loop().create_future()
+        await self._analysis_queue.put((question_text, future))
+        return await future
+
+    async def _run_analysis_worker(self, queue: asyncio.Queue) -> None:
+        """收集 AI_ANALYSIS_BATCH_WINDOW_MS 內最多 AI_ANALYSIS_BATCH_SIZE 筆提問，整批送出分析"""
+        loop = asyncio.get_running_loop()
+        batch: List[Tuple[str, asyncio.Future]] = []
+        try:
+            while True:
+                batch = [await queue.get()]
+                deadline = loop.time() + settings.AI_ANALYSIS_BATCH_WINDOW_MS / 1000
+                while len(batch) < settings.AI_ANALYSIS_BATCH_SIZE:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+                    except asyncio.TimeoutError:
+                        break
+                # 批次在背景執行，收集下一批不需等待本批完成
+                task = asyncio.create_task(self._resolve_analysis_batch(batch))
+                self._analysis_batches.add(task)
+                task.add_done_callback(self._analysis_batches.discard)
+                batch = []
+        except asyncio.CancelledError:
+            # 收集到一半的批次尚未送出，通知呼叫端
+            _fail_pending(batch)
+            raise
+
+    async def _resolve_analysis_batch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            texts = [text for text, _ in batch]
+            if len(texts) == 1:
+                results = [await self._call_ai(
+                    _analysis_prompt(texts[0]), temperature=0.3, response_model=QuestionAnalysis
+                )]
+            else:
+                results = await self._analyze_batch(texts)
+        except asyncio.CancelledError:
+            _fail_pending(batch)
+            raise
+        except Exception as e:
+            _fail_pending(batch, e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _analyze_batch(self, texts: List[str]) -> List[Any]:
+        """以單一提示詞分析多筆提問；AI 回傳缺漏的項目改為逐筆分析"""
+        response = await self._call_ai(_batch_analysis_prompt(texts), json_mode=True, temperature=0.3)
+        items = response.get("results") if isinstance(response, dict) else None
+
+        results: List[Any] = [None] * len(texts)
+        for position, item in enumerate(items if isinstance(items, list) else []):
+            if not isinstance(item, dict):
+                continue
+            # 回應可能來自 _prompt_cache，不修改原物件，驗證時另建不含 index 的副本
+            index = item.get("index", position)
+            if not isinstance(index, int) or not 0 <= index < len(texts) or results[index] is not None:
+                continue
+            try:
+                results[index] = QuestionAnalysis.model_validate(
+                    {k: v for k, v in item.items() if k != "index"}
+                )
+            except ValidationError:
+                # 格式不符的項目視為缺漏，改為逐筆分析
+                continue
+
+        missing = [i for i, r in enumerate(results) if not r]
+        if missing:
+            logger.warning("批次分析缺少 %d/%d 筆結果，改為逐筆分析", len(missing), len(texts))
+            retried = await asyncio.gather(*(
+                self._call_ai(
+                    _analysis_prompt(texts[i]), temperature=0.3, response_model=QuestionAnalysis
+                )
+                for i in missing
+            ))
+            for i, result in zip(missing, retried):
+                results[i] = result
+        return results
 
     async def generate_response_draft(self, question_text: str) -> str:
         """生成教學回覆草稿"""
-        prompt = f"""你是一位資深的教學助理。請針對學生的問題撰寫一份回覆草稿。
-要求：
-1. 語氣親切、鼓勵學生
-2. 結構清晰，先回答核心問題，再補充範例或概念
-3. 使用繁體中文
-
-學生問題：{question_text}"""
+        prompt = _DRAFT_PROMPT + question_text
         try:
-            return await self._call_ai(prompt, temperature=0.7)
+            return await self._response_cache.get_or_set(
+                ("draft", settings.GEMINI_MODEL, _normalize_question(question_text)),
+                lambda: self._call_ai(prompt, temperature=0.7),
+            )
         except RuntimeError:
             return "無法生成草稿"
 
@@ -253,13 +653,65 @@ class AIService:
         """
         根據老師期望的核心觀念與預期迷思，深度診斷並分類學生的理解狀態。
         domain_context: 課程領域描述（選填），若未提供則使用預設電商領域指引。
+        回答數超過 AI_CLUSTER_SHARD_SIZE 時分批分群：先分群第一批，其標籤作為其餘批次的現有群組
+        (其餘批次並行)，再依群組標籤合併，合併結果不超過 max_clusters 個群組。
         """
         if not student_answers:
             return {"clusters": []}
 
-        max_chars = settings.AI_ANSWER_MAX_CHARS
+        shard_size = settings.AI_CLUSTER_SHARD_SIZE
+        if len(student_answers) <= shard_size:
+            result = await self._cluster_answers(
+                student_answers, teacher_question, core_concept,
+                expected_misconceptions, max_clusters, existing_topics, domain_context,
+            )
+            if not result:
+                return {"clusters": []}
+            return result
+
+        # 第一批的群組標籤交給其餘批次沿用，避免各批各自命名同一種迷思
+        first_result = await self._cluster_answers(
+            student_answers[:shard_size], teacher_question, core_concept,
+            expected_misconceptions, max_clusters, existing_topics, domain_context,
+        )
+        first_labels = [
+            c.get("topic_label") for c in _result_clusters(first_result) if c.get("topic_label")
+        ]
+        shared_topics = list(dict.fromkeys([*(existing_topics or []), *first_labels])) or None
+
+        offsets = list(range(shard_size, len(student_answers), shard_size))
+        semaphore = asyncio.Semaphore(settings.AI_CLUSTER_CONCURRENCY)
+
+        async def _run_shard(offset: int) -> Any:
+            async with semaphore:
+                return await self._cluster_answers(
+                    student_answers[offset:offset + shard_size], teacher_question, core_concept,
+                    expected_misconceptions, max_clusters, shared_topics, domain_context,
+                )
+
+        results = [first_result, *await asyncio.gather(*(_run_shard(offset) for offset in offsets))]
+        shards = [
+            (result, offset, min(shard_size, len(student_answers) - offset))
+            for result, offset in zip(results, [0, *offsets])
+        ]
+        return _merge_cluster_shards(shards, existing_topics, max_clusters)
+
+    async def _cluster_answers(
+        self,
+        student_answers: List[str],
+        teacher_question: str,
+        core_concept: str,
+        expected_misconceptions: Optional[str],
+        max_clusters: int,
+        existing_topics: Optional[List[str]],
+        domain_context: Optional[str],
+    ) -> Any:
+        """對單一批回答呼叫 AI 分群，question_indices 為此批內的索引"""
+        fitted_answers, truncated = _fit_answers_to_budget(
+            student_answers, settings.AI_CLUSTER_INPUT_TOKEN_BUDGET
+        )
         indexed_text = "\n".join(
-            [f"ID_{i}: {ans[:max_chars]}" for i, ans in enumerate(student_answers)]
+            [f"ID_{i}: {ans}" for i, ans in enumerate(fitted_answers)]
         )
 
         existing_topics_str = ""
@@ -276,54 +728,143 @@ class AIService:
 
         # 領域指引：可由呼叫端傳入，預設為電商
         if domain_context is None:
-            domain_context = (
-                "本課程涉及電子商務主題，學生回答可能涉及台灣常見電商平台"
-                "（蝦皮、momo、PChome、博客來等）及相關概念"
-                "（B2C、C2C、跨境電商、物流金流、數位行銷等）。"
-                "請在分群時考慮電商領域的專業知識脈絡。"
-            )
+            domain_context = _DEFAULT_DOMAIN_CONTEXT
 
         truncation_note = ""
-        if any(len(ans) > max_chars for ans in student_answers):
-            truncation_note = f"\n⚠️ 部分回答超過 {max_chars} 字元已被截斷，請根據可見內容進行判斷。\n"
+        if truncated:
+            truncation_note = "\n⚠️ 部分較長的回答已被截斷，請根據可見內容進行判斷。\n"
+
+        prompt = _CLUSTER_PROMPT_TEMPLATE.format(
+            domain_context=domain_context,
+            teacher_question=teacher_question,
+            core_concept=core_concept,
+            misconceptions_str=misconceptions_str,
+            existing_topics_str=existing_topics_str,
+            truncation_note=truncation_note,
+            max_clusters=max_clusters,
+            last_index=len(student_answers) - 1,
+            indexed_text=indexed_text,
+        )
 
-        prompt = f"""你是一位專業的「教育診斷分析師」。老師出了一道探究型的問答題，並提供了期望學生掌握的「核心觀念」。
-你的任務不是單純批改對錯，而是要「深度診斷」以下學生的作答，將具有「相似理解類型」、「相同認知盲點」或「相似迷思」的回答進行分群聚類。
+        return await self._call_ai(
+            prompt, json_mode=True, temperature=0.5, system_prompt=_CLUSTER_SYSTEM_PROMPT
+        )
 
-⚠️ 所有群組標籤與摘要必須使用繁體中文。
 
-【領域指引】
-{domain_context}
+def _fail_pending(batch: List[Tuple[str, asyncio.Future]], error: Optional[Exception] = None) -> None:
+    """以例外結束批次中尚未完成的分析 (預設為服務關閉)，呼叫端的 RuntimeError 處理會改回傳分析失敗"""
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error or RuntimeError("AI 服務已關閉，分析未完成"))
 
-【教學與診斷資訊】
-- 老師的提問：{teacher_question}
-- 期望的核心觀念：{core_concept}
-{misconceptions_str}
-{existing_topics_str}
-{truncation_note}
-【任務規則】
-1. **診斷導向分群**：請跳脫死板的對/錯，分類標籤必須精準描述學生的「認知狀態」或「思考特徵」。（例如：「具備完整因果推論」、「混淆了A與B的概念」、「只背誦專有名詞未理解本質」、「依賴直覺經驗取代科學概念」等）。
-2. **群組數量**：請將學生的回答分成合適的群組（包含現有自訂群組與你新增的群組），總群組數請盡量控制在 {max_clusters} 個以內。
-3. **強制覆蓋 (重要)**：列表中的「每一個」學生的回答都必須被分配到某個群組中 (Index 0 到 {len(student_answers)-1})，絕不能遺漏。
-4. **短答不等於無效 (極重要)**：許多學生會用非常簡短的方式作答（例如只列出名稱、關鍵字、或用逗號/數字分隔的清單）。只要回答的內容與老師的提問主題相關，就必須視為有效作答並歸入對應的認知群組。只有完全離題、開玩笑、打招呼、或明顯無意義的內容（例如「555」、「水喔」、「愚人節快樂」、純問候語）才能歸入「無效回答」類別。
-5. **格式要求**：請回傳嚴格的 JSON 格式，格式如下：
-{{
-    "clusters": [
-        {{
-            "topic_label": "群組標籤 (例如：具備完整因果推論 / 混淆了供需法則的因果)",
-            "summary": "此群組的診斷總結 (詳細說明這群學生目前的理解走到哪一步，以及共同的盲點或迷思是什麼)",
-            "question_indices": [0, 2, 5]
-        }}
+
+def _estimate_tokens(text: str) -> int:
+    """粗估 token 數：中日韓文字每字約 1 token，其餘字元約 4 字元 1 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + -(-(len(text) - cjk) // 4)
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """依 _estimate_tokens 的估算方式，截取不超過 max_tokens 的前綴"""
+    used = 0.0
+    for pos, ch in enumerate(text):
+        used += 1 if _CJK_RE.match(ch) else 0.25
+        if used > max_tokens:
+            return text[:pos]
+    return text
+
+
+def _fit_answers_to_budget(answers: List[str], budget: int) -> Tuple[List[str], bool]:
+    """
+    將整批回答放進 token 額度：較短的回答完整保留，剩餘額度平均分給較長的回答，
+    只有超出平均分配額度的回答才會被截斷。回傳 (處理後的回答, 是否有截斷)
+    """
+    costs = [_estimate_tokens(ans) for ans in answers]
+    if sum(costs) <= budget:
+        return answers, False
+
+    remaining = budget
+    cap = 0
+    order = sorted(range(len(answers)), key=costs.__getitem__)
+    for pos, i in enumerate(order):
+        share = remaining // (len(answers) - pos)
+        if costs[i] > share:
+            cap = share
+            break
+        remaining -= costs[i]
+
+    fitted = [
+        ans if cost <= cap else _truncate_to_tokens(ans, cap)
+        for ans, cost in zip(answers, costs)
     ]
-}}
+    return fitted, True
+
+
+def _match_topic_label(label: str, known_labels: List[str]) -> str:
+    """將分批結果的群組標籤對應到已知標籤 (現有自訂群組優先)，相近者視為同一群組"""
+    if label in known_labels:
+        return label
+    matches = difflib.get_close_matches(label, known_labels, n=1, cutoff=CLUSTER_LABEL_MATCH_CUTOFF)
+    return matches[0] if matches else label
+
+
+def _result_clusters(result: Any) -> List[Dict[str, Any]]:
+    """取出 AI 分群結果中的群組列表，格式不符時視為沒有群組"""
+    clusters = result.get("clusters") if isinstance(result, dict) else None
+    return [c for c in clusters if isinstance(c, dict)] if isinstance(clusters, list) else []
+
+
+def _cap_clusters(clusters: List[Dict[str, Any]], max_clusters: int) -> List[Dict[str, Any]]:
+    """群組數超過上限時保留人數最多的群組，其餘併入 OVERFLOW_CLUSTER_LABEL (回答不遺漏)"""
+    if len(clusters) <= max_clusters:
+        return clusters
+    keep_count = max(max_clusters - 1, 0)
+    ranked = sorted(range(len(clusters)), key=lambda i: -len(clusters[i]["question_indices"]))
+    kept = set(ranked[:keep_count])
+    overflow = [c for i, c in enumerate(clusters) if i not in kept]
+    return [c for i, c in enumerate(clusters) if i in kept] + [{
+        "topic_label": OVERFLOW_CLUSTER_LABEL,
+        "summary": "合併自：" + "、".join(c["topic_label"] for c in overflow),
+        "question_indices": sorted(idx for c in overflow for idx in c["question_indices"]),
+    }]
+
+
+def _merge_cluster_shards(
+    shards: List[Tuple[Any, int, int]],
+    existing_topics: Optional[List[str]] = None,
+    max_clusters: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    合併分批分群結果
 
-請對以下學生的回答進行教育診斷與分群：
-{indexed_text}"""
+    Args:
+        shards: (AI 回傳結果, 此批在全部回答中的起始位置, 此批回答數) 的列表
+        existing_topics: 現有自訂群組標籤，合併時保持名稱不變
+        max_clusters: 總群組數上限，超過時人數較少的群組合併為一群
 
-        result = await self._call_ai(prompt, json_mode=True, temperature=0.5)
-        if not result:
-            return {"clusters": []}
-        return result
+    Returns:
+        {"clusters": [...]}，question_indices 已轉為全域索引
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    for result, offset, size in shards:
+        for cluster in _result_clusters(result):
+            label = _match_topic_label(
+                cluster.get("topic_label") or "未命名群組",
+                list(existing_topics or []) + list(merged),
+            )
+            entry = merged.setdefault(
+                label, {"topic_label": label, "summary": cluster.get("summary", ""), "question_indices": []}
+            )
+            if not entry["summary"] and cluster.get("summary"):
+                entry["summary"] = cluster["summary"]
+            entry["question_indices"].extend(
+                offset + idx for idx in cluster.get("question_indices", [])
+                if isinstance(idx, int) and 0 <= idx < size
+            )
+    clusters = list(merged.values())
+    if max_clusters is not None:
+        clusters = _cap_clusters(clusters, max(max_clusters, 1))
+    return {"clusters": clusters}
 
 
 # 建立全域實例
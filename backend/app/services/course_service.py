@@ -2,28 +2,37 @@
 課程與班級管理服務
 處理課程、班級的 CRUD 操作與同步
 """
+import asyncio
+import logging
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from bson import ObjectId
-from ..database import db
+from cachetools import TTLCache
+from pymongo import ReturnDocument, UpdateOne
+from ..database import db, aggregate_options, QUESTIONS_COURSE_STATUS_INDEX
 from ..models.schemas import CourseCreate, ClassCreate
 
+logger = logging.getLogger(__name__)
+
 
 class CourseService:
     """課程管理服務類別"""
     
     def __init__(self):
         self.collection_name = "courses"
+        # 課程是否啟用，供每則 LINE 作答的寫入前檢查使用；課程更新或同步時清除
+        self._active_cache = TTLCache(maxsize=2048, ttl=60)
     
     async def create_course(self, course_data: CourseCreate) -> Dict[str, Any]:
-        """建立新課程"""
+        """建立新課程 (已有啟用中的同代碼、同學期課程時，insert_one 拋出 DuplicateKeyError)"""
         database = db.get_db()
         collection = database[self.collection_name]
         
+        now = datetime.utcnow()
         course_doc = {
             **course_data.model_dump(),
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
+            "created_at": now,
+            "updated_at": now
         }
         
         result = await collection.insert_one(course_doc)
@@ -41,6 +50,18 @@ class CourseService:
             course["_id"] = str(course["_id"])
         return course
     
+    async def is_course_active(self, course_id: str) -> bool:
+        """課程是否存在且啟用 (結果快取一段時間)"""
+        active = self._active_cache.get(course_id)
+        if active is None:
+            database = db.get_db()
+            course = await database[self.collection_name].find_one(
+                {"_id": ObjectId(course_id)}, {"is_active": 1}
+            )
+            active = bool(course and course.get("is_active", False))
+            self._active_cache[course_id] = active
+        return active
+    
     async def get_courses(
         self,
         semester: Optional[str] = None,
@@ -62,22 +83,26 @@ class CourseService:
         courses = await cursor.to_list(length=limit)
         
         course_ids = [str(c["_id"]) for c in courses]
+        if not course_ids:
+            return courses
         
-        # Batch query question counts
-        questions_collection = database["questions"]
+        # 提問數與學生數各以一次聚合批次取得，兩個查詢互不相依，同時送出
         q_pipeline = [
             {"$match": {"course_id": {"$in": course_ids}, "status": {"$ne": "DELETED"}}},
             {"$group": {"_id": "$course_id", "count": {"$sum": 1}}}
         ]
-        q_stats = {s["_id"]: s["count"] for s in await questions_collection.aggregate(q_pipeline).to_list(None)}
-        
-        # Batch query student counts
-        line_users_collection = database["line_users"]
         s_pipeline = [
             {"$match": {"current_course_id": {"$in": course_ids}}},
             {"$group": {"_id": "$current_course_id", "count": {"$sum": 1}}}
         ]
-        s_stats = {s["_id"]: s["count"] for s in await line_users_collection.aggregate(s_pipeline).to_list(None)}
+        q_results, s_results = await asyncio.gather(
+            database["questions"].aggregate(
+                q_pipeline, **aggregate_options(hint=QUESTIONS_COURSE_STATUS_INDEX)
+            ).to_list(None),
+            database["line_users"].aggregate(s_pipeline, **aggregate_options()).to_list(None),
+        )
+        q_stats = {s["_id"]: s["count"] for s in q_results}
+        s_stats = {s["_id"]: s["count"] for s in s_results}
         
         for c in courses:
             cid = str(c["_id"])
@@ -98,14 +123,19 @@ class CourseService:
         
         update_data["updated_at"] = datetime.utcnow()
         
-        result = await collection.update_one(
+        # 更新與取回合併為一次往返 (updated_at 必定變動，找到即視為已修改)
+        course = await collection.find_one_and_update(
             {"_id": ObjectId(course_id)},
-            {"$set": update_data}
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
-        
-        if result.modified_count > 0:
-            return await self.get_course(course_id)
-        return None
+        # 寫入完成後才更新啟用狀態快取：寫入期間並發的檢查可能已將舊狀態寫回快取，這裡以更新後的文件覆蓋
+        if course:
+            course["_id"] = str(course["_id"])
+            self._active_cache[course_id] = bool(course.get("is_active", False))
+        else:
+            self._active_cache.pop(course_id, None)
+        return course
     
     async def delete_course(self, course_id: str) -> bool:
         """
@@ -124,37 +154,33 @@ class CourseService:
         if result is None:
             return False
         
-        # 2. 軟刪除相關的班級
-        classes_collection = database["classes"]
-        await classes_collection.update_many(
-            {"course_id": course_id},
-            {
-                "$set": {
-                    "is_active": False,
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
-        
-        # 3. 軟刪除相關的提問（設為 DELETED 狀態）
-        questions_collection = database["questions"]
-        await questions_collection.update_many(
-            {"course_id": course_id},
-            {
-                "$set": {
-                    "status": "DELETED",
-                    "updated_at": datetime.utcnow()
-                }
-            }
-        )
-        
-        # 4. 硬刪除相關的 QA 對話
-        qas_collection = database["qas"]
-        await qas_collection.delete_many({"course_id": course_id})
+        # 2~5 互不相依，同時送出
+        now = datetime.utcnow()
+        cascade_steps = {
+            # 2. 軟刪除相關的班級
+            "classes": database["classes"].update_many(
+                {"course_id": course_id},
+                {"$set": {"is_active": False, "updated_at": now}}
+            ),
+            # 3. 軟刪除相關的提問（設為 DELETED 狀態）
+            "questions": database["questions"].update_many(
+                {"course_id": course_id},
+                {"$set": {"status": "DELETED", "updated_at": now}}
+            ),
+            # 4. 硬刪除相關的 QA 對話
+            "qas": database["qas"].delete_many({"course_id": course_id}),
+            # 5. 硬刪除相關的公告
+            "announcements": database["announcements"].delete_many({"course_id": course_id}),
+        }
+        results = await asyncio.gather(*cascade_steps.values(), return_exceptions=True)
         
-        # 5. 硬刪除相關的公告
-        announcements_collection = database["announcements"]
-        await announcements_collection.delete_many({"course_id": course_id})
+        errors = []
+        for name, outcome in zip(cascade_steps, results):
+            if isinstance(outcome, Exception):
+                logger.error("刪除課程 %s 時級聯處理 %s 失敗: %s", course_id, name, outcome)
+                errors.append(outcome)
+        if errors:
+            raise errors[0]
         
         return True
     
@@ -171,43 +197,36 @@ class CourseService:
         Returns:
             同步結果統計 {"created": 數量, "updated": 數量}
         """
+        if not courses_data:
+            return {"created": 0, "updated": 0}
+        
         database = db.get_db()
         collection = database[self.collection_name]
         
-        created_count = 0
-        updated_count = 0
-        
-        for course_data in courses_data:
-            course_code = course_data.get("course_code")
-            semester = course_data.get("semester")
-            
-            # 檢查課程是否已存在
-            existing = await collection.find_one({
-                "course_code": course_code,
-                "semester": semester
-            })
-            
-            if existing:
-                # 更新現有課程
-                await collection.update_one(
-                    {"_id": existing["_id"]},
-                    {
-                        "$set": {
-                            **course_data,
-                            "updated_at": datetime.utcnow()
-                        }
-                    }
-                )
-                updated_count += 1
-            else:
-                # 建立新課程
-                course_doc = {
-                    **course_data,
-                    "created_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow()
-                }
-                await collection.insert_one(course_doc)
-                created_count += 1
+        # 以啟用中課程的 (course_code, semester) upsert (與唯一部分索引一致，不更新軟刪除的課程)，
+        # 所有課程合併為一次 bulk_write 送出
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {
+                    "course_code": course_data.get("course_code"),
+                    "semester": course_data.get("semester"),
+                    "is_active": True
+                },
+                {
+                    "$set": {**course_data, "updated_at": now},
+                    "$setOnInsert": {"created_at": now}
+                },
+                upsert=True
+            )
+            for course_data in courses_data
+        ]
+        result = await collection.bulk_write(operations, ordered=False)
+        # 同步可能變更任一課程的啟用狀態
+        self._active_cache.clear()
+        
+        created_count = len(result.upserted_ids)
+        updated_count = result.matched_count
         
         return {"created": created_count, "updated": updated_count}
 
@@ -223,10 +242,11 @@ class ClassService:
         database = db.get_db()
         collection = database[self.collection_name]
         
+        now = datetime.utcnow()
         class_doc = {
             **class_data.model_dump(),
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
+            "created_at": now,
+            "updated_at": now
         }
         
         result = await collection.insert_one(class_doc)
@@ -276,14 +296,14 @@ class ClassService:
         
         update_data["updated_at"] = datetime.utcnow()
         
-        result = await collection.update_one(
+        class_doc = await collection.find_one_and_update(
             {"_id": ObjectId(class_id)},
-            {"$set": update_data}
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
-        
-        if result.modified_count > 0:
-            return await self.get_class(class_id)
-        return None
+        if class_doc:
+            class_doc["_id"] = str(class_doc["_id"])
+        return class_doc
     
     async def delete_class(self, class_id: str) -> bool:
         """刪除班級 (軟刪除)"""
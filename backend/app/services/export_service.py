@@ -2,12 +2,104 @@
 資料匯出服務
 提供 CSV 格式的統計資料與作答明細匯出功能
 """
-import csv
-import io
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator
 from datetime import datetime
-from ..database import db
-from ..utils.datetime_helper import format_datetime, build_date_range_query
+import pandas as pd
+from ..config import settings
+from ..database import (
+    db, aggregate_options,
+    QUESTIONS_EXPORT_QA_INDEX, QUESTIONS_EXPORT_CLUSTER_INDEX,
+    QUESTIONS_EXPORT_CLASS_INDEX, QUESTIONS_EXPORT_COURSE_INDEX, QAS_EXPORT_COURSE_INDEX,
+)
+from ..utils.datetime_helper import build_date_range_query
+from ..utils.cache import report_cache
+
+
+# 批閱狀態的中文標籤
+REVIEW_STATUS_LABELS = {"pending": "待批閱", "approved": "通過", "rejected": "退回"}
+
+# 串流匯出時每累積多少筆資料輸出一次
+CSV_BATCH_SIZE = 1000
+
+# Q&A 明細每批處理的任務數，每批以一次 $in 查詢取得回覆
+QA_BATCH_SIZE = 200
+
+QUESTION_CSV_COLUMNS = ["學號", "學生作答內容", "批閱狀態", "老師評語", "AI 分群名稱", "作答時間"]
+
+CLUSTER_CSV_COLUMNS = [
+    "聚類ID", "主題標籤 (Topic)", "綜合摘要 (Summary)",
+    "包含回覆數", "平均難度", "關鍵字", "是否人工鎖定"
+]
+
+QA_CSV_COLUMNS = ["任務問題", "核心觀念", "學號", "學生作答", "批閱狀態", "老師評語", "作答時間"]
+
+# 各匯出只取輸出欄位需要的資料，避免傳輸草稿、分析結果等大型欄位
+QUESTION_EXPORT_PROJECTION = {
+    "student_id": 1, "question_text": 1, "review_status": 1,
+    "feedback": 1, "cluster_id": 1, "created_at": 1
+}
+QUESTION_EXPORT_FIELDS = list(QUESTION_EXPORT_PROJECTION)
+CLUSTER_EXPORT_PROJECTION = {
+    "topic_label": 1, "summary": 1, "question_count": 1,
+    "avg_difficulty": 1, "keywords": 1, "is_locked": 1
+}
+QA_EXPORT_PROJECTION = {"question": 1, "core_concept": 1, "answer": 1}
+QA_REPLY_EXPORT_PROJECTION = {
+    "_id": 0, "reply_to_qa_id": 1, "student_id": 1, "question_text": 1,
+    "review_status": 1, "feedback": 1, "created_at": 1
+}
+
+
+def _csv_escape(value: Any) -> str:
+    """
+    依 Excel CSV 規則 (同 csv.QUOTE_MINIMAL) 編碼單一欄位：
+    含逗號、雙引號或換行時才加上引號，內部雙引號重複一次
+    """
+    if value is None:
+        return ""
+    text = value if isinstance(value, str) else str(value)
+    if "," in text or '"' in text or "\n" in text or "\r" in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _rows_to_csv(rows: List[list]) -> str:
+    """將多列資料編碼為 CSV 字串，直接組字串不經過 csv.writer"""
+    return "".join([",".join([_csv_escape(field) for field in row]) + "\r\n" for row in rows])
+
+
+# 標題列固定不變，載入模組時編碼一次
+QUESTION_CSV_HEADER = _rows_to_csv([QUESTION_CSV_COLUMNS])
+CLUSTER_CSV_HEADER = _rows_to_csv([CLUSTER_CSV_COLUMNS])
+QA_CSV_HEADER = _rows_to_csv([QA_CSV_COLUMNS])
+
+
+def _questions_export_index(query: Dict[str, Any]) -> list:
+    """依匯出條件選擇可同時滿足等值篩選與 created_at 排序的索引"""
+    if "reply_to_qa_id" in query:
+        return QUESTIONS_EXPORT_QA_INDEX
+    if "cluster_id" in query:
+        return QUESTIONS_EXPORT_CLUSTER_INDEX
+    if "class_id" in query:
+        return QUESTIONS_EXPORT_CLASS_INDEX
+    return QUESTIONS_EXPORT_COURSE_INDEX
+
+
+async def _iter_batches(cursor, size: int) -> AsyncIterator[List[dict]]:
+    """逐筆讀取游標，每累積 size 筆輸出一批，最後不足一批的部分也會輸出"""
+    batch: List[dict] = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _collect(chunks: AsyncIterator[str]) -> str:
+    """將串流匯出的片段合併為完整字串"""
+    return "".join([chunk async for chunk in chunks])
 
 
 class ExportService:
@@ -25,6 +117,22 @@ class ExportService:
         """
         匯出學生作答明細資料為 CSV 格式 (包含 AI 分析欄位)
         """
+        return await _collect(self.stream_questions_csv(
+            course_id, class_id, cluster_id, start_date, end_date, qa_id
+        ))
+
+    async def stream_questions_csv(
+        self,
+        course_id: str,
+        class_id: Optional[str] = None,
+        cluster_id: Optional[str] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        qa_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        以串流方式匯出學生作答明細 CSV，先輸出標題列，之後每批資料輸出一段
+        """
         database = db.get_db()
         collection = database["questions"]
         
@@ -36,94 +144,109 @@ class ExportService:
         if class_id:
             query["class_id"] = class_id
 
+        # 只在有指定時加入等值條件；{"$exists": False} 之類的條件無法有效利用索引
         if cluster_id:
             query["cluster_id"] = cluster_id
         
         # 時間區間過濾
         query.update(build_date_range_query(start_date, end_date))
         
-        # 取得資料
-        cursor = collection.find(query).sort("created_at", -1)
-        questions = await cursor.to_list(length=None)
+        yield QUESTION_CSV_HEADER
         
-        # 建立 CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
+        # 僅取匯出需要的欄位，游標批次與輸出批次分開調整，避免一次載入全部資料；
+        # 以 hint 固定使用含 created_at 的複合索引，避免查詢計畫退回記憶體排序
+        cursor = (
+            collection.find(query, QUESTION_EXPORT_PROJECTION)
+            .hint(_questions_export_index(query))
+            .sort("created_at", -1)
+            .batch_size(settings.MONGODB_EXPORT_CURSOR_BATCH_SIZE)
+        )
         
-        # 預先查詢 cluster 名稱對照表
-        cluster_ids = list(set(q.get("cluster_id") for q in questions if q.get("cluster_id")))
-        cluster_names = {}
-        if cluster_ids:
+        cluster_names: Dict[str, str] = {}
+        async for batch in _iter_batches(cursor, CSV_BATCH_SIZE):
+            yield await self._questions_batch_to_csv(database, batch, cluster_names)
+
+    async def _questions_batch_to_csv(
+        self,
+        database,
+        questions: List[dict],
+        cluster_names: Dict[str, str]
+    ) -> str:
+        """將一批作答資料轉為 CSV，cluster 名稱僅查詢尚未快取的部分"""
+        missing_ids = {
+            q["cluster_id"] for q in questions
+            if q.get("cluster_id") and q["cluster_id"] not in cluster_names
+        }
+        if missing_ids:
             from bson import ObjectId as ObjId
-            valid_ids = [ObjId(cid) for cid in cluster_ids if cid]
+            valid_ids = [ObjId(cid) for cid in missing_ids if ObjId.is_valid(cid)]
+            for cid in missing_ids:
+                cluster_names[cid] = ""
             if valid_ids:
-                clusters_cursor = database["clusters"].find({"_id": {"$in": valid_ids}})
+                clusters_cursor = database["clusters"].find({"_id": {"$in": valid_ids}}, {"topic_label": 1})
                 async for c in clusters_cursor:
                     cluster_names[str(c["_id"])] = c.get("topic_label", "")
         
-        writer.writerow([
-            "學號", "學生作答內容", "批閱狀態", "老師評語",
-            "AI 分群名稱", "作答時間"
-        ])
+        # 由 pandas 一次從整批文件取出匯出欄位 (缺少的欄位為 NaN)，不在 Python 層逐筆逐欄呼叫 q.get
+        records = pd.DataFrame.from_records(questions, columns=QUESTION_EXPORT_FIELDS)
+        statuses = records["review_status"]
+        statuses = statuses.where(statuses.notna() & (statuses != ""), "pending")
+        created_at = pd.to_datetime(records["created_at"])
+        frame = pd.DataFrame({
+            "學號": records["student_id"],
+            "學生作答內容": records["question_text"],
+            "批閱狀態": statuses.map(REVIEW_STATUS_LABELS).fillna(statuses),
+            "老師評語": records["feedback"],
+            "AI 分群名稱": records["cluster_id"].map(cluster_names),
+            "作答時間": created_at.dt.strftime("%Y-%m-%d %H:%M:%S"),
+        })
         
-        for q in questions:
-            status = q.get("review_status", "pending")
-            status_label = {"pending": "待批閱", "approved": "通過", "rejected": "退回"}.get(status, status)
-            cluster_id = q.get("cluster_id", "")
-            cluster_label = cluster_names.get(cluster_id, "") if cluster_id else ""
-            
-            writer.writerow([
-                q.get("student_id", "") or "",
-                q.get("question_text", ""),
-                status_label,
-                q.get("feedback", "") or "",
-                cluster_label,
-                format_datetime(q.get("created_at")) if q.get("created_at") else ""
-            ])
-        
-        csv_content = output.getvalue()
-        output.close()
-        
-        return csv_content
+        return frame.to_csv(index=False, header=False, lineterminator="\r\n")
 
 
     async def export_clusters_to_csv(self, course_id: str) -> str:
         """
         匯出 AI 聚類主題分析報表
         """
+        return await _collect(self.stream_clusters_csv(course_id))
+
+    async def stream_clusters_csv(self, course_id: str) -> AsyncIterator[str]:
+        """
+        以串流方式匯出 AI 聚類主題分析報表 (先輸出標題列，聚類數量少，資料一次輸出)
+        """
+        # 先輸出標題列，查詢期間瀏覽器即可開始下載
+        yield CLUSTER_CSV_HEADER
+        
+        # 聚類報表很小，短時間內重複下載直接使用快取；聚類異動時由 invalidate_course_reports 清除
+        rows_csv = await report_cache.get_or_set(
+            ("clusters_csv", course_id), lambda: self._clusters_rows_csv(course_id)
+        )
+        if rows_csv:
+            yield rows_csv
+
+    async def _clusters_rows_csv(self, course_id: str) -> str:
+        """查詢課程的聚類並編碼為 CSV 資料列 (不含標題列)"""
         database = db.get_db()
         collection = database["clusters"]
         
-        cursor = collection.find({"course_id": course_id}).sort("question_count", -1)
-        clusters = await cursor.to_list(length=None)
-        
-        # 建立 CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # 寫入標題
-        writer.writerow([
-            "聚類ID", "主題標籤 (Topic)", "綜合摘要 (Summary)", 
-            "包含回覆數", "平均難度", "關鍵字", "是否人工鎖定"
-        ])
-        
-        # 處理資料
-        for c in clusters:
-            keywords = c.get("keywords") or []
-            writer.writerow([
+        # 逐筆讀取游標組成資料列，不先將整個結果集載入為串列
+        cursor = collection.find(
+            {"course_id": course_id}, CLUSTER_EXPORT_PROJECTION
+        ).sort("question_count", -1)
+        rows: List[list] = []
+        async for c in cursor:
+            keywords = c.get("keywords")
+            rows.append([
                 str(c["_id"]),
                 c.get("topic_label", ""),
                 c.get("summary", ""),
                 c.get("question_count", 0),
                 f"{c.get('avg_difficulty', 0):.2f}",
-                ", ".join(keywords),
+                ", ".join(keywords) if keywords else "",
                 "是" if c.get("is_locked", False) else "否"
             ])
-            
-        csv_content = output.getvalue()
-        output.close()
         
-        return csv_content
+        return _rows_to_csv(rows)
 
 
     async def export_qas_to_csv(
@@ -136,6 +259,18 @@ class ExportService:
         """
         匯出 Q&A 任務 + 學生作答明細為 CSV 格式（每筆回覆一列）
         """
+        return await _collect(self.stream_qas_csv(course_id, class_id, start_date, end_date))
+
+    async def stream_qas_csv(
+        self,
+        course_id: str,
+        class_id: Optional[str] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None
+    ) -> AsyncIterator[str]:
+        """
+        以串流方式匯出 Q&A 任務 + 學生作答明細，每累積一批資料列輸出一段
+        """
         database = db.get_db()
         qa_collection = database["qas"]
         question_collection = database["questions"] 
@@ -145,53 +280,54 @@ class ExportService:
             query["$or"] = [{"class_id": class_id}, {"class_id": None}]
         query.update(build_date_range_query(start_date, end_date))
         
-        cursor = qa_collection.find(query).sort("created_at", -1)
-        qas = await cursor.to_list(length=None)
+        # 先輸出標題列，查詢期間瀏覽器即可開始下載
+        yield QA_CSV_HEADER
         
+        # 依批次讀取任務，每批任務以一次 $in 查詢取得回覆，記憶體用量不隨任務總數成長
+        cursor = (
+            qa_collection.find(query, QA_EXPORT_PROJECTION)
+            .hint(QAS_EXPORT_COURSE_INDEX)
+            .sort("created_at", -1)
+            .batch_size(settings.MONGODB_EXPORT_CURSOR_BATCH_SIZE)
+        )
+        async for qa_batch in _iter_batches(cursor, QA_BATCH_SIZE):
+            yield await self._qas_batch_to_csv(question_collection, qa_batch)
+
+    async def _qas_batch_to_csv(self, question_collection, qas: List[dict]) -> str:
+        """將一批 Q&A 任務與其學生回覆轉為 CSV 資料列"""
         qa_ids = [str(qa["_id"]) for qa in qas]
-        all_replies_cursor = question_collection.find(
-            {"reply_to_qa_id": {"$in": qa_ids}}
-        ).sort("created_at", 1)
-        all_replies = await all_replies_cursor.to_list(length=None)
-        
         replies_map: Dict[str, list] = {}
-        for r in all_replies:
-            qa_id = r.get("reply_to_qa_id")
-            replies_map.setdefault(qa_id, []).append(r)
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        writer.writerow([
-            "任務問題", "核心觀念", "學號", "學生作答", 
-            "批閱狀態", "老師評語", "作答時間"
-        ])
+        replies_cursor = question_collection.find(
+            {"reply_to_qa_id": {"$in": qa_ids}}, QA_REPLY_EXPORT_PROJECTION
+        ).sort("created_at", 1)
+        async for r in replies_cursor:
+            replies_map.setdefault(r.get("reply_to_qa_id"), []).append(r)
         
+        lines: List[str] = []
         for qa in qas:
             qa_id_str = str(qa["_id"])
-            question_text = qa.get("question", "")
             core_concept = qa.get("core_concept", "") or qa.get("answer", "")
+            # 同一任務的問題與核心觀念只需編碼一次
+            qa_prefix = f"{_csv_escape(qa.get('question', ''))},{_csv_escape(core_concept)}"
             replies = replies_map.get(qa_id_str, [])
             
             if not replies:
-                writer.writerow([question_text, core_concept, "", "（無學生回覆）", "", "", ""])
+                lines.append(f"{qa_prefix},,（無學生回覆）,,,\r\n")
             else:
                 for r in replies:
                     status = r.get("review_status", "pending")
-                    status_label = {"pending": "待批閱", "approved": "通過", "rejected": "退回"}.get(status, status)
-                    writer.writerow([
-                        question_text,
-                        core_concept,
-                        r.get("student_id", "") or "",
-                        r.get("question_text", ""),
-                        status_label,
-                        r.get("feedback", "") or "",
-                        format_datetime(r.get("created_at")) if r.get("created_at") else ""
-                    ])
-        
-        csv_content = output.getvalue()
-        output.close()
-        return csv_content
+                    # 狀態標籤與時間格式固定，不含需跳脫的字元；自由輸入的欄位才需編碼
+                    status_label = REVIEW_STATUS_LABELS.get(status) or _csv_escape(status)
+                    # 資料庫回傳 naive datetime，isoformat 的輸出與 "%Y-%m-%d %H:%M:%S" 相同但省去 strftime 解析格式
+                    created_at = r.get("created_at")
+                    created = created_at.isoformat(" ", "seconds") if created_at else ""
+                    lines.append(
+                        f"{qa_prefix},{_csv_escape(r.get('student_id') or '')},"
+                        f"{_csv_escape(r.get('question_text', ''))},{status_label},"
+                        f"{_csv_escape(r.get('feedback') or '')},{created}\r\n"
+                    )
+        
+        return "".join(lines)
 
 
     async def export_statistics_to_csv(
@@ -204,6 +340,32 @@ class ExportService:
         """
         匯出任務成效統計資料為 CSV 格式
         """
+        return await _collect(self.stream_statistics_csv(course_id, class_id, start_date, end_date))
+
+    async def stream_statistics_csv(
+        self,
+        course_id: str,
+        class_id: Optional[str] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None
+    ) -> AsyncIterator[str]:
+        """
+        以串流方式匯出任務成效統計 (統計結果僅數列，一次輸出)
+        """
+        # 統計結果很小，相同條件的重複下載直接使用快取；作答異動時由 invalidate_course_reports 清除
+        yield await report_cache.get_or_set(
+            ("statistics_csv", course_id, class_id, start_date, end_date),
+            lambda: self._statistics_csv(course_id, class_id, start_date, end_date)
+        )
+
+    async def _statistics_csv(
+        self,
+        course_id: str,
+        class_id: Optional[str],
+        start_date: Optional[datetime],
+        end_date: Optional[datetime]
+    ) -> str:
+        """執行統計聚合並編碼為 CSV"""
         database = db.get_db()
         collection = database["questions"]
         
@@ -213,37 +375,51 @@ class ExportService:
 
         query.update(build_date_range_query(start_date, end_date))
         
-        # 1. 取得總作答數
-        total_replies = await collection.count_documents(query)
-        
-        # 2. 統計難度分布
-        difficulty_pipeline = [
-            {"$match": {**query, "difficulty_level": {"$ne": None}}},
-            {"$group": {"_id": {"$toUpper": "$difficulty_level"}, "count": {"$sum": 1}}}
+        # 以單一 $facet 一次取得總數、難度分布與批閱狀態分布
+        pipeline = [
+            {"$match": query},
+            {"$project": {"_id": 0, "difficulty_level": 1, "review_status": 1}},
+            {"$facet": {
+                "total": [{"$count": "count"}],
+                "by_difficulty": [
+                    {"$match": {"difficulty_level": {"$ne": None}}},
+                    {"$group": {"_id": {"$toUpper": "$difficulty_level"}, "count": {"$sum": 1}}}
+                ],
+                "by_review_status": [
+                    {"$group": {"_id": "$review_status", "count": {"$sum": 1}}}
+                ]
+            }}
         ]
-        difficulty_stats = await collection.aggregate(difficulty_pipeline).to_list(length=None)
-        
-        # 建立 CSV
-        output = io.StringIO()
-        writer = csv.writer(output)
+        facet_results = await collection.aggregate(pipeline, **aggregate_options()).to_list(length=1)
+        facets = facet_results[0] if facet_results else {}
         
-        writer.writerow(["=== 任務作答總覽 ==="])
-        writer.writerow(["總收集回覆數", total_replies])
-        writer.writerow([])
+        total_replies = facets["total"][0]["count"] if facets.get("total") else 0
+        difficulty_stats = facets.get("by_difficulty", [])
+        review_status_stats = facets.get("by_review_status", [])
         
-        writer.writerow(["=== 學生學習難度分布 ==="])
-        writer.writerow(["難度等級", "數量"])
+        rows: List[list] = [
+            ["=== 任務作答總覽 ==="],
+            ["總收集回覆數", total_replies],
+            [],
+            ["=== 學生學習難度分布 ==="],
+            ["難度等級", "數量"],
+        ]
         for stat in difficulty_stats:
             diff_label = stat["_id"]
             if diff_label == "EASY": diff_label = "簡單"
             elif diff_label == "MEDIUM": diff_label = "中等"
             elif diff_label == "HARD": diff_label = "困難"
             
-            writer.writerow([diff_label, stat["count"]])
+            rows.append([diff_label, stat["count"]])
+        rows.append([])
+        
+        rows.append(["=== 批閱狀態分布 ==="])
+        rows.append(["批閱狀態", "數量"])
+        for stat in review_status_stats:
+            status = stat["_id"] or "pending"
+            rows.append([REVIEW_STATUS_LABELS.get(status, status), stat["count"]])
         
-        csv_content = output.getvalue()
-        output.close()
-        return csv_content
+        return _rows_to_csv(rows)
 
 
 # 全域服務實例
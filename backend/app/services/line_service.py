@@ -2,15 +2,19 @@
 LINE 服務邏輯層
 負責處理 LINE Bot 的訊息判斷、課程綁定與提問記錄
 """
-import traceback
 import asyncio
+import logging
 from datetime import datetime, timedelta
+from typing import List, Optional, Set
 from bson import ObjectId
+from cachetools import TTLCache
+from pymongo.errors import BulkWriteError
 from linebot.v3.messaging import (
     Configuration,
     AsyncApiClient,
     AsyncMessagingApi,
     ReplyMessageRequest,
+    PushMessageRequest,
     TextMessage,
     MulticastRequest
 )
@@ -23,46 +27,175 @@ from linebot.v3.webhooks import (
 from ..config import settings
 from ..database import db
 from ..utils.security import generate_pseudonym
+from ..utils.cache import AsyncTTLCache
 from ..models.schemas import QuestionCreate
 from .question_service import question_service
 
+logger = logging.getLogger(__name__)
+
+# LINE multicast 單次最多 500 位收件者，亦作為讀取學生名單的游標批次大小
+MULTICAST_BATCH_SIZE = 500
+
 class LineService:
     def __init__(self):
         self.configuration = Configuration(access_token=settings.LINE_CHANNEL_ACCESS_TOKEN)
+        # 儀表板輪詢用的短時效快取 (LINE 配置、訊息統計)
+        self.stats_cache = AsyncTTLCache(maxsize=128, ttl=10)
+        # 已受理的 webhook_event_id，避免 LINE 重送時重複處理
+        self._seen_event_ids = TTLCache(maxsize=10000, ttl=600)
+        # 訂閱即時統計 (SSE) 的連線佇列
+        self._stats_subscribers: Set[asyncio.Queue] = set()
+        # 共用的 LINE Messaging API 客戶端，回覆與推播重複使用同一個連線池
+        self._api_client: Optional[AsyncApiClient] = None
+        self._messaging_api: Optional[AsyncMessagingApi] = None
+        self._api_lock = asyncio.Lock()
+        # 綁定指令的課程查詢快取，鍵為學生輸入的課程代碼 (課程資料甚少變動)
+        self._course_cache = TTLCache(maxsize=256, ttl=60)
+        # 使用者目前綁定的課程與學號，綁定 / 解除綁定時清除
+        self._user_bindings = TTLCache(maxsize=10000, ttl=300)
+        # 收到的訊息紀錄先排入佇列，由背景 worker 合併為 insert_many 批次寫入
+        self._message_log_queue: Optional[asyncio.Queue] = None
+        self._message_log_worker: Optional[asyncio.Task] = None
+        # 背景寫入訊息紀錄的 task，保留參照避免執行中被回收
+        self._background_tasks: Set[asyncio.Task] = set()
+
+    async def _get_messaging_api(self) -> AsyncMessagingApi:
+        """Lazy init 共用的 AsyncMessagingApi（需在事件迴圈中建立連線池）"""
+        async with self._api_lock:
+            if self._messaging_api is None:
+                self._api_client = AsyncApiClient(self.configuration)
+                self._messaging_api = AsyncMessagingApi(self._api_client)
+            return self._messaging_api
+
+    async def aclose(self) -> None:
+        """寫完佇列中的訊息紀錄並關閉共用的 LINE API 連線（應用程式關閉時呼叫）"""
+        worker = self._message_log_worker
+        if worker is not None and not worker.done() and worker.get_loop() is asyncio.get_running_loop():
+            # 以 None 通知 worker 送出手上的批次後結束
+            self._message_log_queue.put_nowait(None)
+            await worker
+        self._message_log_worker = None
+        self._message_log_queue = None
+        if self._background_tasks:
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        async with self._api_lock:
+            if self._api_client is not None:
+                await self._api_client.close()
+                self._api_client = None
+                self._messaging_api = None
+
+    def claim_webhook_event(self, event_id) -> bool:
+        """
+        登記 webhook 事件 ID，第一次出現時回傳 True，重複出現時回傳 False
+
+        沒有事件 ID 的事件一律視為新事件
+        """
+        if not event_id:
+            return True
+        if event_id in self._seen_event_ids:
+            return False
+        self._seen_event_ids[event_id] = True
+        return True
+
+    def invalidate_stats_cache(self):
+        """收到新訊息後清除統計快取，限制儀表板資料的過期時間"""
+        for prefix in ("line_config", "line_stats", "message_stats"):
+            self.stats_cache.invalidate_prefix(prefix)
+
+    def subscribe_stats(self) -> asyncio.Queue:
+        """註冊一個即時統計訂閱者，回傳接收增量的佇列"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+        self._stats_subscribers.add(queue)
+        return queue
+
+    def unsubscribe_stats(self, queue: asyncio.Queue):
+        """移除即時統計訂閱者"""
+        self._stats_subscribers.discard(queue)
+
+    def notify_message_recorded(self, direction: str, created_at: datetime):
+        """
+        新訊息寫入後呼叫：清除統計快取並推送增量給所有訂閱者
+
+        Args:
+            direction: 訊息方向 (received / sent / failed)
+            created_at: 訊息建立時間
+        """
+        self.invalidate_stats_cache()
+        if not self._stats_subscribers:
+            return
+        delta = {"direction": direction, "date": created_at.strftime("%Y-%m-%d")}
+        for queue in list(self._stats_subscribers):
+            try:
+                queue.put_nowait(delta)
+            except asyncio.QueueFull:
+                # 消費過慢的連線直接略過此筆增量，前端可重新載入完整統計
+                pass
 
     async def _reply_text(self, reply_token: str, text: str):
         """共用的回覆文字訊息方法"""
         if not settings.LINE_CHANNEL_ACCESS_TOKEN:
-            print("⚠️ LINE_CHANNEL_ACCESS_TOKEN 未設定，無法回覆訊息")
+            logger.warning("⚠️ LINE_CHANNEL_ACCESS_TOKEN 未設定，無法回覆訊息")
             return
 
         try:
-            async with AsyncApiClient(self.configuration) as api_client:
-                line_bot_api = AsyncMessagingApi(api_client)
-                await line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=reply_token,
-                        messages=[TextMessage(text=text)]
-                    )
+            line_bot_api = await self._get_messaging_api()
+            await line_bot_api.reply_message(
+                ReplyMessageRequest(
+                    reply_token=reply_token,
+                    messages=[TextMessage(text=text)]
                 )
+            )
         except Exception as e:
-            print(f"❌ 傳送 LINE 回覆失敗: {str(e)}")
+            logger.error("❌ 傳送 LINE 回覆失敗: %s", e)
 
-    async def broadcast_qa_to_course(self, course_id: str, qa_data: dict):
-        """將 Q&A 推播給該課程的所有學生"""
-        if not settings.LINE_CHANNEL_ACCESS_TOKEN:
-            print("⚠️ LINE_CHANNEL_ACCESS_TOKEN 未設定，無法推播")
-            return
+    async def get_bot_info(self):
+        """以共用的 Messaging API 客戶端取得 Bot 資訊 (失敗時拋出例外由呼叫端處理)"""
+        line_bot_api = await self._get_messaging_api()
+        return await line_bot_api.get_bot_info()
+
+    async def push_text(self, user_id: str, text: str):
+        """以共用的 Messaging API 客戶端推播文字訊息給單一使用者 (失敗時拋出例外由呼叫端處理)"""
+        line_bot_api = await self._get_messaging_api()
+        await line_bot_api.push_message(
+            PushMessageRequest(to=user_id, messages=[TextMessage(text=text)])
+        )
 
+    async def _multicast_to_course(self, course_id: str, text: str) -> int:
+        """
+        串流讀取課程學生並逐批 multicast，回傳推播人數
+        游標每取回一批即送出，不必先將整個學生名單載入記憶體
+        """
         database = db.get_db()
+        cursor = database["line_users"].find(
+            {"current_course_id": course_id}, {"_id": 0, "user_id": 1}
+        ).batch_size(MULTICAST_BATCH_SIZE)
         
-        cursor = database["line_users"].find({"current_course_id": course_id})
-        users = await cursor.to_list(length=None)
+        sent = 0
+        batch_user_ids: List[str] = []
         
-        user_ids = [u["user_id"] for u in users if "user_id" in u]
+        async def send(user_ids: List[str]):
+            line_bot_api = await self._get_messaging_api()
+            await line_bot_api.multicast(
+                MulticastRequest(to=user_ids, messages=[TextMessage(text=text)])
+            )
         
-        if not user_ids:
-            print(f"課程 {course_id} 目前沒有綁定的學生，略過推播")
+        async for user in cursor:
+            if "user_id" not in user:
+                continue
+            batch_user_ids.append(user["user_id"])
+            if len(batch_user_ids) == MULTICAST_BATCH_SIZE:
+                await send(batch_user_ids)
+                sent += len(batch_user_ids)
+                batch_user_ids = []
+        if batch_user_ids:
+            await send(batch_user_ids)
+            sent += len(batch_user_ids)
+        return sent
+
+    async def broadcast_qa_to_course(self, course_id: str, qa_data: dict):
+        """將 Q&A 推播給該課程的所有學生"""
+        if not settings.LINE_CHANNEL_ACCESS_TOKEN:
+            logger.warning("⚠️ LINE_CHANNEL_ACCESS_TOKEN 未設定，無法推播")
             return
 
         text = f"📢 【課堂 Q&A 推播】\n\n❓ 問題：\n{qa_data.get('question')}"
@@ -75,60 +208,35 @@ class LineService:
         else:
             text += f"\n\n💡 參考解答：\n{qa_data.get('answer')}"
         
-        batch_size = 500
         try:
-            async with AsyncApiClient(self.configuration) as api_client:
-                line_bot_api = AsyncMessagingApi(api_client)
-                
-                for i in range(0, len(user_ids), batch_size):
-                    batch_user_ids = user_ids[i:i+batch_size]
-                    await line_bot_api.multicast(
-                        MulticastRequest(
-                            to=batch_user_ids,
-                            messages=[TextMessage(text=text)]
-                        )
-                    )
-            print(f"✅ 成功推播 Q&A 給 {len(user_ids)} 位學生")
-        except Exception as e:
-            print(f"❌ 推播 Q&A 失敗: {str(e)}")
-            traceback.print_exc()
+            sent = await self._multicast_to_course(course_id, text)
+        except Exception:
+            logger.exception("❌ 推播 Q&A 失敗")
+            return
+        
+        if not sent:
+            logger.info("課程 %s 目前沒有綁定的學生，略過推播", course_id)
+            return
+        logger.info("✅ 成功推播 Q&A 給 %d 位學生", sent)
 
     async def broadcast_announcement_to_course(self, course_id: str, announcement_data: dict):
         """將課堂公告推播給該課程的所有學生"""
         if not settings.LINE_CHANNEL_ACCESS_TOKEN:
-            print("⚠️ LINE_CHANNEL_ACCESS_TOKEN 未設定，無法推播公告")
-            return
-
-        database = db.get_db()
-        
-        cursor = database["line_users"].find({"current_course_id": course_id})
-        users = await cursor.to_list(length=None)
-        
-        user_ids = [u["user_id"] for u in users if "user_id" in u]
-        
-        if not user_ids:
-            print(f"課程 {course_id} 目前沒有綁定的學生，略過推播公告")
+            logger.warning("⚠️ LINE_CHANNEL_ACCESS_TOKEN 未設定，無法推播公告")
             return
 
         text = f"🔔 【課堂公告】\n\n📌 標題：{announcement_data.get('title')}\n\n📝 內容：\n{announcement_data.get('content')}"
         
-        batch_size = 500
         try:
-            async with AsyncApiClient(self.configuration) as api_client:
-                line_bot_api = AsyncMessagingApi(api_client)
-                
-                for i in range(0, len(user_ids), batch_size):
-                    batch_user_ids = user_ids[i:i+batch_size]
-                    await line_bot_api.multicast(
-                        MulticastRequest(
-                            to=batch_user_ids,
-                            messages=[TextMessage(text=text)]
-                        )
-                    )
-            print(f"✅ 成功推播公告給 {len(user_ids)} 位學生")
-        except Exception as e:
-            print(f"❌ 推播公告失敗: {str(e)}")
-            traceback.print_exc()
+            sent = await self._multicast_to_course(course_id, text)
+        except Exception:
+            logger.exception("❌ 推播公告失敗")
+            return
+        
+        if not sent:
+            logger.info("課程 %s 目前沒有綁定的學生，略過推播公告", course_id)
+            return
+        logger.info("✅ 成功推播公告給 %d 位學生", sent)
 
     async def handle_follow(self, event: FollowEvent):
         """處理加入好友事件"""
@@ -152,11 +260,10 @@ class LineService:
         user_id = event.source.user_id
         message_text = event.message.text.strip()
         reply_token = event.reply_token
-        
-        database = db.get_db()
 
         pseudonym = generate_pseudonym(user_id)
-        await database["line_messages"].insert_one({
+        # 訊息紀錄僅供統計，排入背景批次寫入，不延遲後續的指令判斷與回覆
+        self._enqueue_message_log({
             "user_id": user_id,
             "pseudonym": pseudonym,
             "message_type": "text",
@@ -177,6 +284,78 @@ class LineService:
 
         await self._handle_question(user_id, pseudonym, message_text, reply_token, event.message.id)
 
+    # ── 訊息紀錄合併批次 ─────────────────────────────────────
+
+    def _enqueue_message_log(self, message_doc: dict):
+        """將收到的訊息紀錄排入批次寫入佇列"""
+        worker = self._message_log_worker
+        if worker is None or worker.done() or worker.get_loop() is not asyncio.get_running_loop():
+            self._message_log_queue = asyncio.Queue()
+            self._message_log_worker = asyncio.create_task(
+                self._run_message_log_worker(self._message_log_queue)
+            )
+        self._message_log_queue.put_nowait(message_doc)
+
+    async def _run_message_log_worker(self, queue: asyncio.Queue):
+        """收集 LINE_MESSAGE_LOG_BATCH_WINDOW_MS 內最多 LINE_MESSAGE_LOG_BATCH_SIZE 筆紀錄，整批寫入；收到 None 時送出手上的批次後結束"""
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            doc = await queue.get()
+            if doc is None:
+                return
+            batch = [doc]
+            deadline = loop.time() + settings.LINE_MESSAGE_LOG_BATCH_WINDOW_MS / 1000
+            while len(batch) < settings.LINE_MESSAGE_LOG_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                if doc is None:
+                    closing = True
+                    break
+                batch.append(doc)
+            # 批次在背景寫入，收集下一批不需等待本批完成
+            task = asyncio.create_task(self._record_received_messages(batch))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+    async def _record_received_messages(self, message_docs: List[dict]):
+        """批次寫入收到的訊息紀錄並通知統計訂閱者；紀錄僅供統計，寫入失敗只記錄不重試"""
+        try:
+            await db.get_db()["line_messages"].insert_many(message_docs, ordered=False)
+        except BulkWriteError as e:
+            failed = {err["index"] for err in e.details.get("writeErrors", [])}
+            logger.error("❌ 寫入 LINE 訊息紀錄部分失敗: %d / %d 筆", len(failed), len(message_docs))
+            message_docs = [doc for i, doc in enumerate(message_docs) if i not in failed]
+        except Exception:
+            logger.exception("❌ 寫入 LINE 訊息紀錄失敗")
+            return
+        for doc in message_docs:
+            self.notify_message_recorded("received", doc["created_at"])
+
+    async def _find_course_by_code(self, course_code: str) -> Optional[dict]:
+        """依課程 ID 或課程名稱查詢課程，找到的結果快取一段時間"""
+        course = self._course_cache.get(course_code)
+        if course is not None:
+            return course
+
+        database = db.get_db()
+        projection = {"course_name": 1}
+        # 先判斷是否為合法 ObjectId，不以例外處理分支；以 ID 查無時再依課程名稱查詢
+        if ObjectId.is_valid(course_code):
+            course = await database["courses"].find_one({"_id": ObjectId(course_code)}, projection)
+        if not course:
+            course = await database["courses"].find_one({"course_name": course_code}, projection)
+
+        # 查無課程不快取，避免剛建立的課程在快取期間無法綁定
+        if course:
+            self._course_cache[course_code] = course
+        return course
+
     async def _handle_bind_course(self, user_id: str, message_text: str, reply_token: str):
         """處理綁定課程邏輯"""
         database = db.get_db()
@@ -196,12 +375,7 @@ class LineService:
             return
         # ========================================================
         
-        course = None
-        try:
-            course = await database["courses"].find_one({"_id": ObjectId(course_code)})
-        except:
-            course = await database["courses"].find_one({"course_name": course_code})
-            
+        course = await self._find_course_by_code(course_code)
         if not course:
             await self._reply_text(reply_token, f"❌ 找不到代碼為「{course_code}」的課程。請向助教或老師確認正確的代碼喔！")
             return
@@ -218,6 +392,7 @@ class LineService:
             }},
             upsert=True
         )
+        self._user_bindings.pop(user_id, None)
 
         reply_msg = f"✅ 綁定成功！\n您已成功以學號「{student_id}」加入「{course['course_name']}」。\n\n現在起，您可以直接把答案打字傳上來，系統會自動幫您記錄喔！"
         # ===================================================
@@ -236,13 +411,27 @@ class LineService:
                 "updated_at": datetime.utcnow()
             }}
         )
+        self._user_bindings.pop(user_id, None)
         await self._reply_text(reply_token, "👋 已為您解除綁定。若有其他課程的問題，請重新輸入綁定指令。")
 
+    async def _get_user_binding(self, user_id: str) -> Optional[dict]:
+        """取得使用者綁定的課程與學號，已綁定課程的結果快取一段時間"""
+        binding = self._user_bindings.get(user_id)
+        if binding is not None:
+            return binding
+
+        binding = await db.get_db()["line_users"].find_one(
+            {"user_id": user_id}, {"_id": 0, "current_course_id": 1, "student_id": 1}
+        )
+        if binding and binding.get("current_course_id"):
+            self._user_bindings[user_id] = binding
+        return binding
+
     async def _handle_question(self, user_id: str, pseudonym: str, message_text: str, reply_token: str, message_id: str):
         """處理學生提問與回覆邏輯 (僅限 Q&A 任務)"""
         database = db.get_db()
         
-        user_data = await database["line_users"].find_one({"user_id": user_id})
+        user_data = await self._get_user_binding(user_id)
         
         if not user_data or not user_data.get("current_course_id"):
             await self._reply_text(reply_token, "⚠️ 您尚未綁定任何課程！\n請先輸入「綁定 [課程代碼] [學號]」來告訴我您要參與哪堂課。")
@@ -273,7 +462,8 @@ class LineService:
 
         # 寫入資料庫
         try:
-            new_q_data = QuestionCreate(
+            # 欄位皆為伺服器端取得的字串 (綁定資料、任務 ID、LINE 事件)，QuestionCreate 沒有額外驗證規則，略過驗證直接建構
+            new_q_data = QuestionCreate.model_construct(
                 course_id=course_id,
                 line_user_id=user_id,
                 student_id=student_id, # 🔥 傳入學號給服務層
@@ -288,9 +478,8 @@ class LineService:
         except ValueError as ve:
             # 這裡會攔截到超過 max_attempts 次數的錯誤，並回覆給學生
             await self._reply_text(reply_token, f"❌ 操作失敗：{str(ve)}")
-        except Exception as e:
-            print(f"❌ 寫入失敗: {str(e)}")
-            traceback.print_exc()
+        except Exception:
+            logger.exception("❌ 寫入失敗")
             await self._reply_text(reply_token, "❌ 系統發生小錯誤，請稍後再試一次。")
 
 line_service = LineService()
\ No newline at end of file
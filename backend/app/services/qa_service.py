@@ -2,15 +2,20 @@
 Q&A 與公告管理服務
 處理 Q&A 內容的建立、編輯、發布等功能
 """
+import re
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 import asyncio
 from bson import ObjectId
+from pymongo import ReturnDocument
 from ..database import db
 from ..models.schemas import QACreate, AnnouncementCreate
 from .line_service import line_service  # 🔥 引入 line_service 準備做推播
 
 
+QA_LIST_PROJECTION = {"related_question_ids": 0}
+
+
 class QAService:
     """Q&A 管理服務類別"""
     
@@ -33,26 +38,28 @@ class QAService:
         
         collection = database[self.collection_name]
         
-        qa_dict = qa_data.model_dump()
+        # 同一筆文件的各時間欄位使用同一個時間點
+        now = datetime.utcnow()
         
         # =========== 🔥 處理限時互動時間計算 ===========
         expires_at = None
-        if qa_dict.get("allow_replies") and qa_dict.get("duration_minutes"):
-            expires_at = datetime.utcnow() + timedelta(minutes=qa_dict["duration_minutes"])
+        if qa_data.allow_replies and qa_data.duration_minutes:
+            expires_at = now + timedelta(minutes=qa_data.duration_minutes)
         # ==========================================
         
-        qa_doc = {
-            **qa_dict,
-            "expires_at": expires_at,
-            "created_by": created_by,
-            "related_question_ids": [],
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
+        # QACreate 欄位皆為基本型別且無別名，直接複製已驗證的欄位值，省去 model_dump 逐欄序列化
+        qa_doc = dict(qa_data.__dict__)
+        qa_doc.update(
+            expires_at=expires_at,
+            created_by=created_by,
+            related_question_ids=[],
+            created_at=now,
+            updated_at=now
+        )
         
         # 如果立即發布，設定發布時間
         if qa_data.is_published:
-            qa_doc["publish_date"] = datetime.utcnow()
+            qa_doc["publish_date"] = now
         
         result = await collection.insert_one(qa_doc)
         qa_doc["_id"] = str(result.inserted_id)
@@ -66,12 +73,16 @@ class QAService:
         
         return qa_doc
     
-    async def get_qa(self, qa_id: str) -> Optional[Dict[str, Any]]:
-        """取得單一 Q&A"""
+    async def get_qa(
+        self,
+        qa_id: str,
+        projection: Optional[Dict[str, Any]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """取得單一 Q&A (projection 供只需部分欄位的內部呼叫端使用)"""
         database = db.get_db()
         collection = database[self.collection_name]
         
-        qa = await collection.find_one({"_id": ObjectId(qa_id)})
+        qa = await collection.find_one({"_id": ObjectId(qa_id)}, projection)
         if qa:
             qa["_id"] = str(qa["_id"])
         return qa
@@ -115,7 +126,15 @@ class QAService:
         if is_published is not None:
             query["is_published"] = is_published
         
-        cursor = collection.find(query).skip(skip).limit(limit).sort("created_at", -1)
+        # 列表不需要關聯提問 ID 陣列，該陣列隨回覆累積變大，不隨每筆任務傳回；
+        # batch_size 設為 limit，整頁於第一批回傳 (伺服器預設首批僅 101 筆，較大的頁面須再 getMore)
+        cursor = (
+            collection.find(query, QA_LIST_PROJECTION)
+            .skip(skip)
+            .limit(limit)
+            .sort("created_at", -1)
+            .batch_size(limit)
+        )
         qas = await cursor.to_list(length=limit)
         
         for q in qas:
@@ -132,19 +151,21 @@ class QAService:
         database = db.get_db()
         collection = database[self.collection_name]
         
-        update_data["updated_at"] = datetime.utcnow()
+        now = datetime.utcnow()
+        update_data["updated_at"] = now
         
         if update_data.get("is_published") and not update_data.get("publish_date"):
-            update_data["publish_date"] = datetime.utcnow()
+            update_data["publish_date"] = now
         
-        result = await collection.update_one(
+        # updated_at 每次都會變更，有符合的文件即代表已更新，直接取回更新後的文件
+        qa = await collection.find_one_and_update(
             {"_id": ObjectId(qa_id)},
-            {"$set": update_data}
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
-        
-        if result.modified_count > 0:
-            return await self.get_qa(qa_id)
-        return None
+        if qa:
+            qa["_id"] = str(qa["_id"])
+        return qa
     
     async def link_questions_to_qa(
         self,
@@ -153,32 +174,39 @@ class QAService:
     ) -> Optional[Dict[str, Any]]:
         """將提問連結至 Q&A"""
         database = db.get_db()
+        now = datetime.utcnow()
         
         qa_collection = database[self.collection_name]
-        await qa_collection.update_one(
-            {"_id": ObjectId(qa_id)},
-            {
-                "$addToSet": {
-                    "related_question_ids": {"$each": question_ids}
-                },
-                "$set": {"updated_at": datetime.utcnow()}
-            }
-        )
-        
         question_collection = database["questions"]
         question_object_ids = [ObjectId(qid) for qid in question_ids]
-        await question_collection.update_many(
-            {"_id": {"$in": question_object_ids}},
-            {
-                "$set": {
-                    "merged_to_qa_id": qa_id,
-                    "is_merged": True,
-                    "updated_at": datetime.utcnow()
+        
+        # 兩筆寫入互不相依，同時送出；Q&A 以 find_one_and_update 直接取回更新後的文件，省去再查一次
+        qa, _ = await asyncio.gather(
+            qa_collection.find_one_and_update(
+                {"_id": ObjectId(qa_id)},
+                {
+                    "$addToSet": {
+                        "related_question_ids": {"$each": question_ids}
+                    },
+                    "$set": {"updated_at": now}
+                },
+                return_document=ReturnDocument.AFTER
+            ),
+            question_collection.update_many(
+                {"_id": {"$in": question_object_ids}},
+                {
+                    "$set": {
+                        "merged_to_qa_id": qa_id,
+                        "is_merged": True,
+                        "updated_at": now
+                    }
                 }
-            }
+            ),
         )
         
-        return await self.get_qa(qa_id)
+        if qa:
+            qa["_id"] = str(qa["_id"])
+        return qa
     
     async def delete_qa(self, qa_id: str) -> bool:
         """刪除 Q&A (硬刪除)"""
@@ -199,16 +227,26 @@ class QAService:
         database = db.get_db()
         collection = database[self.collection_name]
         
+        # 中文內容沒有空白可斷詞，$text 索引無法做子字串搜尋，仍以 regex 比對；
+        # 關鍵字先跳脫為字面比對，避免使用者輸入的特殊字元形成大量回溯的正規表示式
+        pattern = re.escape(keyword)
         query = {
             "course_id": course_id,
             "$or": [
-                {"question": {"$regex": keyword, "$options": "i"}},
-                {"answer": {"$regex": keyword, "$options": "i"}},
+                {"question": {"$regex": pattern, "$options": "i"}},
+                {"answer": {"$regex": pattern, "$options": "i"}},
                 {"tags": {"$in": [keyword]}}
             ]
         }
         
-        cursor = collection.find(query).skip(skip).limit(limit)
+        # 依 (course_id, created_at) 索引順序掃描，與列表相同排序，分頁結果穩定
+        cursor = (
+            collection.find(query, QA_LIST_PROJECTION)
+            .sort("created_at", -1)
+            .skip(skip)
+            .limit(limit)
+            .batch_size(limit)
+        )
         qas = await cursor.to_list(length=limit)
         
         for q in qas:
@@ -234,17 +272,18 @@ class AnnouncementService:
         database = db.get_db()
         collection = database[self.collection_name]
         
-        announcement_doc = {
-            **announcement_data.model_dump(),
-            "created_by": created_by,
-            "sent_to_line": False,
-            "line_message_id": None,
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
-        }
+        now = datetime.utcnow()
+        announcement_doc = dict(announcement_data.__dict__)
+        announcement_doc.update(
+            created_by=created_by,
+            sent_to_line=False,
+            line_message_id=None,
+            created_at=now,
+            updated_at=now
+        )
         
         if announcement_data.is_published:
-            announcement_doc["publish_date"] = datetime.utcnow()
+            announcement_doc["publish_date"] = now
             # 🔥 新增：標記將送出至 LINE
             announcement_doc["sent_to_line"] = True
         
@@ -294,7 +333,7 @@ class AnnouncementService:
         if is_published is not None:
             query["is_published"] = is_published
         
-        cursor = collection.find(query).skip(skip).limit(limit).sort("created_at", -1)
+        cursor = collection.find(query).skip(skip).limit(limit).sort("created_at", -1).batch_size(limit)
         announcements = await cursor.to_list(length=limit)
         
         for a in announcements:
@@ -310,37 +349,41 @@ class AnnouncementService:
         database = db.get_db()
         collection = database[self.collection_name]
         
-        # 先取得原本的狀態，用來比對是不是「剛剛才被改為發布」
-        old_announcement = await self.get_announcement(announcement_id)
-        if not old_announcement:
-            return None
-
-        update_data["updated_at"] = datetime.utcnow()
+        now = datetime.utcnow()
+        update_data["updated_at"] = now
+        object_id = ObjectId(announcement_id)
         
         # =========== 🔥 判斷是否為「草稿轉發布」 ===========
+        # 以「尚未發布」作為更新條件，比對與寫入在同一個操作內完成，重複送出的發布請求也只會推播一次
+        updated_doc = None
         is_newly_published = False
-        if update_data.get("is_published") and not old_announcement.get("is_published"):
-            update_data["publish_date"] = datetime.utcnow()
-            update_data["sent_to_line"] = True
-            is_newly_published = True
+        if update_data.get("is_published"):
+            updated_doc = await collection.find_one_and_update(
+                {"_id": object_id, "is_published": {"$ne": True}},
+                {"$set": {**update_data, "publish_date": now, "sent_to_line": True}},
+                return_document=ReturnDocument.AFTER
+            )
+            is_newly_published = updated_doc is not None
         # ===============================================
         
-        result = await collection.update_one(
-            {"_id": ObjectId(announcement_id)},
-            {"$set": update_data}
-        )
+        if updated_doc is None:
+            updated_doc = await collection.find_one_and_update(
+                {"_id": object_id},
+                {"$set": update_data},
+                return_document=ReturnDocument.AFTER
+            )
+            if updated_doc is None:
+                return None
+        
+        updated_doc["_id"] = str(updated_doc["_id"])
         
-        if result.modified_count > 0:
-            updated_doc = await self.get_announcement(announcement_id)
+        # 🔥 如果是從草稿改為發布，觸發推播
+        if is_newly_published:
+            asyncio.create_task(
+                line_service.broadcast_announcement_to_course(updated_doc["course_id"], updated_doc)
+            )
             
-            # 🔥 如果是從草稿改為發布，觸發推播
-            if is_newly_published and updated_doc:
-                asyncio.create_task(
-                    line_service.broadcast_announcement_to_course(updated_doc["course_id"], updated_doc)
-                )
-                
-            return updated_doc
-        return None
+        return updated_doc
     
     async def mark_sent_to_line(
         self,
@@ -2,15 +2,26 @@
 作答紀錄管理服務 (原提問管理)
 處理學生對 Q&A 任務的作答、去識別化、批閱狀態與 AI 分析結果更新
 """
-from typing import List, Optional, Dict, Any
-from datetime import datetime
+import asyncio
+import logging
+from typing import List, Optional, Dict, Any, Tuple
 from bson import ObjectId
 from fastapi import BackgroundTasks
-from ..database import db
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from ..config import settings
+from ..database import db, aggregate_options, QUESTIONS_CLUSTERING_INDEX
 from ..models.schemas import QuestionCreate, DifficultyLevel, AIAnalysisResult, ReviewStatus
 from ..utils.security import generate_pseudonym
+from ..utils.cache import invalidate_course_reports
+from ..utils.datetime_helper import utc_now_naive
 from .course_service import course_service
 
+logger = logging.getLogger(__name__)
+
+# 批量退回時同時進行的 LINE 推播數上限
+REJECTION_NOTIFY_CONCURRENCY = 8
+
 
 class QuestionService:
     """作答紀錄管理服務類別"""
@@ -18,50 +29,61 @@ class QuestionService:
     def __init__(self):
         # 為了相容舊資料與結構，資料表名稱維持 "questions"
         self.collection_name = "questions"
+        # 作答寫入的合併批次：前一批寫入期間排入的作答併成下一次 insert_many
+        self._insert_queue: Optional[asyncio.Queue] = None
+        self._insert_worker: Optional[asyncio.Task] = None
+
+    async def aclose(self) -> None:
+        """寫完已排入的作答後停止寫入 worker（應用程式關閉時呼叫）"""
+        worker = self._insert_worker
+        if worker is not None and not worker.done() and worker.get_loop() is asyncio.get_running_loop():
+            # 以 None 通知 worker 寫完佇列中的作答後結束
+            self._insert_queue.put_nowait(None)
+            await worker
+        self._insert_worker = None
+        self._insert_queue = None
     
     async def create_question(self, question_data: QuestionCreate, background_tasks: Optional[BackgroundTasks] = None) -> Dict[str, Any]:
         """
         建立新提問/作答紀錄 (從 Line Bot 接收)
         """
-        # 1. 驗證課程是否存在與啟用
-        course = await course_service.get_course(question_data.course_id)
-        if not course or not course.get("is_active", False):
-            raise ValueError(f"課程不存在或已停用: {question_data.course_id}")
-        
         database = db.get_db()
         collection = database[self.collection_name]
+        qa_id = getattr(question_data, 'reply_to_qa_id', None)
+
+        # 1. 驗證課程是否存在與啟用；作答次數上限的設定與課程互不相依，同時查詢以縮短 LINE 回覆前的等待
+        if qa_id:
+            course_active, max_attempts = await asyncio.gather(
+                course_service.is_course_active(question_data.course_id),
+                self._get_max_attempts(database, qa_id)
+            )
+        else:
+            course_active, max_attempts = await course_service.is_course_active(question_data.course_id), None
+        if not course_active:
+            raise ValueError(f"課程不存在或已停用: {question_data.course_id}")
         
         # 2. 去識別化處理
         pseudonym = generate_pseudonym(question_data.line_user_id)
         
         # =========== 🔥 作答次數限制檢查 ===========
-        qa_id = getattr(question_data, 'reply_to_qa_id', None)
-        if qa_id:
+        # 如果老師有設定次數限制 (大於 0)
+        if max_attempts is not None and max_attempts > 0:
             try:
-                # 撈取這題 Q&A 的設定
-                qa_doc = await database["qas"].find_one({"_id": ObjectId(qa_id)})
-                if qa_doc:
-                    max_attempts = qa_doc.get("max_attempts")
-                    
-                    # 如果老師有設定次數限制 (大於 0)
-                    if max_attempts is not None and max_attempts > 0:
-                        # 查詢該學生 (pseudonym) 在這題已作答的次數（不計退回的）
-                        existing_count = await collection.count_documents({
-                            "reply_to_qa_id": qa_id,
-                            "pseudonym": pseudonym,
-                            "review_status": {"$ne": "rejected"}
-                        })
-                        
-                        if existing_count >= max_attempts:
-                            raise ValueError(f"您已達到本題的最高作答次數上限 ({max_attempts} 次)！")
+                # 查詢該學生 (pseudonym) 在這題已作答的次數（不計退回的）
+                existing_count = await collection.count_documents({
+                    "reply_to_qa_id": qa_id,
+                    "pseudonym": pseudonym,
+                    "review_status": {"$ne": "rejected"}
+                })
             except Exception as e:
-                # 確保我們自定義的 ValueError 能順利往外拋
-                if isinstance(e, ValueError):
-                    raise e
-                print(f"檢查作答次數時發生錯誤: {e}")
+                logger.error("檢查作答次數時發生錯誤: %s", e)
+            else:
+                if existing_count >= max_attempts:
+                    raise ValueError(f"您已達到本題的最高作答次數上限 ({max_attempts} 次)！")
         # ===============================================
 
         # 3. 建立乾淨的作答紀錄文件
+        now = utc_now_naive()
         question_doc = {
             "course_id": question_data.course_id,
             "class_id": getattr(question_data, 'class_id', None), 
@@ -83,15 +105,80 @@ class QuestionService:
             "source": "LINE",  
             "original_message_id": getattr(question_data, 'original_message_id', None),
             "reply_to_qa_id": getattr(question_data, 'reply_to_qa_id', None),
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow()
+            "created_at": now,
+            "updated_at": now
         }
         
-        result = await collection.insert_one(question_doc)
-        question_doc["_id"] = str(result.inserted_id)
+        question_doc["_id"] = str(await self._enqueue_insert(question_doc))
+        invalidate_course_reports(question_data.course_id)
 
         return question_doc
 
+    # ── 作答寫入合併批次 ─────────────────────────────────────
+
+    async def _enqueue_insert(self, question_doc: Dict[str, Any]) -> ObjectId:
+        """將作答排入寫入批次，等待寫入完成後回傳 inserted _id"""
+        worker = self._insert_worker
+        if worker is None or worker.done() or worker.get_loop() is not asyncio.get_running_loop():
+            self._insert_queue = asyncio.Queue()
+            self._insert_worker = asyncio.create_task(self._run_insert_worker(self._insert_queue))
+        future = asyncio.get_running_loop().create_future()
+        self._insert_queue.put_nowait((question_doc, future))
+        return await future
+
+    async def _run_insert_worker(self, queue: asyncio.Queue) -> None:
+        """
+        依序寫入作答批次：每批取出佇列中已排入的作答 (最多 QUESTION_INSERT_BATCH_SIZE 筆)
+
+        不等待時間窗，零星作答立即寫入；尖峰時前一批寫入期間累積的作答併成下一次 insert_many
+        """
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            batch = [item]
+            closing = False
+            while len(batch) < settings.QUESTION_INSERT_BATCH_SIZE and not queue.empty():
+                item = queue.get_nowait()
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            await self._insert_batch(batch)
+            if closing:
+                return
+
+    async def _insert_batch(self, batch: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        """以 insert_many 寫入一批作答，逐筆回報各自的結果"""
+        # 在客戶端預先配置 _id：不依賴 insert_many 回填，失敗的單筆也能以 _id 對應
+        docs = [doc for doc, _ in batch]
+        for doc in docs:
+            doc.setdefault("_id", ObjectId())
+        errors: Dict[int, Exception] = {}
+        try:
+            await db.get_db()[self.collection_name].insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for err in e.details.get("writeErrors", []):
+                errors[err["index"]] = RuntimeError(err.get("errmsg", "寫入作答失敗"))
+        except Exception as e:
+            errors = {i: e for i in range(len(batch))}
+        for i, (doc, future) in enumerate(batch):
+            if future.done():
+                continue
+            if i in errors:
+                future.set_exception(errors[i])
+            else:
+                future.set_result(doc["_id"])
+
+    async def _get_max_attempts(self, database, qa_id: str) -> Optional[int]:
+        """取得 Q&A 的作答次數上限；查詢失敗時記錄錯誤並視為不限制"""
+        try:
+            qa_doc = await database["qas"].find_one({"_id": ObjectId(qa_id)}, {"max_attempts": 1})
+        except Exception as e:
+            logger.error("檢查作答次數時發生錯誤: %s", e)
+            return None
+        return qa_doc.get("max_attempts") if qa_doc else None
+
     async def get_question(self, question_id: str) -> Optional[Dict[str, Any]]:
         """取得單一作答紀錄"""
         database = db.get_db()
@@ -121,12 +208,8 @@ class QuestionService:
             query["class_id"] = class_id
         
         cursor = collection.find(query).skip(skip).limit(limit).sort("created_at", -1)
-        questions = await cursor.to_list(length=limit)
-        
-        for q in questions:
-            q["_id"] = str(q["_id"])
-        
-        return questions
+        # _id 保留 ObjectId，由路由的 MongoJSONResponse 於序列化時轉為字串
+        return await cursor.to_list(length=limit)
     
     async def update_review_status(
         self,
@@ -140,43 +223,48 @@ class QuestionService:
         
         update_data = {
             "review_status": review_status,
-            "updated_at": datetime.utcnow()
+            "updated_at": utc_now_naive()
         }
         
         if feedback is not None:
             update_data["feedback"] = feedback
             
-        result = await collection.update_one(
+        # 更新並直接取回更新後的作答，不再另外查詢
+        question = await collection.find_one_and_update(
             {"_id": ObjectId(question_id)},
-            {"$set": update_data}
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
-        
-        question = await self.get_question(question_id)
+        if question:
+            question["_id"] = str(question["_id"])
+            invalidate_course_reports(question.get("course_id"))
 
         # 退回時透過 LINE 通知學生可重新作答
         if question and review_status == ReviewStatus.REJECTED:
-            await self._notify_rejection(question, feedback)
+            await self.notify_rejections([question], feedback)
 
         return question
 
-    async def _notify_rejection(self, question: Dict[str, Any], feedback: Optional[str] = None):
-        """透過 LINE 推播通知學生作答被退回，可重新作答"""
-        from ..config import settings
+    async def notify_rejections(self, questions: List[Dict[str, Any]], feedback: Optional[str] = None):
+        """
+        透過 LINE 推播通知學生作答被退回，可重新作答
+        
+        所有學生的 LINE user_id 以一次 $in 查詢反查，推播共用 line_service 的連線池並限制同時送出的數量；
+        單一學生推播失敗只記錄警告，不影響其他學生
+        """
         if not settings.LINE_CHANNEL_ACCESS_TOKEN:
             return
 
-        # 需要找到學生的 LINE user_id（從 pseudonym 反查 line_users）
-        database = db.get_db()
-        pseudonym = question.get("pseudonym")
-        if not pseudonym:
-            return
-
-        # 從 line_messages 找到該 pseudonym 對應的 user_id
-        msg_doc = await database["line_messages"].find_one({"pseudonym": pseudonym})
-        if not msg_doc or not msg_doc.get("user_id"):
+        pseudonyms = list({q["pseudonym"] for q in questions if q.get("pseudonym")})
+        if not pseudonyms:
             return
 
-        user_id = msg_doc["user_id"]
+        # 需要找到學生的 LINE user_id（從 line_messages 以 pseudonym 反查）
+        cursor = db.get_db()["line_messages"].aggregate([
+            {"$match": {"pseudonym": {"$in": pseudonyms}, "user_id": {"$type": "string"}}},
+            {"$group": {"_id": "$pseudonym", "user_id": {"$first": "$user_id"}}},
+        ], **aggregate_options())
+        user_ids = {doc["user_id"] async for doc in cursor}
 
         feedback_text = f"\n\n💬 老師的評語：{feedback}" if feedback else ""
         text = (
@@ -184,19 +272,17 @@ class QuestionService:
             f"🔄 請直接在此重新輸入您的答案即可。"
         )
 
-        try:
-            from linebot.v3.messaging import (
-                Configuration, AsyncApiClient, AsyncMessagingApi,
-                PushMessageRequest, TextMessage,
-            )
-            configuration = Configuration(access_token=settings.LINE_CHANNEL_ACCESS_TOKEN)
-            async with AsyncApiClient(configuration) as api_client:
-                line_bot_api = AsyncMessagingApi(api_client)
-                await line_bot_api.push_message(
-                    PushMessageRequest(to=user_id, messages=[TextMessage(text=text)])
-                )
-        except Exception as e:
-            print(f"⚠️ 退回通知發送失敗: {e}")
+        from .line_service import line_service
+        semaphore = asyncio.Semaphore(REJECTION_NOTIFY_CONCURRENCY)
+
+        async def push(user_id: str):
+            async with semaphore:
+                try:
+                    await line_service.push_text(user_id, text)
+                except Exception as e:
+                    logger.warning("⚠️ 退回通知發送失敗 (user_id=%s): %s", user_id, e)
+
+        await asyncio.gather(*(push(user_id) for user_id in user_ids))
 
     async def update_ai_analysis(
         self,
@@ -224,17 +310,19 @@ class QuestionService:
             "ai_response_draft": getattr(analysis_result, "response_draft", None),
             "ai_summary": getattr(analysis_result, "summary", None),
             "sentiment_score": getattr(analysis_result, "sentiment_score", None),
-            "updated_at": datetime.utcnow()
+            "updated_at": utc_now_naive()
         }
         
-        result = await collection.update_one(
+        # updated_at 每次都會變更，有符合的文件即代表已更新
+        question = await collection.find_one_and_update(
             {"_id": ObjectId(question_id)},
-            {"$set": update_data}
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER
         )
-        
-        if result.modified_count > 0:
-            return await self.get_question(question_id)
-        return None
+        if question:
+            question["_id"] = str(question["_id"])
+            invalidate_course_reports(question.get("course_id"))
+        return question
     
     async def get_questions_by_cluster(
         self,
@@ -249,12 +337,8 @@ class QuestionService:
             "course_id": course_id,
             "cluster_id": cluster_id
         })
-        questions = await cursor.to_list(length=None)
-        
-        for q in questions:
-            q["_id"] = str(q["_id"])
-        
-        return questions
+        # _id 保留 ObjectId，由路由的 MongoJSONResponse 於序列化時轉為字串
+        return await cursor.to_list(length=None)
 
     async def reset_clusters_for_qa(self, qa_id: str) -> int:
         """
@@ -268,7 +352,7 @@ class QuestionService:
             {"reply_to_qa_id": qa_id},
             {"$set": {
                 "cluster_id": None,
-                "updated_at": datetime.utcnow()
+                "updated_at": utc_now_naive()
             }}
         )
         return result.modified_count
@@ -282,11 +366,15 @@ class QuestionService:
         database = db.get_db()
         collection = database[self.collection_name]
 
-        cursor = collection.find({
-            "reply_to_qa_id": qa_id,
-            "cluster_id": None,
-            "review_status": ReviewStatus.APPROVED
-        }).limit(limit)
+        # 只取送給 AI 的欄位，其餘欄位 (批閱回饋、AI 分析結果等) 不隨每筆作答傳回
+        cursor = collection.find(
+            {
+                "reply_to_qa_id": qa_id,
+                "cluster_id": None,
+                "review_status": ReviewStatus.APPROVED
+            },
+            {"pseudonym": 1, "question_text": 1, "created_at": 1}
+        ).hint(QUESTIONS_CLUSTERING_INDEX).limit(limit)
         
         replies = await cursor.to_list(length=limit)
         
@@ -307,6 +395,8 @@ class QuestionService:
         collection = database[self.collection_name]
         
         result = await collection.delete_one({"_id": ObjectId(question_id)})
+        if result.deleted_count > 0:
+            invalidate_course_reports()
         return result.deleted_count > 0
 
 
@@ -0,0 +1,90 @@
+"""
+非同步 TTL 快取工具
+提供短時效的行程內快取，合併儀表板短時間內的重複輪詢請求
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from cachetools import TTLCache
+
+
+class AsyncTTLCache:
+    """以 cachetools.TTLCache 為底的非同步快取，每個 key 各自持有一把鎖避免同時回源"""
+
+    def __init__(self, maxsize: int = 128, ttl: float = 10):
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # 只保留正在回源的 key 的鎖，最後一個等待者離開時移除，不隨歷來的 key 數量成長
+        self._locks: Dict[Hashable, asyncio.Lock] = {}
+        self._lock_users: Dict[Hashable, int] = {}
+
+    async def get_or_set(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        取得快取值，未命中時呼叫 factory 產生並寫入快取
+
+        Args:
+            key: 快取鍵，例如 ("line_stats", course_id)
+            factory: 無參數的協程工廠函式
+
+        Returns:
+            快取值或 factory 的結果
+        """
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._lock_users[key] = self._lock_users.get(key, 0) + 1
+        try:
+            async with lock:
+                # 等待鎖期間可能已有其他請求完成回源
+                try:
+                    return self._cache[key]
+                except KeyError:
+                    pass
+                value = await factory()
+                self._cache[key] = value
+                return value
+        finally:
+            remaining = self._lock_users[key] - 1
+            if remaining:
+                self._lock_users[key] = remaining
+            else:
+                del self._lock_users[key]
+                del self._locks[key]
+
+    def invalidate(self, key: Hashable) -> None:
+        """移除單一快取鍵"""
+        self._cache.pop(key, None)
+
+    def invalidate_prefix(self, prefix: str, *parts: Hashable) -> None:
+        """移除所有以指定名稱 (及其後的鍵值，如 course_id) 開頭的 tuple 快取鍵"""
+        head = (prefix, *parts)
+        for key in list(self._cache.keys()):
+            if isinstance(key, tuple) and key[:len(head)] == head:
+                self._cache.pop(key, None)
+
+    def clear(self) -> None:
+        """清空快取"""
+        self._cache.clear()
+
+
+# 報表統計快取 (課程統計摘要、熱門主題摘要、統計與聚類 CSV)，鍵為 (報表名稱, course_id, 其他篩選條件...)
+REPORT_CACHE_PREFIXES = ("statistics", "clusters_summary", "statistics_csv", "clusters_csv")
+report_cache = AsyncTTLCache(maxsize=1024, ttl=15)
+
+
+def invalidate_course_reports(course_id: Optional[str] = None) -> None:
+    """
+    作答或聚類資料異動後清除報表快取
+
+    Args:
+        course_id: 課程 ID；無法得知課程時傳入 None 清除所有課程的報表快取
+    """
+    for prefix in REPORT_CACHE_PREFIXES:
+        if course_id is None:
+            report_cache.invalidate_prefix(prefix)
+        else:
+            report_cache.invalidate_prefix(prefix, course_id)
@@ -1,7 +1,7 @@
 """
 日期時間處理工具
 """
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from typing import Any, Dict, Optional
 
 
@@ -10,6 +10,11 @@ def utc_now() -> datetime:
     return datetime.now(timezone.utc)
 
 
+def utc_now_naive() -> datetime:
+    """取得當前 UTC 時間 (不含時區，與資料庫既有欄位格式一致)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def to_taiwan_time(dt: datetime) -> datetime:
     """轉換為台灣時間 (UTC+8)"""
     from datetime import timedelta
@@ -37,15 +42,20 @@ def build_date_range_query(
     end_date: Optional[datetime] = None,
     field_name: str = "created_at"
 ) -> Dict[str, Any]:
-    """建構 MongoDB 日期區間查詢條件"""
+    """
+    建構 MongoDB 日期區間查詢條件
+
+    結束日期轉為隔日零時的半開區間 [start, end + 1 天)，
+    與 (course_id, created_at) 複合索引的範圍掃描邊界一致
+    """
     if not start_date and not end_date:
         return {}
     date_filter = {}
     if start_date:
         date_filter["$gte"] = start_date
     if end_date:
-        adjusted_end = end_date.replace(hour=23, minute=59, second=59, microsecond=999999)
-        date_filter["$lte"] = adjusted_end
+        end_of_range = end_date.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        date_filter["$lt"] = end_of_range
     if date_filter:
         return {field_name: date_filter}
     return {}
@@ -0,0 +1,53 @@
+"""
+日誌設定模組
+以 QueueHandler 將日誌寫入佇列，由背景執行緒的 QueueListener 負責格式化與輸出，
+避免 webhook 等熱路徑在事件迴圈中直接阻塞於 stdout
+"""
+import logging
+import logging.handlers
+import queue
+from typing import Optional
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(level: str = "INFO") -> logging.handlers.QueueListener:
+    """
+    設定 root logger 使用佇列輸出並啟動背景 listener
+
+    Args:
+        level: 日誌等級名稱，例如 "DEBUG"、"INFO"
+
+    Returns:
+        已啟動的 QueueListener
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s")
+    )
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """停止背景 listener 並寫出佇列中剩餘的日誌"""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            root.removeHandler(handler)
+    _listener = None
@@ -0,0 +1,27 @@
+"""
+JSON 回應工具
+以 orjson 序列化回應，並直接處理 MongoDB 的 ObjectId
+"""
+from typing import Any
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+
+
+def _default(obj: Any) -> Any:
+    """orjson 無法原生序列化的型別 (ObjectId) 轉為字串"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class MongoJSONResponse(JSONResponse):
+    """可直接回傳含 ObjectId 文件的 orjson 回應，不需逐筆轉換 _id"""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
@@ -3,16 +3,24 @@
 包含密碼加密、JWT token 生成、去識別化等功能
 """
 import hashlib
+import re
+from functools import lru_cache
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
 from passlib.context import CryptContext
-from jose import JWTError, jwt
+from jose import JWTError, jwk, jwt
 from ..config import settings
 
 
 # 密碼加密上下文
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# pseudonym 格式：完整 SHA256 (64 字元) 或短版 (16 字元) 的十六進位字串
+_PSEUDONYM_RE = re.compile(r"[0-9a-fA-F]{16}|[0-9a-fA-F]{64}")
+
+# LINE User ID 遮罩後綴
+_MASK_SUFFIX = '***'
+
 
 # ==================== 密碼處理 ====================
 
@@ -28,6 +36,16 @@ def get_password_hash(password: str) -> str:
 
 # ==================== JWT Token ====================
 
+@lru_cache(maxsize=4)
+def _jwt_key(secret: str, algorithm: str):
+    """
+    建立 JWT 簽章金鑰物件 (依密鑰與演算法快取)
+
+    直接傳入字串時 python-jose 每次簽章都重建金鑰，驗證時還會先嘗試以 JSON 解析密鑰
+    """
+    return jwk.construct(secret, algorithm)
+
+
 def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
     """
     建立 JWT access token
@@ -51,7 +69,7 @@ def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta]
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(
         to_encode,
-        settings.JWT_SECRET_KEY,
+        _jwt_key(settings.JWT_SECRET_KEY, settings.JWT_ALGORITHM),
         algorithm=settings.JWT_ALGORITHM
     )
     return encoded_jwt
@@ -70,7 +88,7 @@ def decode_access_token(token: str) -> Optional[Dict[str, Any]]:
     try:
         payload = jwt.decode(
             token,
-            settings.JWT_SECRET_KEY,
+            _jwt_key(settings.JWT_SECRET_KEY, settings.JWT_ALGORITHM),
             algorithms=[settings.JWT_ALGORITHM]
         )
         return payload
@@ -101,13 +119,22 @@ def generate_pseudonym(line_user_id: str, salt: Optional[str] = None) -> str:
     if salt is None:
         salt = settings.PSEUDONYM_SALT
     
+    return _hash_pseudonym(line_user_id, salt)
+
+
+@lru_cache(maxsize=8192)
+def _hash_pseudonym(line_user_id: str, salt: str) -> str:
+    """
+    計算 SHA256(line_user_id + salt)
+
+    同一位學生的每則訊息都會重算代號 (LINE 事件與作答寫入各一次)，
+    以 (line_user_id, salt) 為鍵快取結果，重複的使用者直接取用
+    """
     # 組合 line_user_id 和 salt
     data_to_hash = f"{line_user_id}{salt}"
     
     # 使用 SHA256 進行雜湊
-    pseudonym = hashlib.sha256(data_to_hash.encode('utf-8')).hexdigest()
-    
-    return pseudonym
+    return hashlib.sha256(data_to_hash.encode('utf-8')).hexdigest()
 
 
 def generate_short_pseudonym(line_user_id: str, length: int = 16) -> str:
@@ -137,16 +164,9 @@ def validate_pseudonym(pseudonym: str) -> bool:
     Returns:
         是否為有效的 pseudonym
     """
-    # SHA256 雜湊值長度為 64 個十六進位字元
-    if len(pseudonym) not in [16, 64]:
-        return False
-    
-    # 檢查是否只包含十六進位字元
-    try:
-        int(pseudonym, 16)
-        return True
-    except ValueError:
-        return False
+    # 以預先編譯的正規表示式比對長度與十六進位字元，不需轉成整數
+    # (int(x, 16) 也會接受 "+"、"_" 與 "0x" 前綴等非雜湊字元)
+    return _PSEUDONYM_RE.fullmatch(pseudonym) is not None
 
 
 # ==================== 資料遮罩 ====================
@@ -161,13 +181,11 @@ def mask_email(email: str) -> str:
     if '@' not in email:
         return email
     
-    local, domain = email.split('@', 1)
-    if len(local) <= 2:
-        masked_local = local[0] + '*'
-    else:
-        masked_local = local[0] + '*' * (len(local) - 1)
+    local, _, domain = email.partition('@')
+    if not local:
+        return email
     
-    return f"{masked_local}@{domain}"
+    return f"{local[0]}{'*' * max(len(local) - 1, 1)}@{domain}"
 
 
 def mask_line_user_id(line_user_id: str, visible_chars: int = 4) -> str:
@@ -180,5 +198,5 @@ def mask_line_user_id(line_user_id: str, visible_chars: int = 4) -> str:
     if len(line_user_id) <= visible_chars:
         return line_user_id
     
-    return line_user_id[:visible_chars] + '***'
+    return f"{line_user_id[:visible_chars]}{_MASK_SUFFIX}"
 
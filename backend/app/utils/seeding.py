@@ -0,0 +1,39 @@
+"""
+種子資料寫入工具
+供測試資料腳本共用的分批無序寫入設定與輔助函式
+"""
+import asyncio
+
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
+
+# 大量種子資料分批寫入：每批文件數與同時進行的批次數
+SEED_CHUNK_SIZE = 1000
+SEED_CONCURRENCY = 4
+# 測試資料可隨時重建：只等主節點確認、不等日誌落盤；仍保留確認以回報單筆寫入錯誤
+SEED_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+
+async def insert_unordered(collection, docs, label):
+    """
+    分批無序寫入並回傳成功筆數
+    每批最多 SEED_CHUNK_SIZE 筆、最多 SEED_CONCURRENCY 批同時寫入；單筆失敗不中斷其餘文件，並逐筆列出失敗原因
+    """
+    collection = collection.with_options(write_concern=SEED_WRITE_CONCERN)
+    semaphore = asyncio.Semaphore(SEED_CONCURRENCY)
+
+    async def push(offset, chunk):
+        async with semaphore:
+            try:
+                result = await collection.insert_many(chunk, ordered=False)
+                return len(result.inserted_ids)
+            except BulkWriteError as e:
+                for err in e.details.get("writeErrors", []):
+                    print(f"⚠️  {label}第 {offset + err['index']} 筆寫入失敗：{err.get('errmsg')}")
+                return e.details.get("nInserted", 0)
+
+    counts = await asyncio.gather(*(
+        push(offset, docs[offset:offset + SEED_CHUNK_SIZE])
+        for offset in range(0, len(docs), SEED_CHUNK_SIZE)
+    ))
+    return sum(counts)
@@ -22,15 +22,18 @@ async def check():
         
         print(f"🔍 檢查課程 ID: {COURSE_ID}")
 
-        # 1. 檢查 Questions (提問)
         # 注意：這邊我們同時檢查 String 格式和 ObjectId 格式的 course_id，以防萬一
-        questions = await database["questions"].find({
-            "$or": [
-                {"course_id": COURSE_ID},
-                {"course_id": ObjectId(COURSE_ID)}
-            ]
-        }).to_list(None)
-        
+        course_filter = {"course_id": {"$in": [COURSE_ID, ObjectId(COURSE_ID)]}}
+
+        # 提問與主題的查詢互不相依，同時送出
+        questions, clusters = await asyncio.gather(
+            database["questions"].find(
+                course_filter, {"question_text": 1, "status": 1, "cluster_id": 1}
+            ).to_list(None),
+            database["clusters"].find(course_filter).to_list(None),
+        )
+
+        # 1. 檢查 Questions (提問)
         print(f"👉 找到 {len(questions)} 個問題")
         
         clustered_count = 0
@@ -44,13 +47,6 @@ async def check():
         print(f"📊 統計: 共 {clustered_count} 個問題有 cluster_id")
 
         # 2. 檢查 Clusters (聚類主題)
-        clusters = await database["clusters"].find({
-            "$or": [
-                {"course_id": COURSE_ID},
-                {"course_id": ObjectId(COURSE_ID)}
-            ]
-        }).to_list(None)
-        
         print(f"👉 找到 {len(clusters)} 個主題 (Clusters)")
         for c in clusters:
             print(f"   - 主題名稱: {c.get('topic_label')}")
@@ -28,8 +28,47 @@ async def check_line_data():
         database = db.get_db()
         messages_collection = database["line_messages"]
         
+        # 以單一 $facet 聚合取得所有統計，只需一次資料庫往返
+        now = datetime.utcnow()
+        today_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        yesterday_start = today_start - timedelta(days=1)
+        week_start = now - timedelta(days=7)
+        
+        def count_if(condition):
+            return {"$sum": {"$cond": [condition, 1, 0]}}
+        
+        pipeline = [{"$facet": {
+            "by_direction": [
+                {"$group": {"_id": "$direction", "n": {"$sum": 1}}}
+            ],
+            "by_time": [
+                {"$group": {
+                    "_id": None,
+                    "today": count_if({"$gte": ["$created_at", today_start]}),
+                    "yesterday": count_if({"$and": [
+                        {"$gte": ["$created_at", yesterday_start]},
+                        {"$lt": ["$created_at", today_start]}
+                    ]}),
+                    "week": count_if({"$gte": ["$created_at", week_start]})
+                }}
+            ],
+            "users": [
+                {"$group": {"_id": "$user_id", "n": {"$sum": 1}, "pseudonym": {"$first": "$pseudonym"}}},
+                {"$sort": {"_id": 1}}
+            ],
+            "latest": [
+                {"$sort": {"created_at": -1}},
+                {"$limit": 5}
+            ]
+        }}]
+        stats = (await messages_collection.aggregate(pipeline).to_list(1))[0]
+        
+        direction_counts = {row["_id"]: row["n"] for row in stats["by_direction"]}
+        time_counts = stats["by_time"][0] if stats["by_time"] else {}
+        users = stats["users"]
+        
         # 統計總數
-        total_count = await messages_collection.count_documents({})
+        total_count = sum(direction_counts.values())
         print(f"\n📊 總訊息數：{total_count}")
         
         if total_count == 0:
@@ -43,21 +82,21 @@ async def check_line_data():
             return
         
         # 統計訊息方向
-        received_count = await messages_collection.count_documents({"direction": "received"})
-        sent_count = await messages_collection.count_documents({"direction": "sent"})
-        failed_count = await messages_collection.count_documents({"direction": "failed"})
+        received_count = direction_counts.get("received", 0)
+        sent_count = direction_counts.get("sent", 0)
+        failed_count = direction_counts.get("failed", 0)
         
         print(f"  • 收到的訊息：{received_count}")
         print(f"  • 發送的訊息：{sent_count}")
         print(f"  • 失敗的訊息：{failed_count}")
         
         # 統計唯一使用者
-        unique_users = await messages_collection.distinct("user_id")
+        unique_users = [user["_id"] for user in users]
         print(f"\n👥 唯一使用者數：{len(unique_users)}")
         
         # 檢查是否為測試資料
         test_user_pattern = "U00000000000000000000000000000"
-        test_users = [uid for uid in unique_users if uid.startswith(test_user_pattern)]
+        test_users = [uid for uid in unique_users if uid and uid.startswith(test_user_pattern)]
         
         if test_users:
             print(f"\n⚠️  偵測到 {len(test_users)} 個測試使用者")
@@ -71,7 +110,7 @@ async def check_line_data():
         print("\n📝 最新 5 則訊息：")
         print("-" * 60)
         
-        async for msg in messages_collection.find().sort("created_at", -1).limit(5):
+        for msg in stats["latest"]:
             created_at = msg.get('created_at')
             if isinstance(created_at, datetime):
                 time_str = created_at.strftime("%Y-%m-%d %H:%M:%S")
@@ -93,21 +132,9 @@ async def check_line_data():
         print("-" * 60)
         print("\n📅 訊息時間分佈：")
         
-        now = datetime.utcnow()
-        today_count = await messages_collection.count_documents({
-            "created_at": {"$gte": now.replace(hour=0, minute=0, second=0, microsecond=0)}
-        })
-        
-        yesterday_start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        yesterday_end = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        yesterday_count = await messages_collection.count_documents({
-            "created_at": {"$gte": yesterday_start, "$lt": yesterday_end}
-        })
-        
-        week_start = now - timedelta(days=7)
-        week_count = await messages_collection.count_documents({
-            "created_at": {"$gte": week_start}
-        })
+        today_count = time_counts.get("today", 0)
+        yesterday_count = time_counts.get("yesterday", 0)
+        week_count = time_counts.get("week", 0)
         
         print(f"  • 今天：{today_count} 則")
         print(f"  • 昨天：{yesterday_count} 則")
@@ -144,11 +171,9 @@ async def check_line_data():
         # 顯示使用者列表
         if len(unique_users) <= 10:
             print(f"\n👥 使用者列表：")
-            for user_id in unique_users:
-                user_msg_count = await messages_collection.count_documents({"user_id": user_id})
-                pseudonym = await messages_collection.find_one({"user_id": user_id})
-                pseudonym_str = pseudonym.get('pseudonym', 'N/A') if pseudonym else 'N/A'
-                print(f"  • {pseudonym_str}：{user_msg_count} 則訊息")
+            for user in users:
+                pseudonym_str = user.get('pseudonym') or 'N/A'
+                print(f"  • {pseudonym_str}：{user['n']} 則訊息")
     
     finally:
         # 關閉資料庫連線
@@ -11,7 +11,7 @@ import os
 # 添加 app 目錄到路徑
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
 
-from app.database import db
+from app.database import db, LINE_MESSAGES_INDEXES
 
 
 async def clear_test_data():
@@ -28,8 +28,8 @@ async def clear_test_data():
         database = db.get_db()
         messages_collection = database["line_messages"]
         
-        # 顯示目前的資料統計
-        total_count = await messages_collection.count_documents({})
+        # 顯示目前的資料統計 (不帶條件的總數直接讀取集合中繼資料，不掃描文件)
+        total_count = await messages_collection.estimated_document_count()
         print(f"\n目前資料庫中有 {total_count} 筆 LINE 訊息")
         
         if total_count == 0:
@@ -47,8 +47,11 @@ async def clear_test_data():
         
         if choice == "1":
             print("\n開始清除資料...")
-            result = await messages_collection.delete_many({})
-            print(f"✅ 成功刪除 {result.deleted_count} 筆資料")
+            # 清除整個集合：drop 只需更新中繼資料，不必逐筆刪除文件與索引項目；之後重建索引
+            await messages_collection.drop()
+            for keys in LINE_MESSAGES_INDEXES:
+                await messages_collection.create_index(keys)
+            print(f"✅ 成功刪除 {total_count} 筆資料")
             print("\n現在您可以接收真實的 LINE Bot 訊息了。")
             print("請確保：")
             print("  1. ngrok 正在運行")
@@ -3,17 +3,19 @@
 用於測試統計功能
 """
 import asyncio
-from datetime import datetime, timedelta
+from datetime import timedelta
 import random
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 from app.database import db
 from app.models.schemas import QuestionStatus, DifficultyLevel
 from app.utils.security import generate_pseudonym
+from app.utils.datetime_helper import utc_now_naive
+from app.utils.seeding import insert_unordered, SEED_WRITE_CONCERN
+
 
 async def create_test_data():
     """建立測試資料"""
-    
-    # 連接資料庫
-    await db.connect_db()
     database = db.get_db()
     
     # 清除現有測試資料（可選）
@@ -22,21 +24,24 @@ async def create_test_data():
     # await database["questions"].delete_many({})
     # await database["qas"].delete_many({})
     
+    # 整個腳本共用同一個時間基準
+    now = utc_now_naive()
+    
     # 建立測試課程
     print("建立測試課程...")
+    # 在客戶端預先產生課程 _id，提問與 Q&A 可直接引用
+    course_oid = ObjectId()
+    course_id = str(course_oid)
     course_data = {
+        "_id": course_oid,
         "course_code": "CS101",
         "course_name": "Python 基礎程式設計",
         "semester": "113-1",
         "description": "Python 程式設計入門課程",
         "is_active": True,
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
     
-    result = await database["courses"].insert_one(course_data)
-    course_id = str(result.inserted_id)
-    print(f"課程建立成功，ID: {course_id}")
-    
     # 建立測試提問
     print("建立測試提問...")
     questions_data = []
@@ -86,24 +91,27 @@ async def create_test_data():
         ["套件", "import", "安裝"],
     ]
     
-    # 建立 50 個測試提問
-    for i in range(50):
-        question_text = random.choice(question_templates)
-        status = random.choice(statuses)
-        difficulty_score, difficulty_level = random.choice(difficulties)
-        keywords = random.choice(keywords_pool)
-        
-        # 生成偽名
-        pseudonym = generate_pseudonym(f"test_user_{i % 10}")
-        
-        # 隨機日期（過去 30 天內）
-        days_ago = random.randint(0, 30)
-        created_at = datetime.utcnow() - timedelta(days=days_ago)
+    # 建立 50 個測試提問：一次抽出所有隨機欄位，迴圈內只組裝文件
+    question_count = 50
+    picked_templates = random.choices(question_templates, k=question_count)
+    picked_statuses = random.choices(statuses, k=question_count)
+    picked_difficulties = random.choices(difficulties, k=question_count)
+    picked_keywords = random.choices(keywords_pool, k=question_count)
+    # 隨機日期（過去 30 天內）
+    picked_days_ago = random.choices(range(31), k=question_count)
+    
+    # 偽名只有 10 種，預先計算
+    pseudonyms = [generate_pseudonym(f"test_user_{u}") for u in range(10)]
+    
+    for i, (question_text, status, (difficulty_score, difficulty_level), keywords, days_ago) in enumerate(zip(
+        picked_templates, picked_statuses, picked_difficulties, picked_keywords, picked_days_ago
+    )):
+        created_at = now - timedelta(days=days_ago)
         
         question = {
             "course_id": course_id,
             "class_id": None,
-            "pseudonym": pseudonym,
+            "pseudonym": pseudonyms[i % 10],
             "question_text": f"{question_text} (測試問題 #{i+1})",
             "status": status.value,
             "cluster_id": f"cluster_{i % 5 + 1}",  # 5 個聚類
@@ -118,10 +126,6 @@ async def create_test_data():
         
         questions_data.append(question)
     
-    if questions_data:
-        await database["questions"].insert_many(questions_data)
-        print(f"成功建立 {len(questions_data)} 個測試提問")
-    
     # 建立測試 Q&A
     print("建立測試 Q&A...")
     qas_data = [
@@ -133,10 +137,10 @@ async def create_test_data():
             "category": "檔案處理",
             "tags": ["Python", "檔案", "讀取"],
             "is_published": True,
-            "publish_date": datetime.utcnow(),
+            "publish_date": now,
             "related_question_ids": [],
             "created_by": "admin",
-            "created_at": datetime.utcnow()
+            "created_at": now
         },
         {
             "course_id": course_id,
@@ -146,10 +150,10 @@ async def create_test_data():
             "category": "資料結構",
             "tags": ["Python", "list", "tuple", "資料結構"],
             "is_published": True,
-            "publish_date": datetime.utcnow(),
+            "publish_date": now,
             "related_question_ids": [],
             "created_by": "admin",
-            "created_at": datetime.utcnow()
+            "created_at": now
         },
         {
             "course_id": course_id,
@@ -159,16 +163,28 @@ async def create_test_data():
             "category": "物件導向",
             "tags": ["Python", "OOP", "物件導向", "class"],
             "is_published": True,
-            "publish_date": datetime.utcnow(),
+            "publish_date": now,
             "related_question_ids": [],
             "created_by": "admin",
-            "created_at": datetime.utcnow()
+            "created_at": now
         }
     ]
     
-    if qas_data:
-        await database["qas"].insert_many(qas_data)
-        print(f"成功建立 {len(qas_data)} 個測試 Q&A")
+    # 先寫入課程：課程代碼 + 學期唯一，重複執行時課程已存在，不寫入指向不存在課程的提問與 Q&A
+    try:
+        await database["courses"].with_options(write_concern=SEED_WRITE_CONCERN).insert_one(course_data)
+    except DuplicateKeyError:
+        print(f"❌ 課程 {course_data['course_code']} ({course_data['semester']}) 已存在，未建立測試資料")
+        return
+    print(f"課程建立成功，ID: {course_id}")
+    
+    # 提問與 Q&A 的寫入互不相依，同時送出
+    inserted_questions, inserted_qas = await asyncio.gather(
+        insert_unordered(database["questions"], questions_data, "測試提問"),
+        insert_unordered(database["qas"], qas_data, "測試 Q&A"),
+    )
+    print(f"成功建立 {inserted_questions} 個測試提問")
+    print(f"成功建立 {inserted_qas} 個測試 Q&A")
     
     # 顯示統計
     print("\n=== 測試資料建立完成 ===")
@@ -177,10 +193,19 @@ async def create_test_data():
     print(f"Q&A 數量: {len(qas_data)}")
     print(f"\n課程 ID: {course_id}")
     print("\n請前往 http://localhost:3000/dashboard/statistics 查看統計資料")
+
+
+async def main():
+    """主函式"""
+    # 連接資料庫
+    await db.connect_db()
     
-    # 關閉資料庫連線
-    await db.close_db()
+    try:
+        await create_test_data()
+    finally:
+        # 關閉資料庫連線
+        await db.close_db()
 
 if __name__ == "__main__":
-    asyncio.run(create_test_data())
+    asyncio.run(main())
 
@@ -3,10 +3,12 @@
 用於測試 LINE 整合功能
 """
 import asyncio
-from datetime import datetime, timedelta
+from datetime import timedelta
 import random
-from app.database import db
+from app.database import db, LINE_MESSAGES_INDEXES
 from app.utils.security import generate_pseudonym
+from app.utils.datetime_helper import utc_now_naive
+from app.utils.seeding import insert_unordered
 
 # 模擬的學生問題
 SAMPLE_QUESTIONS = [
@@ -36,97 +38,109 @@ SAMPLE_REPLIES = [
     "期末專題題目會在下週公告"
 ]
 
+
 async def create_test_messages():
     """建立測試訊息"""
     database = db.get_db()
     messages_collection = database["line_messages"]
     
     # 清除現有的測試資料（可選）
+    # 直接 drop 整個集合：之後寫入無索引的空集合，索引於寫入完成後一次重建
     print("清除現有的測試資料...")
-    await messages_collection.delete_many({})
+    await messages_collection.drop()
     
     # 產生過去 7 天的測試資料
     print("開始產生測試資料...")
-    now = datetime.utcnow()
+    now = utc_now_naive()
     
     # 模擬 5 個不同的學生
     test_users = [
         f"U{str(i).zfill(32)}" for i in range(1, 6)
     ]
     
+    # 偽名只有 5 種，預先計算，迴圈內不重複雜湊
+    pseudonyms = {user_id: generate_pseudonym(user_id) for user_id in test_users}
+    
     messages_to_insert = []
+    # 組裝文件時同步累計各方向筆數，不需事後再掃描清單
+    received_count = sent_count = failed_count = 0
     
+    # 一次抽出所有隨機值，迴圈內只組裝文件
+    # 每天隨機產生 10-20 組對話
+    days = []
     for day_offset in range(7):
-        date = now - timedelta(days=6-day_offset)
-        # 每天隨機產生 10-20 組對話
-        num_conversations = random.randint(10, 20)
+        days.extend([now - timedelta(days=6-day_offset)] * random.randint(10, 20))
+    total = len(days)
+    picked_users = random.choices(test_users, k=total)
+    picked_questions = random.choices(SAMPLE_QUESTIONS, k=total)
+    picked_replies = random.choices(SAMPLE_REPLIES, k=total)
+    # 隨機時間
+    picked_hours = random.choices(range(8, 23), k=total)
+    picked_minutes = random.choices(range(60), k=total)
+    picked_seconds = random.choices(range(60), k=total)
+    picked_delays = random.choices(range(5, 31), k=total)
+    picked_suffixes = random.choices(range(1000, 10000), k=total)
+    # 90% 的機率成功發送
+    picked_success = random.choices((True, False), weights=(9, 1), k=total)
+    
+    for date, user_id, question, reply, hour, minute, second, delay, suffix, success in zip(
+        days, picked_users, picked_questions, picked_replies, picked_hours,
+        picked_minutes, picked_seconds, picked_delays, picked_suffixes, picked_success
+    ):
+        pseudonym = pseudonyms[user_id]
+        
+        timestamp = date.replace(
+            hour=hour,
+            minute=minute,
+            second=second
+        )
+        
+        # 學生問題
+        received_msg = {
+            "user_id": user_id,
+            "pseudonym": pseudonym,
+            "message_type": "text",
+            "direction": "received",
+            "content": question,
+            "line_message_id": f"msg_{timestamp.timestamp()}_{suffix}",
+            "created_at": timestamp
+        }
+        messages_to_insert.append(received_msg)
+        received_count += 1
+        
+        # 系統回覆（幾秒後）
+        reply_timestamp = timestamp + timedelta(seconds=delay)
         
-        for conv in range(num_conversations):
-            # 隨機選擇一個學生
-            user_id = random.choice(test_users)
-            pseudonym = generate_pseudonym(user_id)
-            
-            # 隨機時間
-            hour = random.randint(8, 22)
-            minute = random.randint(0, 59)
-            second = random.randint(0, 59)
-            
-            timestamp = date.replace(
-                hour=hour,
-                minute=minute,
-                second=second
-            )
-            
-            # 學生問題
-            question = random.choice(SAMPLE_QUESTIONS)
-            received_msg = {
+        if success:
+            sent_count += 1
+            sent_msg = {
                 "user_id": user_id,
                 "pseudonym": pseudonym,
                 "message_type": "text",
-                "direction": "received",
-                "content": question,
-                "line_message_id": f"msg_{timestamp.timestamp()}_{random.randint(1000, 9999)}",
-                "created_at": timestamp
+                "direction": "sent",
+                "content": reply,
+                "created_at": reply_timestamp
             }
-            messages_to_insert.append(received_msg)
-            
-            # 系統回覆（幾秒後）
-            reply_timestamp = timestamp + timedelta(seconds=random.randint(5, 30))
-            reply = random.choice(SAMPLE_REPLIES)
-            
-            # 90% 的機率成功發送
-            if random.random() < 0.9:
-                sent_msg = {
-                    "user_id": user_id,
-                    "pseudonym": pseudonym,
-                    "message_type": "text",
-                    "direction": "sent",
-                    "content": reply,
-                    "created_at": reply_timestamp
-                }
-            else:
-                # 10% 的機率發送失敗
-                sent_msg = {
-                    "user_id": user_id,
-                    "pseudonym": pseudonym,
-                    "message_type": "text",
-                    "direction": "failed",
-                    "content": reply,
-                    "error_message": "發送失敗：網路連線逾時",
-                    "created_at": reply_timestamp
-                }
-            messages_to_insert.append(sent_msg)
+        else:
+            # 10% 的機率發送失敗
+            failed_count += 1
+            sent_msg = {
+                "user_id": user_id,
+                "pseudonym": pseudonym,
+                "message_type": "text",
+                "direction": "failed",
+                "content": reply,
+                "error_message": "發送失敗：網路連線逾時",
+                "created_at": reply_timestamp
+            }
+        messages_to_insert.append(sent_msg)
     
     # 批次插入
     if messages_to_insert:
-        result = await messages_collection.insert_many(messages_to_insert)
-        print(f"成功建立 {len(result.inserted_ids)} 筆測試訊息資料")
+        inserted_count = await insert_unordered(messages_collection, messages_to_insert, "測試訊息")
+        print(f"成功建立 {inserted_count} 筆測試訊息資料")
         
         # 統計資訊
-        received_count = sum(1 for msg in messages_to_insert if msg["direction"] == "received")
-        sent_count = sum(1 for msg in messages_to_insert if msg["direction"] == "sent")
-        failed_count = sum(1 for msg in messages_to_insert if msg["direction"] == "failed")
-        
         print(f"\n統計資訊：")
         print(f"  收到的訊息：{received_count}")
         print(f"  發送的訊息：{sent_count}")
@@ -134,6 +148,10 @@ async def create_test_messages():
         print(f"  唯一用戶數：{len(test_users)}")
     else:
         print("沒有資料需要插入")
+    
+    # 寫入完成後一次排序建立索引，取代逐筆寫入時的隨機索引更新
+    for keys in LINE_MESSAGES_INDEXES:
+        await messages_collection.create_index(keys)
 
 async def main():
     """主函式"""
@@ -30,19 +30,17 @@ async def hard_delete_course_data():
             return
 
         # 建立過濾條件 (同時支援 string 和 ObjectId 格式)
-        filter_query = {
-            "$or": [
-                {"course_id": COURSE_ID},
-                {"course_id": ObjectId(COURSE_ID)}
-            ]
-        }
+        # 系統寫入的 course_id 一律為字串；以單一 $in 條件涵蓋舊的 ObjectId 資料，只需一次 course_id 索引掃描
+        filter_query = {"course_id": {"$in": [COURSE_ID, ObjectId(COURSE_ID)]}}
         
         # 1. 刪除所有問題 (包含 PENDING, DELETED 等所有狀態)
-        q_result = await database["questions"].delete_many(filter_query)
-        print(f"🗑️  已永久刪除 {q_result.deleted_count} 筆問題 (Questions)")
-
         # 2. 刪除所有聚類結果
-        c_result = await database["clusters"].delete_many(filter_query)
+        # 兩個集合的刪除互不相依，同時送出；保留索引，刪除條件需靠 course_id 索引定位文件
+        q_result, c_result = await asyncio.gather(
+            database["questions"].delete_many(filter_query),
+            database["clusters"].delete_many(filter_query),
+        )
+        print(f"🗑️  已永久刪除 {q_result.deleted_count} 筆問題 (Questions)")
         print(f"🗑️  已永久刪除 {c_result.deleted_count} 筆聚類 (Clusters)")
         
         # 3. (選用) 刪除相關的 AI 分析紀錄 (若有獨立 Collection)
@@ -22,15 +22,18 @@ async def reset_course_data():
 
         # 1. 重置問題狀態 (把 cluster_id 變回 null)
         # 我們同時匹配 string 和 ObjectId 格式，確保萬無一失
-        q_filter = {
-            "$or": [
-                {"course_id": COURSE_ID},
-                {"course_id": ObjectId(COURSE_ID)}
-            ]
-        }
+        # 系統寫入的 course_id 一律為字串；以單一 $in 條件涵蓋舊的 ObjectId 資料，只需一次 course_id 索引掃描
+        course_filter = {"course_id": {"$in": [COURSE_ID, ObjectId(COURSE_ID)]}}
         
+        # 只更新確實需要變更的作答，已是未分群且待處理的文件不重寫
         update_result = await database["questions"].update_many(
-            q_filter,
+            {
+                **course_filter,
+                "$or": [
+                    {"cluster_id": {"$ne": None}},
+                    {"status": {"$ne": "PENDING"}}
+                ]
+            },
             {
                 "$set": {
                     "cluster_id": None, # 清空分群
@@ -42,13 +45,7 @@ async def reset_course_data():
 
         # 2. 刪除舊的 Cluster 紀錄
         # 這樣前端才不會顯示舊的卡片
-        c_filter = {
-            "$or": [
-                {"course_id": COURSE_ID},
-                {"course_id": ObjectId(COURSE_ID)}
-            ]
-        }
-        delete_result = await database["clusters"].delete_many(c_filter)
+        delete_result = await database["clusters"].delete_many(course_filter)
         print(f"🗑️ 已刪除 {delete_result.deleted_count} 個舊的 Cluster 主題")
 
         print("\n✨ 重置完成！現在您可以回到前端點擊「重新運行 AI 分析」了。")
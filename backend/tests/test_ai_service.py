@@ -6,6 +6,7 @@ import inspect
 import pytest
 import asyncio
 from unittest.mock import AsyncMock, MagicMock, patch
+from app.models.schemas import QuestionAnalysis
 from app.services.ai_service import AIService
 
 
@@ -41,6 +42,56 @@ class TestAIServiceBasic:
         assert inspect.iscoroutinefunction(service.get_reply)
 
 
+class TestRetryWithBackoff:
+    """Tests for _retry_with_backoff"""
+
+    @pytest.mark.asyncio
+    async def test_non_retryable_error_fails_immediately(self):
+        from app.services.ai_service import _retry_with_backoff
+
+        fn = AsyncMock(side_effect=Exception("400 INVALID_ARGUMENT"))
+        with pytest.raises(RuntimeError, match="呼叫失敗"):
+            await _retry_with_backoff(fn, max_attempts=3, base_delay=0.01, timeout=1, provider="Test")
+        assert fn.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_5xx_retried_with_jittered_backoff(self):
+        from app.services.ai_service import _retry_with_backoff
+
+        fn = AsyncMock(side_effect=[Exception("502 Bad Gateway"), "ok"])
+        with patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+            result = await _retry_with_backoff(fn, max_attempts=3, base_delay=1.0, timeout=1, provider="Test")
+
+        assert result == "ok"
+        delay = mock_sleep.await_args_list[-1].args[0]
+        assert 1.0 <= delay <= 2.0
+
+    @pytest.mark.asyncio
+    async def test_retry_after_header_sets_provider_cooldown(self):
+        """Retry-After 決定等待秒數，並讓同供應商後續請求先等待冷卻"""
+        from app.services import ai_service as module
+
+        error = Exception("429 Too Many Requests")
+        error.response = MagicMock(headers={"retry-after": "7"})
+        fn = AsyncMock(side_effect=[error, "ok"])
+
+        with patch("asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+            result = await module._retry_with_backoff(
+                fn, max_attempts=2, base_delay=1.0, timeout=1, provider="CooldownTest"
+            )
+        assert result == "ok"
+        assert 7.0 in [c.args[0] for c in mock_sleep.await_args_list]
+        assert "CooldownTest" in module._provider_cooldown_until
+        module._provider_cooldown_until.pop("CooldownTest")
+
+
+def make_gemini_client(response=None, side_effect=None):
+    """建立以 client.aio.models.generate_content 回應的 Gemini 客戶端替身"""
+    mock_client = MagicMock()
+    mock_client.aio.models.generate_content = AsyncMock(return_value=response, side_effect=side_effect)
+    return mock_client
+
+
 class TestCallGemini:
     """Tests for _call_gemini method"""
 
@@ -48,79 +99,117 @@ class TestCallGemini:
     async def test_uses_correct_model_name(self):
         """Req 3.1: Uses model name from settings"""
         service = AIService()
-        service.api_key = "test-key"
-        service.model_name = "gemini-2.0-flash"
-
-        mock_client = MagicMock()
         mock_response = MagicMock()
         mock_response.text = "test response"
-        mock_client.models.generate_content.return_value = mock_response
-        service._client = mock_client
+        mock_client = make_gemini_client(mock_response)
+        service._gemini_client = mock_client
 
-        with patch("asyncio.to_thread", new_callable=AsyncMock) as mock_thread:
-            mock_thread.return_value = mock_response
-            result = await service._call_gemini("test prompt")
+        with patch("app.config.settings.GEMINI_MODEL", "gemini-2.0-flash"):
+            with patch("asyncio.to_thread", new_callable=AsyncMock) as mock_thread:
+                result = await service._call_gemini("test prompt")
 
-        call_args = mock_thread.call_args
+        assert result == "test response"
+        mock_thread.assert_not_called()
+        call_args = mock_client.aio.models.generate_content.call_args
         assert call_args is not None
-        assert "gemini-2.0-flash" in str(call_args)
+        assert call_args.kwargs["model"] == "gemini-2.0-flash"
 
     @pytest.mark.asyncio
     async def test_json_mode_sets_response_mime_type(self):
         """Req 3.2: json_mode=True sets response_mime_type to application/json"""
         service = AIService()
-        service.api_key = "test-key"
-
-        mock_client = MagicMock()
         mock_response = MagicMock()
         mock_response.text = '{"test": true}'
-        mock_client.models.generate_content.return_value = mock_response
-        service._client = mock_client
+        mock_client = make_gemini_client(mock_response)
+        service._gemini_client = mock_client
 
-        with patch("asyncio.to_thread", new_callable=AsyncMock) as mock_thread:
-            mock_thread.return_value = mock_response
-            result = await service._call_gemini("test", json_mode=True)
+        result = await service._call_gemini("test", json_mode=True)
 
         assert result == {"test": True}
+        config = mock_client.aio.models.generate_content.call_args.kwargs["config"]
+        assert config.response_mime_type == "application/json"
+
+    @pytest.mark.asyncio
+    async def test_generation_config_is_reused(self):
+        """相同生成參數共用預先建立的設定物件"""
+        service = AIService()
+        mock_response = MagicMock()
+        mock_response.text = "ok"
+        mock_client = make_gemini_client(mock_response)
+        service._gemini_client = mock_client
+
+        await service._call_gemini("a", temperature=0.3)
+        await service._call_gemini("b", temperature=0.3)
+        await service._call_gemini("c", temperature=0.3, json_mode=True)
+
+        configs = [c.kwargs["config"] for c in mock_client.aio.models.generate_content.call_args_list]
+        assert configs[0] is configs[1]
+        assert configs[2] is not configs[0]
+        assert configs[0].max_output_tokens == 2048
 
     @pytest.mark.asyncio
     async def test_invalid_json_returns_empty_dict(self):
         """Req 3.4: Invalid JSON in json_mode returns {}"""
         service = AIService()
-        service.api_key = "test-key"
-
         mock_response = MagicMock()
         mock_response.text = "not valid json {{"
+        service._gemini_client = make_gemini_client(mock_response)
 
-        with patch("asyncio.to_thread", new_callable=AsyncMock) as mock_thread:
-            mock_thread.return_value = mock_response
-            result = await service._call_gemini("test", json_mode=True)
+        result = await service._call_gemini("test", json_mode=True)
 
         assert result == {}
 
+    @pytest.mark.asyncio
+    async def test_response_model_validates_raw_json(self):
+        """指定 response_model 時直接驗證原始 JSON，格式不符回傳 None"""
+        service = AIService()
+        mock_response = MagicMock()
+        mock_response.text = '{"keywords": ["迴圈"], "difficulty_score": 0.4, "sentiment": "Neutral", "summary": "s"}'
+        service._gemini_client = make_gemini_client(mock_response)
+
+        result = await service._call_gemini("test", json_mode=True, response_model=QuestionAnalysis)
+        assert result == QuestionAnalysis(keywords=["迴圈"], difficulty_score=0.4, summary="s")
+
+        mock_response.text = '{"keywords": "迴圈"}'
+        assert await service._call_gemini("test", json_mode=True, response_model=QuestionAnalysis) is None
+
+    def test_off_fields_are_coerced_instead_of_failing(self):
+        """summary 為 null 或情緒無法辨識時改用預設值，其餘欄位照常保留"""
+        analysis = QuestionAnalysis.model_validate_json(
+            '{"keywords": ["迴圈"], "difficulty_score": 0.4, "sentiment": "confused", "summary": null}'
+        )
+        assert analysis == QuestionAnalysis(keywords=["迴圈"], difficulty_score=0.4, sentiment="neutral", summary="")
+
+    def test_difficulty_score_coerced_and_clamped(self):
+        """難度分數為數字字串或超出範圍時轉為 float 並夾回 0-1，無法轉換時視為未提供"""
+        assert QuestionAnalysis.model_validate({"difficulty_score": 1.2}).difficulty_score == 1.0
+        assert QuestionAnalysis.model_validate({"difficulty_score": -0.5}).difficulty_score == 0.0
+        assert QuestionAnalysis.model_validate({"difficulty_score": "0.7"}).difficulty_score == 0.7
+        assert QuestionAnalysis.model_validate({"difficulty_score": "hard"}).difficulty_score is None
+
     @pytest.mark.asyncio
     async def test_retry_on_429_error(self):
         """Req 11.1: Retries on 429 errors with exponential backoff"""
         service = AIService()
-        service.api_key = "test-key"
 
         mock_response = MagicMock()
         mock_response.text = "success"
 
         call_count = 0
 
-        async def mock_to_thread(*args, **kwargs):
+        async def mock_generate(*args, **kwargs):
             nonlocal call_count
             call_count += 1
             if call_count < 3:
                 raise Exception("429 Too Many Requests")
             return mock_response
 
-        with patch("asyncio.to_thread", side_effect=mock_to_thread):
-            with patch("asyncio.sleep", new_callable=AsyncMock):
-                with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 3):
-                    with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.01):
-                        result = await service._call_gemini("test")
+        service._gemini_client = make_gemini_client(side_effect=mock_generate)
+
+        with patch("asyncio.sleep", new_callable=AsyncMock):
+            with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 3):
+                with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.01):
+                    result = await service._call_gemini("test")
 
         assert result == "success"
         assert call_count == 3
@@ -129,32 +218,38 @@ class TestCallGemini:
     async def test_timeout_raises_timeout_error(self):
         """Req 11.2: Timeout raises asyncio.TimeoutError"""
         service = AIService()
-        service.api_key = "test-key"
 
-        with patch("asyncio.wait_for", side_effect=asyncio.TimeoutError()):
-            with pytest.raises(asyncio.TimeoutError):
-                await service._call_gemini("test")
+        async def slow_generate(*args, **kwargs):
+            await asyncio.sleep(1)
+
+        mock_client = make_gemini_client(side_effect=slow_generate)
+        service._gemini_client = mock_client
+
+        with patch("app.config.settings.GEMINI_TIMEOUT_SECONDS", 0.01):
+            with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 2):
+                with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.001):
+                    with pytest.raises(asyncio.TimeoutError):
+                        await service._call_gemini("test")
+
+        # 逾時屬於暫時性錯誤，重試用盡後才拋出
+        assert mock_client.aio.models.generate_content.await_count == 2
 
     @pytest.mark.asyncio
     async def test_all_retries_fail_raises_runtime_error(self):
         """Req 11.3: All retries failing raises RuntimeError"""
         service = AIService()
+        service._gemini_client = make_gemini_client(side_effect=Exception("503 Service Unavailable"))
 
-        async def always_fail(*args, **kwargs):
-            raise Exception("503 Service Unavailable")
-
-        with patch("asyncio.to_thread", side_effect=always_fail):
-            with patch("asyncio.sleep", new_callable=AsyncMock):
-                with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 3):
-                    with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.01):
-                        with pytest.raises(RuntimeError):
-                            await service._call_gemini("test")
+        with patch("asyncio.sleep", new_callable=AsyncMock):
+            with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 3):
+                with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.01):
+                    with pytest.raises(RuntimeError):
+                        await service._call_gemini("test")
 
     @pytest.mark.asyncio
     async def test_retry_logs_attempt_number(self):
         """Req 11.4: Retry logs attempt number"""
         service = AIService()
-        service.api_key = "test-key"
 
         call_count = 0
 
@@ -167,14 +262,195 @@ class TestCallGemini:
             mock_resp.text = "ok"
             return mock_resp
 
-        with patch("asyncio.to_thread", side_effect=fail_then_succeed):
-            with patch("asyncio.sleep", new_callable=AsyncMock):
-                with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 3):
-                    with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.01):
-                        with patch("app.services.ai_service.logger") as mock_logger:
-                            result = await service._call_gemini("test")
+        service._gemini_client = make_gemini_client(side_effect=fail_then_succeed)
+
+        with patch("asyncio.sleep", new_callable=AsyncMock):
+            with patch("app.config.settings.GEMINI_RETRY_MAX_ATTEMPTS", 3):
+                with patch("app.config.settings.GEMINI_RETRY_BASE_DELAY", 0.01):
+                    with patch("app.services.ai_service.logger") as mock_logger:
+                        result = await service._call_gemini("test")
 
         assert result == "ok"
         mock_logger.warning.assert_called()
         warning_call = mock_logger.warning.call_args_list[0]
         assert "1/3" in str(warning_call) or "重試" in str(warning_call)
+
+
+class TestCallGroq:
+    """Tests for _call_groq method"""
+
+    @pytest.mark.asyncio
+    async def test_groq_awaits_async_client_without_thread(self):
+        """Groq 備援直接 await 非同步客戶端，不經過 to_thread"""
+        service = AIService()
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = " ok "
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
+        mock_client.close = AsyncMock()
+        service._groq_client = mock_client
+
+        with patch("app.config.settings.GROQ_API_KEY", "test-key"):
+            with patch("asyncio.to_thread", new_callable=AsyncMock) as mock_thread:
+                result = await service._call_groq("test")
+
+        assert result == "ok"
+        mock_thread.assert_not_called()
+        mock_client.chat.completions.create.assert_awaited_once()
+
+        await service.aclose()
+        mock_client.close.assert_awaited_once()
+        assert service._groq_client is None
+
+    @pytest.mark.asyncio
+    async def test_groq_client_disables_sdk_retries(self):
+        """SDK 內建重試關閉，避免與 _retry_with_backoff 疊加；連線逾時獨立設定"""
+        service = AIService()
+        with patch("app.config.settings.GROQ_API_KEY", "test-key"):
+            with patch("app.config.settings.GROQ_CONNECT_TIMEOUT_SECONDS", 5.0):
+                client = await service._get_groq_client()
+                assert await service._get_groq_client() is client
+
+        assert client.max_retries == 0
+        assert client.timeout.connect == 5.0
+        await service.aclose()
+
+    @pytest.mark.asyncio
+    async def test_groq_sends_system_prompt_first(self):
+        """系統提示詞作為第一則訊息送出，固定前綴可命中供應商的提示詞快取"""
+        service = AIService()
+        mock_response = MagicMock()
+        mock_response.choices = [MagicMock()]
+        mock_response.choices[0].message.content = "ok"
+        mock_client = MagicMock()
+        mock_client.chat.completions.create = AsyncMock(return_value=mock_response)
+        service._groq_client = mock_client
+
+        with patch("app.config.settings.GROQ_API_KEY", "test-key"):
+            await service._call_groq("user part", system_prompt="stable rules")
+
+        messages = mock_client.chat.completions.create.call_args[1]["messages"]
+        assert messages == [
+            {"role": "system", "content": "stable rules"},
+            {"role": "user", "content": "user part"},
+        ]
+
+
+class TestResponseCache:
+    """Tests for the analyze / draft response cache"""
+
+    @pytest.mark.asyncio
+    async def test_analyze_question_reuses_result_for_equivalent_text(self):
+        """只差在大小寫、連續空白、結尾問號或全半形的提問共用快取結果"""
+        service = AIService()
+        analysis = {"keywords": ["迴圈"], "difficulty_score": 0.4, "sentiment": "neutral", "summary": "迴圈"}
+        with patch.object(service, "_call_ai", new_callable=AsyncMock, return_value=analysis) as mock_ai:
+            first = await service.analyze_question("For 迴圈怎麼寫？")
+            second = await service.analyze_question(" for   迴圈怎麼寫?  ")
+            await service.generate_response_draft("For 迴圈怎麼寫？")
+        await service.aclose()
+
+        assert first == second == QuestionAnalysis(**analysis)
+        # 分析命中快取；草稿使用不同命名空間，另外呼叫一次
+        assert mock_ai.await_count == 2
+
+    def test_code_symbols_do_not_collide(self):
+        """運算子與底線在程式設計提問中有意義，不同提問不可共用快取鍵"""
+        from app.services.ai_service import _normalize_question
+
+        for a, b in [("i++ 是什麼", "i 是什麼"), ("a<b 怎麼判斷", "ab 怎麼判斷"),
+                     ("2*3 等於多少", "23 等於多少"), ("x_1 的值", "x1 的值")]:
+            assert _normalize_question(a) != _normalize_question(b)
+
+    @pytest.mark.asyncio
+    async def test_failed_analysis_is_not_cached(self):
+        service = AIService()
+        with patch.object(service, "_call_ai", new_callable=AsyncMock, side_effect=[{}, {"summary": "ok"}]) as mock_ai:
+            failed = await service.analyze_question("q")
+            retried = await service.analyze_question("q")
+        await service.aclose()
+
+        assert failed.summary == "分析失敗"
+        assert retried == QuestionAnalysis(summary="ok")
+        assert mock_ai.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_call_ai_caches_identical_low_temperature_prompts(self):
+        """相同提示詞的低溫度呼叫命中快取；高溫度呼叫每次都重新生成"""
+        service = AIService()
+        with patch.object(service, "_call_gemini", new_callable=AsyncMock, return_value="answer") as mock_gemini:
+            assert await service._call_ai("prompt", temperature=0.3) == "answer"
+            assert await service._call_ai("prompt", temperature=0.3) == "answer"
+            assert mock_gemini.await_count == 1
+
+            await service._call_ai("prompt", json_mode=True, temperature=0.3)
+            assert mock_gemini.await_count == 2
+
+            await service._call_ai("prompt", temperature=0.7)
+            await service._call_ai("prompt", temperature=0.7)
+            assert mock_gemini.await_count == 4
+
+
+class TestAnalysisBatching:
+    """Tests for the analyze_question micro-batcher"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_analyses_share_one_ai_call(self):
+        """同時段的多筆分析合併為一次 AI 呼叫，結果依 index 對應回各自的提問"""
+        service = AIService()
+        batch_response = {"results": [
+            {"index": 1, "keywords": ["b"], "summary": "B"},
+            {"index": 0, "keywords": ["a"], "summary": "A"},
+            {"index": 2, "keywords": ["c"], "summary": "C"},
+        ]}
+        with patch.object(service, "_call_ai", new_callable=AsyncMock, return_value=batch_response) as mock_ai:
+            results = await asyncio.gather(*(service.analyze_question(q) for q in ["qa", "qb", "qc"]))
+        await service.aclose()
+
+        assert mock_ai.await_count == 1
+        assert "ID_2: qc" in mock_ai.await_args.args[0]
+        assert [r.summary for r in results] == ["A", "B", "C"]
+        assert results[0].keywords == ["a"]
+        # 回應可能被 _prompt_cache 保留，index 不可從原物件移除
+        assert [item["index"] for item in batch_response["results"]] == [1, 0, 2]
+
+    @pytest.mark.asyncio
+    async def test_missing_batch_items_fall_back_to_single_calls(self):
+        service = AIService()
+
+        async def fake_call_ai(prompt, json_mode=False, temperature=0.7, system_prompt=None, response_model=None):
+            if "ID_0" in prompt:
+                return {"results": [{"index": 0, "summary": "A"}, {"index": 1, "keywords": "not a list"}]}
+            assert response_model is QuestionAnalysis
+            return QuestionAnalysis(summary="single")
+
+        with patch.object(service, "_call_ai", side_effect=fake_call_ai) as mock_ai:
+            results = await asyncio.gather(service.analyze_question("qa"), service.analyze_question("qb"))
+        await service.aclose()
+
+        assert [r.summary for r in results] == ["A", "single"]
+        assert mock_ai.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_aclose_fails_pending_and_in_flight_analyses(self):
+        """關閉時執行中與收集中的分析皆以失敗結束，不留下等待中的呼叫端"""
+        service = AIService()
+        never = asyncio.Event()
+
+        async def hang(*args, **kwargs):
+            await never.wait()
+
+        with patch("app.config.settings.AI_ANALYSIS_BATCH_SIZE", 2), \
+             patch("app.config.settings.AI_ANALYSIS_BATCH_WINDOW_MS", 10_000), \
+             patch.object(service, "_call_ai", side_effect=hang):
+            in_flight = [asyncio.create_task(service.analyze_question(q)) for q in ("qa", "qb")]
+            while not service._analysis_batches:
+                await asyncio.sleep(0)
+            collecting = asyncio.create_task(service.analyze_question("qc"))
+            await asyncio.sleep(0.01)
+            await service.aclose()
+            results = await asyncio.wait_for(asyncio.gather(*in_flight, collecting), timeout=1)
+
+        assert [r.summary for r in results] == ["分析失敗"] * 3
+        assert not service._analysis_batches
@@ -0,0 +1,103 @@
+"""
+TTL 快取測試
+驗證 AsyncTTLCache 合併並發請求、失效與 LINE 統計快取的清除
+"""
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+
+from app.utils.cache import AsyncTTLCache
+
+
+class TestAsyncTTLCache:
+
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_call_factory_once(self):
+        """同一個 key 的並發請求只回源一次"""
+        cache = AsyncTTLCache(maxsize=8, ttl=10)
+        calls = 0
+
+        async def factory():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return {"value": calls}
+
+        results = await asyncio.gather(*[cache.get_or_set(("stats", None), factory) for _ in range(5)])
+
+        assert calls == 1
+        assert all(r == {"value": 1} for r in results)
+
+    @pytest.mark.asyncio
+    async def test_locks_released_after_fill(self):
+        """回源完成 (含失敗) 後移除該 key 的鎖，鎖的數量不隨 key 累積"""
+        cache = AsyncTTLCache(maxsize=8, ttl=10)
+        await asyncio.gather(*[cache.get_or_set(("q", i % 3), AsyncMock(return_value=i)) for i in range(9)])
+        with pytest.raises(ValueError):
+            await cache.get_or_set(("q", "bad"), AsyncMock(side_effect=ValueError))
+
+        assert cache._locks == {} and cache._lock_users == {}
+
+    @pytest.mark.asyncio
+    async def test_keys_are_isolated(self):
+        cache = AsyncTTLCache(maxsize=8, ttl=10)
+        a = await cache.get_or_set(("stats", "c1"), AsyncMock(return_value="a"))
+        b = await cache.get_or_set(("stats", "c2"), AsyncMock(return_value="b"))
+        assert (a, b) == ("a", "b")
+
+    @pytest.mark.asyncio
+    async def test_invalidate_prefix_forces_reload(self):
+        cache = AsyncTTLCache(maxsize=8, ttl=10)
+        factory = AsyncMock(side_effect=["old", "new"])
+
+        assert await cache.get_or_set(("line_stats", None), factory) == "old"
+        assert await cache.get_or_set(("line_stats", None), factory) == "old"
+
+        cache.invalidate_prefix("line_stats")
+        assert await cache.get_or_set(("line_stats", None), factory) == "new"
+        assert factory.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_invalidate_prefix_with_parts_matches_longer_keys(self):
+        """指定 course_id 時清除該課程所有篩選條件的快取，不影響其他課程"""
+        cache = AsyncTTLCache(maxsize=8, ttl=10)
+        for key in [("csv", "c1"), ("csv", "c1", "A"), ("csv", "c2", "A")]:
+            await cache.get_or_set(key, AsyncMock(return_value="old"))
+
+        cache.invalidate_prefix("csv", "c1")
+
+        factory = AsyncMock(return_value="new")
+        assert await cache.get_or_set(("csv", "c1"), factory) == "new"
+        assert await cache.get_or_set(("csv", "c1", "A"), factory) == "new"
+        assert await cache.get_or_set(("csv", "c2", "A"), factory) == "old"
+
+    @pytest.mark.asyncio
+    async def test_line_service_invalidates_stats(self):
+        """LineService 收到新訊息後會清除統計快取"""
+        from app.services.line_service import LineService
+
+        service = LineService()
+        await service.stats_cache.get_or_set(("line_stats", None), AsyncMock(return_value=1))
+        await service.stats_cache.get_or_set(("message_stats", 7), AsyncMock(return_value=2))
+
+        service.invalidate_stats_cache()
+
+        factory = AsyncMock(return_value=3)
+        assert await service.stats_cache.get_or_set(("line_stats", None), factory) == 3
+        factory.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_notify_message_recorded_pushes_delta_to_subscribers(self):
+        """寫入訊息後推送增量給即時統計訂閱者"""
+        from datetime import datetime
+        from app.services.line_service import LineService
+
+        service = LineService()
+        queue = service.subscribe_stats()
+
+        service.notify_message_recorded("received", datetime(2024, 1, 2, 3, 4))
+        assert queue.get_nowait() == {"direction": "received", "date": "2024-01-02"}
+
+        service.unsubscribe_stats(queue)
+        service.notify_message_recorded("sent", datetime(2024, 1, 2))
+        assert queue.empty()
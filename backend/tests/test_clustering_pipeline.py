@@ -24,6 +24,7 @@ class TestGetApprovedAnswers:
 
         mock_cursor = AsyncMock()
         mock_cursor.to_list = AsyncMock(return_value=[approved_doc])
+        mock_cursor.hint = MagicMock(return_value=mock_cursor)
         mock_cursor.limit = MagicMock(return_value=mock_cursor)
 
         mock_collection = AsyncMock()
@@ -38,6 +39,13 @@ class TestGetApprovedAnswers:
 
         assert len(replies) == 1
         assert replies[0]["answer_text"] == approved_doc["question_text"]
+        # 只取送給 AI 的欄位，並以 (reply_to_qa_id, review_status, cluster_id) 索引比對
+        query, projection = mock_collection.find.call_args[0]
+        assert query["cluster_id"] is None
+        assert projection == {"pseudonym": 1, "question_text": 1, "created_at": 1}
+        mock_cursor.hint.assert_called_once_with(
+            [("reply_to_qa_id", 1), ("review_status", 1), ("cluster_id", 1)]
+        )
 
     @pytest.mark.asyncio
     async def test_empty_answers_returns_empty_list(self):
@@ -48,6 +56,7 @@ class TestGetApprovedAnswers:
 
         mock_cursor = AsyncMock()
         mock_cursor.to_list = AsyncMock(return_value=[])
+        mock_cursor.hint = MagicMock(return_value=mock_cursor)
         mock_cursor.limit = MagicMock(return_value=mock_cursor)
 
         mock_collection = AsyncMock()
@@ -72,6 +81,7 @@ class TestGetApprovedAnswers:
 
         mock_cursor = AsyncMock()
         mock_cursor.to_list = AsyncMock(return_value=[doc])
+        mock_cursor.hint = MagicMock(return_value=mock_cursor)
         mock_cursor.limit = MagicMock(return_value=mock_cursor)
 
         mock_collection = AsyncMock()
@@ -127,6 +137,100 @@ class TestFullClusteringPipeline:
         assert result["clusters"][0]["topic_label"] == "正確理解B2C"
         assert result["clusters"][1]["question_indices"] == [1]
 
+    @pytest.mark.asyncio
+    async def test_cluster_prompt_keeps_stable_system_prefix(self):
+        """不同題目的分群呼叫共用逐字相同的系統提示詞，題目資訊只出現在使用者訊息"""
+        from app.services.ai_service import AIService, _CLUSTER_SYSTEM_PROMPT
+
+        service = AIService()
+        with patch.object(service, "_call_ai", new_callable=AsyncMock, return_value={"clusters": []}) as mock_ai:
+            await service.perform_qa_answer_clustering(["a"], "題目一", "觀念一", max_clusters=3)
+            await service.perform_qa_answer_clustering(["b", "c"], "題目二", "觀念二", existing_topics=["舊群組"])
+
+        first, second = mock_ai.call_args_list
+        assert first.kwargs["system_prompt"] == second.kwargs["system_prompt"] == _CLUSTER_SYSTEM_PROMPT
+        assert "題目一" in first.args[0] and "3 個" in first.args[0]
+        assert "題目二" in second.args[0] and "舊群組" in second.args[0]
+
+    @pytest.mark.asyncio
+    async def test_large_answer_set_is_sharded_and_merged(self):
+        """回答數超過分批大小時分批並行分群，依標籤合併並換算為全域索引"""
+        from app.services.ai_service import AIService
+
+        answers = [f"answer {i}" for i in range(5)]
+        shard_responses = {
+            "answer 0": {"clusters": [
+                {"topic_label": "觀念正確", "summary": "s", "question_indices": [0, 1]},
+            ]},
+            "answer 2": {"clusters": [
+                {"topic_label": "觀念正確", "summary": "", "question_indices": [1]},
+                {"topic_label": "混淆概念", "summary": "m", "question_indices": [0, 9]},
+            ]},
+            "answer 4": {"clusters": [
+                {"topic_label": "混淆概念。", "summary": "", "question_indices": [0]},
+            ]},
+        }
+
+        async def fake_call_ai(prompt, json_mode=False, temperature=0.7, system_prompt=None):
+            first_answer = prompt.split("ID_0: ")[1].split("\n")[0]
+            return shard_responses[first_answer]
+
+        service = AIService()
+        with patch("app.config.settings.AI_CLUSTER_SHARD_SIZE", 2), \
+             patch.object(service, "_call_ai", side_effect=fake_call_ai) as mock_ai:
+            result = await service.perform_qa_answer_clustering(
+                student_answers=answers,
+                teacher_question="q",
+                core_concept="c",
+            )
+
+        assert mock_ai.call_count == 3
+        assert result == {"clusters": [
+            {"topic_label": "觀念正確", "summary": "s", "question_indices": [0, 1, 3]},
+            {"topic_label": "混淆概念", "summary": "m", "question_indices": [2, 4]},
+        ]}
+
+    @pytest.mark.asyncio
+    async def test_sharded_clustering_shares_labels_and_respects_cap(self):
+        """其餘批次沿用第一批的標籤，合併後群組數不超過 max_clusters，且回答不遺漏"""
+        from app.services.ai_service import AIService, OVERFLOW_CLUSTER_LABEL
+
+        answers = [f"answer {i}" for i in range(6)]
+        shard_responses = {
+            "answer 0": {"clusters": [
+                {"topic_label": "觀念正確", "summary": "s", "question_indices": [0]},
+                {"topic_label": "混淆供需", "summary": "m", "question_indices": [1]},
+            ]},
+            "answer 2": {"clusters": [
+                {"topic_label": "觀念正確", "summary": "", "question_indices": [0, 1]},
+            ]},
+            "answer 4": {"clusters": [
+                {"topic_label": "只背名詞", "summary": "", "question_indices": [0]},
+                {"topic_label": "離題", "summary": "", "question_indices": [1]},
+            ]},
+        }
+        prompts = []
+
+        async def fake_call_ai(prompt, json_mode=False, temperature=0.7, system_prompt=None):
+            prompts.append(prompt)
+            return shard_responses[prompt.split("ID_0: ")[1].split("\n")[0]]
+
+        service = AIService()
+        with patch("app.config.settings.AI_CLUSTER_SHARD_SIZE", 2), \
+             patch.object(service, "_call_ai", side_effect=fake_call_ai):
+            result = await service.perform_qa_answer_clustering(
+                student_answers=answers, teacher_question="q", core_concept="c", max_clusters=3,
+            )
+
+        # 第一批單獨先送出，其標籤出現在其餘批次的提示詞中
+        assert "現有自訂群組" not in prompts[0]
+        assert all('"觀念正確", "混淆供需"' in p for p in prompts[1:])
+        clusters = result["clusters"]
+        assert len(clusters) == 3
+        assert clusters[0] == {"topic_label": "觀念正確", "summary": "s", "question_indices": [0, 2, 3]}
+        assert clusters[-1]["topic_label"] == OVERFLOW_CLUSTER_LABEL
+        assert sorted(i for c in clusters for i in c["question_indices"]) == list(range(6))
+
     @pytest.mark.asyncio
     async def test_empty_answers_returns_success(self):
         """Req 2.4, 5.1: Empty answers returns success without calling Gemini"""
@@ -236,3 +340,163 @@ class TestFullClusteringPipeline:
             with pytest.raises(HTTPException) as exc_info:
                 await generate_course_clusters(request)
             assert exc_info.value.status_code == 500
+
+
+class TestAnswerTokenBudget:
+    """分群提示詞依 token 額度截斷回答，而非固定字元數"""
+
+    def test_answers_within_budget_are_kept_whole(self):
+        from app.services.ai_service import _fit_answers_to_budget
+
+        answers = ["蝦皮是C2C", "def f(x):\n    return x * 2  # " + "a" * 400]
+        fitted, truncated = _fit_answers_to_budget(answers, budget=1000)
+        assert fitted == answers
+        assert truncated is False
+
+    def test_long_answers_share_leftover_budget(self):
+        """短回答完整保留，較長的回答平分剩餘額度"""
+        from app.services.ai_service import _estimate_tokens, _fit_answers_to_budget
+
+        short = "短答"
+        long_cjk = "長" * 500
+        long_ascii = "x" * 2000
+        fitted, truncated = _fit_answers_to_budget([short, long_cjk, long_ascii], budget=202)
+
+        assert truncated is True
+        assert fitted[0] == short
+        assert fitted[1] == "長" * 100
+        assert fitted[2] == "x" * 400
+        assert sum(_estimate_tokens(a) for a in fitted) <= 202
+
+    @pytest.mark.asyncio
+    async def test_cluster_prompt_notes_truncation(self):
+        from app.services.ai_service import AIService
+
+        service = AIService()
+        with patch("app.config.settings.AI_CLUSTER_INPUT_TOKEN_BUDGET", 10), \
+             patch.object(service, "_call_ai", new_callable=AsyncMock, return_value={"clusters": []}) as mock_ai:
+            await service.perform_qa_answer_clustering(["長" * 50], "q", "c")
+
+        prompt = mock_ai.call_args.args[0]
+        assert "ID_0: " + "長" * 10 + "\n" in prompt + "\n"
+        assert "已被截斷" in prompt
+
+
+class TestClusterWrites:
+    """分群結果以批次寫入資料庫"""
+
+    def test_build_cluster_writes_merges_duplicate_labels(self):
+        from pymongo import InsertOne, UpdateMany, UpdateOne
+        from app.api.ai_integration import _build_cluster_writes
+
+        existing_id = ObjectId()
+        replies = [{"_id": str(ObjectId())} for _ in range(4)]
+        existing_topic_map = {"舊群組": existing_id}
+        clusters_data = [
+            {"topic_label": "舊群組", "summary": "", "question_indices": [0]},
+            {"topic_label": "新群組", "summary": "", "question_indices": [1, 99]},
+            {"topic_label": "新群組", "summary": "最新摘要", "question_indices": [2]},
+            {"topic_label": "空群組", "question_indices": []},
+        ]
+
+        cluster_ops, question_ops = _build_cluster_writes(
+            clusters_data, replies, existing_topic_map, "course1", "qa1"
+        )
+
+        assert [type(op) for op in cluster_ops] == [UpdateOne, InsertOne]
+        assert cluster_ops[0]._doc["$inc"] == {"question_count": 1}
+        assert "summary" not in cluster_ops[0]._doc["$set"]
+        new_doc = cluster_ops[1]._doc
+        assert new_doc["question_count"] == 2
+        assert new_doc["summary"] == "最新摘要"
+        assert existing_topic_map["新群組"] == new_doc["_id"]
+
+        assert all(isinstance(op, UpdateMany) for op in question_ops)
+        assert question_ops[1]._filter == {
+            "_id": {"$in": [ObjectId(replies[1]["_id"]), ObjectId(replies[2]["_id"])]}
+        }
+        assert question_ops[1]._doc["$set"]["cluster_id"] == str(new_doc["_id"])
+
+    @pytest.mark.asyncio
+    async def test_endpoint_issues_one_bulk_write_per_collection(self):
+        from app.api.ai_integration import generate_course_clusters
+        from app.models.schemas import ClusterGenerateRequest
+
+        request = ClusterGenerateRequest(course_id=str(ObjectId()), qa_id=str(ObjectId()), max_clusters=5)
+        replies = [{"_id": str(ObjectId()), "answer_text": f"a{i}"} for i in range(3)]
+        ai_result = {"clusters": [
+            {"topic_label": "A", "summary": "s", "question_indices": [0, 1]},
+            {"topic_label": "B", "summary": "t", "question_indices": [2]},
+        ]}
+
+        collections = {name: MagicMock() for name in ("clusters", "questions")}
+        collections["clusters"].find = MagicMock(return_value=MagicMock(to_list=AsyncMock(return_value=[])))
+        for coll in collections.values():
+            coll.bulk_write = AsyncMock()
+            coll.insert_one = AsyncMock()
+            coll.update_many = AsyncMock()
+        mock_database = MagicMock()
+        mock_database.__getitem__ = MagicMock(side_effect=lambda name: collections[name])
+
+        with patch("app.api.ai_integration.qa_service") as mock_qa_svc, \
+             patch("app.api.ai_integration.question_service") as mock_q_svc, \
+             patch("app.api.ai_integration.ai_service") as mock_ai_svc, \
+             patch("app.database.db") as mock_db_inst:
+            mock_qa_svc.get_qa = AsyncMock(return_value=make_qa_doc())
+            mock_q_svc.get_replies_for_clustering = AsyncMock(return_value=replies)
+            mock_ai_svc.perform_qa_answer_clustering = AsyncMock(return_value=ai_result)
+            mock_db_inst.get_db.return_value = mock_database
+            result = await generate_course_clusters(request)
+
+        assert result["success"] is True
+        collections["clusters"].bulk_write.assert_awaited_once()
+        collections["questions"].bulk_write.assert_awaited_once()
+        assert len(collections["clusters"].bulk_write.call_args[0][0]) == 2
+        assert len(collections["questions"].bulk_write.call_args[0][0]) == 2
+        collections["clusters"].insert_one.assert_not_called()
+        collections["questions"].update_many.assert_not_called()
+
+
+class TestClusterSummaryKeywords:
+    """聚類摘要的熱門關鍵字由資料庫聚合計算"""
+
+    @pytest.mark.asyncio
+    async def test_top_keywords_computed_by_aggregation(self):
+        from app.api.ai_integration import get_clusters_summary
+
+        cluster_a, cluster_b = ObjectId(), ObjectId()
+        clusters = MagicMock()
+        clusters.find = MagicMock(return_value=MagicMock(to_list=AsyncMock(return_value=[
+            {"_id": cluster_a, "topic_label": "A"},
+            {"_id": cluster_b, "topic_label": "B", "keywords": ["預設"]},
+        ])))
+        stats = [{"_id": str(cluster_a), "count": 3, "avg_difficulty": 0.5}]
+        keyword_stats = [{"_id": str(cluster_a), "top": ["迴圈", "陣列"]}]
+        questions = MagicMock()
+        questions.aggregate = MagicMock(side_effect=[
+            MagicMock(to_list=AsyncMock(return_value=stats)),
+            MagicMock(to_list=AsyncMock(return_value=keyword_stats)),
+        ])
+        mock_database = MagicMock()
+        mock_database.__getitem__ = MagicMock(
+            side_effect=lambda name: {"clusters": clusters, "questions": questions}[name]
+        )
+
+        with patch("app.database.db") as mock_db_inst:
+            mock_db_inst.get_db.return_value = mock_database
+            result = await get_clusters_summary(course_id=str(ObjectId()), qa_id=None)
+
+        keywords_pipeline = questions.aggregate.call_args_list[1][0][0]
+        stages = [next(iter(stage)) for stage in keywords_pipeline]
+        assert stages == ["$match", "$project", "$unwind", "$match", "$group", "$sort", "$group", "$project"]
+        assert keywords_pipeline[-1] == {"$project": {"top": {"$slice": ["$top", 5]}}}
+        assert "keywords" not in questions.aggregate.call_args_list[0][0][0][1]["$group"]
+        # 兩個聚合皆以 $type 篩選已分群作答並指定對應的部分索引
+        for agg_call in questions.aggregate.call_args_list:
+            assert agg_call[0][0][0]["$match"]["cluster_id"] == {"$type": "string"}
+            assert agg_call[1]["hint"] == "course_qa_clustered"
+
+        data = result["data"]
+        assert data[0]["top_keywords"] == ["迴圈", "陣列"]
+        assert data[0]["question_count"] == 3
+        assert data[1]["top_keywords"] == ["預設"]
@@ -0,0 +1,105 @@
+"""
+課程服務測試
+驗證課程啟用狀態的快取與失效，以及重複課程代碼的處理
+"""
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from bson import ObjectId
+
+
+def make_db(collection):
+    mock_db = MagicMock()
+    mock_db.__getitem__ = MagicMock(return_value=collection)
+    return mock_db
+
+
+class TestIsCourseActive:
+
+    @pytest.mark.asyncio
+    async def test_repeated_checks_query_once(self):
+        """同一課程的啟用檢查在快取期間只查詢一次"""
+        from app.services.course_service import CourseService
+
+        course_id = str(ObjectId())
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value={"_id": ObjectId(course_id), "is_active": True})
+        service = CourseService()
+
+        with patch("app.services.course_service.db") as patched_db:
+            patched_db.get_db.return_value = make_db(collection)
+            assert await service.is_course_active(course_id) is True
+            assert await service.is_course_active(course_id) is True
+
+        collection.find_one.assert_awaited_once()
+        assert collection.find_one.call_args[0][1] == {"is_active": 1}
+
+    @pytest.mark.asyncio
+    async def test_update_refreshes_cached_state(self):
+        """課程更新 (含軟刪除) 後以更新後的文件刷新啟用狀態"""
+        from app.services.course_service import CourseService
+
+        course_id = str(ObjectId())
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value={"is_active": True})
+        collection.find_one_and_update = AsyncMock(return_value={"_id": ObjectId(course_id), "is_active": False})
+        service = CourseService()
+
+        with patch("app.services.course_service.db") as patched_db:
+            patched_db.get_db.return_value = make_db(collection)
+            assert await service.is_course_active(course_id) is True
+            course = await service.update_course(course_id, {"is_active": False})
+            assert await service.is_course_active(course_id) is False
+
+        # 更新後直接取回文件，不再另外查詢
+        assert course == {"_id": course_id, "is_active": False}
+        collection.find_one.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_check_during_update_does_not_restore_stale_state(self):
+        """寫入期間並發的啟用檢查讀到舊狀態，寫入完成後仍以新狀態為準"""
+        from app.services.course_service import CourseService
+
+        course_id = str(ObjectId())
+        service = CourseService()
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value={"is_active": True})
+
+        async def slow_update(*args, **kwargs):
+            # 寫入尚未完成時，另一個請求讀到舊的啟用狀態並寫入快取
+            assert await service.is_course_active(course_id) is True
+            return {"_id": ObjectId(course_id), "is_active": False}
+
+        collection.find_one_and_update = AsyncMock(side_effect=slow_update)
+
+        with patch("app.services.course_service.db") as patched_db:
+            patched_db.get_db.return_value = make_db(collection)
+            await service.update_course(course_id, {"is_active": False})
+            assert await service.is_course_active(course_id) is False
+
+    @pytest.mark.asyncio
+    async def test_missing_course_is_inactive(self):
+        from app.services.course_service import CourseService
+
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value=None)
+
+        with patch("app.services.course_service.db") as patched_db:
+            patched_db.get_db.return_value = make_db(collection)
+            assert await CourseService().is_course_active(str(ObjectId())) is False
+
+
+class TestCreateCourse:
+
+    def test_duplicate_course_returns_conflict(self):
+        """已有啟用中的同名課程時回傳 409"""
+        from pymongo.errors import DuplicateKeyError
+        from fastapi.testclient import TestClient
+        from app.main import app
+        from app.services.course_service import course_service
+
+        payload = {"course_code": "CS101", "course_name": "程式設計", "semester": "113-1"}
+        with patch.object(course_service, "create_course", AsyncMock(side_effect=DuplicateKeyError("dup"))), \
+             patch.object(course_service, "update_course", AsyncMock(side_effect=DuplicateKeyError("dup"))):
+            client = TestClient(app)
+            assert client.post("/courses/", json=payload).status_code == 409
+            assert client.patch(f"/courses/{ObjectId()}", json={"semester": "113-1"}).status_code == 409
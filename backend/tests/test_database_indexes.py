@@ -17,14 +17,19 @@ class TestEnsureIndexes:
         mock_questions = AsyncMock()
         mock_clusters = AsyncMock()
         mock_qas = AsyncMock()
+        mock_courses = AsyncMock()
+        mock_courses.index_information = AsyncMock(return_value={})
         mock_line_users = AsyncMock()
+        mock_line_messages = AsyncMock()
 
         def get_collection(name):
             collections = {
                 "questions": mock_questions,
+                "courses": mock_courses,
                 "clusters": mock_clusters,
                 "qas": mock_qas,
                 "line_users": mock_line_users,
+                "line_messages": mock_line_messages,
             }
             return collections.get(name, AsyncMock())
 
@@ -64,6 +69,35 @@ class TestEnsureIndexes:
         line_users_index_args = [str(c) for c in line_users_calls]
         assert any("current_course_id" in a for a in line_users_index_args)
 
+        # line_messages collection indexes
+        line_messages_index_args = [str(c) for c in mock_line_messages.create_index.call_args_list]
+        assert any("created_at" in a and "direction" in a for a in line_messages_index_args)
+        assert any("created_at" in a and "user_id" in a for a in line_messages_index_args)
+        assert any("pseudonym" in a for a in line_messages_index_args)
+
+        # questions: course_id + original_message_id for LINE stats
+        assert any("original_message_id" in a for a in questions_index_args)
+        # questions: course_id + review_status / created_at for statistics and date-range exports
+        assert any("course_id" in a and "review_status" in a for a in questions_index_args)
+        assert any("course_id" in a and "created_at" in a for a in questions_index_args)
+        # questions: named course_id + status index hinted by the course list statistics
+        assert any("'status'" in a and "course_status" in a for a in questions_index_args)
+        # questions: export filters by class / cluster sorted by created_at
+        assert any("cluster_id" in a and "created_at" in a for a in questions_index_args)
+        assert any("class_id" in a and "created_at" in a for a in questions_index_args)
+        assert any("reply_to_qa_id" in a and "created_at" in a for a in questions_index_args)
+        # questions: approved, unclustered answers fetched by the clustering job
+        assert any("reply_to_qa_id" in a and "review_status" in a and "cluster_id" in a for a in questions_index_args)
+        # questions: partial index over clustered answers for the cluster summary
+        assert any("course_qa_clustered" in a and "partialFilterExpression" in a for a in questions_index_args)
+        # qas: course_id + created_at for the Q&A export sort
+        assert any("course_id" in a and "created_at" in a for a in qas_index_args)
+        # qas: list filters (is_published / class_id) followed by the created_at sort
+        assert any("is_published" in a and "created_at" in a for a in qas_index_args)
+        assert any("class_id" in a and "created_at" in a for a in qas_index_args)
+        # clusters: course_id + question_count for the top clusters summary
+        assert any("course_id" in a and "question_count" in a for a in clusters_index_args)
+
     @pytest.mark.asyncio
     async def test_ensure_indexes_correct_count(self):
         """Verify the correct number of indexes are created per collection"""
@@ -72,14 +106,21 @@ class TestEnsureIndexes:
         mock_questions = AsyncMock()
         mock_clusters = AsyncMock()
         mock_qas = AsyncMock()
+        mock_courses = AsyncMock()
+        mock_courses.index_information = AsyncMock(return_value={})
         mock_line_users = AsyncMock()
+        mock_line_messages = AsyncMock()
+        mock_announcements = AsyncMock()
 
         def get_collection(name):
             collections = {
                 "questions": mock_questions,
+                "courses": mock_courses,
                 "clusters": mock_clusters,
                 "qas": mock_qas,
                 "line_users": mock_line_users,
+                "line_messages": mock_line_messages,
+                "announcements": mock_announcements,
             }
             return collections.get(name, AsyncMock())
 
@@ -89,14 +130,119 @@ class TestEnsureIndexes:
         with patch.object(Database, "get_db", return_value=mock_db):
             await Database.ensure_indexes()
 
-        # questions: course_id, reply_to_qa_id, cluster_id, review_status, compound(reply_to_qa_id, pseudonym) = 5
-        assert mock_questions.create_index.call_count == 5
+        # questions: course_id, reply_to_qa_id, cluster_id, review_status,
+        # compound(reply_to_qa_id, pseudonym), compound(course_id, original_message_id),
+        # compound(course_id, review_status), compound(course_id, created_at), compound(course_id, status),
+        # compound(course_id, cluster_id, created_at), compound(course_id, class_id, created_at),
+        # compound(reply_to_qa_id, created_at), partial(course_id, reply_to_qa_id, cluster_id),
+        # compound(reply_to_qa_id, review_status, cluster_id) = 14
+        assert mock_questions.create_index.call_count == 14
+
+        # clusters: course_id, qa_id, compound(course_id, qa_id), compound(course_id, question_count) = 4
+        assert mock_clusters.create_index.call_count == 4
+
+        # qas: course_id, compound(course_id, allow_replies, expires_at), compound(course_id, created_at),
+        # compound(course_id, is_published, created_at), compound(course_id, class_id, created_at) = 5
+        assert mock_qas.create_index.call_count == 5
 
-        # clusters: course_id, qa_id, compound(course_id, qa_id) = 3
-        assert mock_clusters.create_index.call_count == 3
+        # announcements: compound(course_id, is_published, created_at), compound(course_id, class_id, created_at) = 2
+        assert mock_announcements.create_index.call_count == 2
 
-        # qas: course_id, compound(course_id, allow_replies, expires_at) = 2
-        assert mock_qas.create_index.call_count == 2
+        # courses: partial unique compound(course_code, semester) over active courses = 1
+        mock_courses.create_index.assert_called_once_with(
+            [("course_code", 1), ("semester", 1)],
+            name="course_code_semester_active",
+            unique=True,
+            partialFilterExpression={"is_active": True},
+        )
 
         # line_users: current_course_id = 1
         assert mock_line_users.create_index.call_count == 1
+
+        # line_messages: created_at, compound(direction, created_at), compound(user_id, created_at), pseudonym = 4
+        assert mock_line_messages.create_index.call_count == 4
+
+    @pytest.mark.asyncio
+    async def test_duplicate_courses_do_not_block_startup(self):
+        """既有課程重複導致唯一索引建立失敗時，記錄重複組合並繼續建立其餘索引"""
+        from pymongo.errors import OperationFailure
+        from app.database import Database
+
+        mock_courses = AsyncMock()
+        mock_courses.index_information = AsyncMock(return_value={"_id_": {"key": [("_id", 1)]}})
+        mock_courses.create_index = AsyncMock(side_effect=OperationFailure("E11000 duplicate key", 11000))
+        mock_courses.aggregate = MagicMock(return_value=MagicMock(to_list=AsyncMock(return_value=[
+            {"_id": {"course_code": "CS101", "semester": "113-1"}, "ids": ["a", "b"], "count": 2}
+        ])))
+        mock_line_messages = AsyncMock()
+
+        def get_collection(name):
+            return {"courses": mock_courses, "line_messages": mock_line_messages}.get(name, AsyncMock())
+
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=get_collection)
+
+        with patch.object(Database, "get_db", return_value=mock_db):
+            await Database.ensure_indexes()
+
+        mock_courses.aggregate.assert_called_once()
+        assert mock_courses.aggregate.call_args[0][0][0] == {"$match": {"is_active": True}}
+        mock_courses.drop_index.assert_not_called()
+        assert mock_line_messages.create_index.call_count == 4
+
+    @pytest.mark.asyncio
+    async def test_legacy_unique_course_index_replaced(self):
+        """舊版不分啟用狀態的唯一索引先移除，再建立只收錄啟用課程的部分索引"""
+        from app.database import Database
+
+        mock_courses = AsyncMock()
+        mock_courses.index_information = AsyncMock(return_value={
+            "_id_": {"key": [("_id", 1)]},
+            "course_code_1_semester_1": {"key": [("course_code", 1), ("semester", 1)], "unique": True},
+        })
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: mock_courses if name == "courses" else AsyncMock())
+
+        with patch.object(Database, "get_db", return_value=mock_db):
+            await Database.ensure_indexes()
+
+        mock_courses.drop_index.assert_awaited_once_with("course_code_1_semester_1")
+        assert mock_courses.create_index.call_args[1]["partialFilterExpression"] == {"is_active": True}
+
+
+class TestConnectDb:
+
+    @pytest.mark.asyncio
+    async def test_connect_configures_pool_and_pings(self):
+        """連線時設定連線池大小，並以 ping 預先建立連線"""
+        from app import database as module
+
+        client = MagicMock()
+        client.admin.command = AsyncMock(return_value={"ok": 1})
+        with patch.object(module, "AsyncIOMotorClient", return_value=client) as client_cls, \
+             patch.object(module.Database, "client", None), patch.object(module.Database, "db", None):
+            await module.Database.connect_db()
+
+        kwargs = client_cls.call_args[1]
+        assert kwargs["maxPoolSize"] == module.settings.MONGODB_MAX_POOL_SIZE
+        assert kwargs["minPoolSize"] == module.settings.MONGODB_MIN_POOL_SIZE
+        client.admin.command.assert_awaited_once_with("ping")
+
+    @pytest.mark.asyncio
+    async def test_connect_reuses_open_client_until_closed(self):
+        """已連線時沿用同一個客戶端，關閉後才重新建立"""
+        from app import database as module
+
+        client = MagicMock()
+        client.admin.command = AsyncMock(return_value={"ok": 1})
+        with patch.object(module, "AsyncIOMotorClient", return_value=client) as client_cls, \
+             patch.object(module.Database, "client", None), patch.object(module.Database, "db", None):
+            await module.Database.connect_db()
+            await module.Database.connect_db()
+            assert client_cls.call_count == 1
+
+            await module.Database.close_db()
+            client.close.assert_called_once()
+            with pytest.raises(RuntimeError):
+                module.Database.get_db()
+
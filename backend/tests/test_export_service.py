@@ -0,0 +1,439 @@
+"""
+匯出服務測試
+驗證 CSV 匯出內容與查詢方式
+"""
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime
+
+
+@pytest.fixture(autouse=True)
+def clear_report_cache():
+    """統計與聚類匯出經過報表快取，每個測試前後清空避免互相影響"""
+    from app.utils.cache import report_cache
+    report_cache.clear()
+    yield
+    report_cache.clear()
+
+
+def make_cursor(docs):
+    cursor = MagicMock()
+    cursor.sort = MagicMock(return_value=cursor)
+    cursor.hint = MagicMock(return_value=cursor)
+    cursor.batch_size = MagicMock(return_value=cursor)
+    cursor.to_list = AsyncMock(return_value=docs)
+    cursor.__aiter__.return_value = docs
+    return cursor
+
+
+class TestCsvEncoding:
+
+    def test_rows_to_csv_matches_csv_writer(self):
+        """手動組字串的結果須與 csv.writer (excel 方言) 完全一致"""
+        import csv
+        import io
+        from app.services.export_service import _rows_to_csv
+
+        rows = [
+            ["plain", 'has "quote"', "a,b", "line\nbreak", "cr\rhere", "", None, 3, 0.5],
+            ["中文", " leading space", "'single'", '""', "tab\tfield", "end,", "\r\n", 0, "是"],
+        ]
+        expected = io.StringIO()
+        csv.writer(expected).writerows(rows)
+
+        assert _rows_to_csv(rows) == expected.getvalue()
+
+
+class TestExportQuestions:
+
+    @pytest.mark.asyncio
+    async def test_export_questions_csv_content(self):
+        """CSV 欄位、狀態標籤與特殊字元跳脫維持原本格式"""
+        from app.services.export_service import ExportService
+
+        docs = [
+            {
+                "student_id": "111400000",
+                "question_text": 'a,"b"',
+                "review_status": "approved",
+                "created_at": datetime(2024, 1, 1),
+            },
+            {"question_text": "x", "review_status": "pending"},
+        ]
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor(docs))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            csv_text = await ExportService().export_questions_to_csv("course1")
+
+        lines = csv_text.split("\r\n")
+        assert lines[0] == "學號,學生作答內容,批閱狀態,老師評語,AI 分群名稱,作答時間"
+        assert lines[1].startswith('111400000,"a,""b""",通過,,,')
+        assert lines[2] == ",x,待批閱,,,"
+
+    @pytest.mark.asyncio
+    async def test_questions_batch_missing_and_empty_fields(self):
+        """整批取欄時缺少的欄位輸出空白，空字串狀態視為待批閱，未知狀態原樣輸出"""
+        from app.services.export_service import ExportService
+
+        docs = [
+            {"question_text": "a", "review_status": "", "cluster_id": "c1", "created_at": datetime(2024, 1, 1, 8, 0, 5)},
+            {"student_id": None, "question_text": "b", "review_status": "custom", "feedback": None, "cluster_id": "gone"},
+        ]
+        csv_text = await ExportService()._questions_batch_to_csv(None, docs, {"c1": "主題", "gone": ""})
+
+        assert csv_text == ",a,待批閱,,主題,2024-01-01 08:00:05\r\n,b,custom,,,\r\n"
+
+    @pytest.mark.asyncio
+    async def test_export_questions_csv_empty_has_header(self):
+        from app.services.export_service import ExportService
+
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor([]))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            csv_text = await ExportService().export_questions_to_csv("course1")
+
+        assert csv_text == "學號,學生作答內容,批閱狀態,老師評語,AI 分群名稱,作答時間\r\n"
+
+    @pytest.mark.asyncio
+    async def test_export_questions_date_range_is_half_open(self):
+        """日期區間與其他條件合併為同一個查詢條件，結束日期轉為隔日零時的 $lt"""
+        from app.services.export_service import ExportService
+
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor([]))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            await ExportService().export_questions_to_csv(
+                "course1", class_id="A",
+                start_date=datetime(2024, 1, 1), end_date=datetime(2024, 1, 7),
+            )
+
+        query = questions.find.call_args[0][0]
+        assert query == {
+            "course_id": "course1",
+            "class_id": "A",
+            "created_at": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 1, 8)},
+        }
+
+
+class TestExportStatistics:
+
+    @pytest.mark.asyncio
+    async def test_export_statistics_uses_single_facet_aggregate(self):
+        """總數、難度與批閱狀態以單一 $facet 聚合取得，不再另外 count_documents"""
+        from app.services.export_service import ExportService
+
+        facet_result = [{
+            "total": [{"count": 4}],
+            "by_difficulty": [{"_id": "EASY", "count": 1}, {"_id": "HARD", "count": 2}],
+            "by_review_status": [{"_id": "approved", "count": 3}, {"_id": "pending", "count": 1}],
+        }]
+        agg_cursor = MagicMock()
+        agg_cursor.to_list = AsyncMock(return_value=facet_result)
+        questions = MagicMock()
+        questions.aggregate = MagicMock(return_value=agg_cursor)
+        questions.count_documents = AsyncMock()
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            csv_text = await ExportService().export_statistics_to_csv("course1")
+
+        assert questions.aggregate.call_count == 1
+        pipeline = questions.aggregate.call_args[0][0]
+        assert pipeline[1] == {"$project": {"_id": 0, "difficulty_level": 1, "review_status": 1}}
+        assert "$facet" in pipeline[2]
+        agg_kwargs = questions.aggregate.call_args[1]
+        assert agg_kwargs["allowDiskUse"] is False
+        assert agg_kwargs["maxTimeMS"] > 0
+        questions.count_documents.assert_not_called()
+
+        assert "總收集回覆數,4" in csv_text
+        assert "簡單,1" in csv_text
+        assert "困難,2" in csv_text
+        assert "通過,3" in csv_text
+        assert "待批閱,1" in csv_text
+
+
+class TestExportCache:
+
+    @pytest.mark.asyncio
+    async def test_statistics_csv_cached_per_filter_until_invalidated(self):
+        """相同條件的統計匯出命中快取，不同條件分開快取，作答異動後重新查詢"""
+        from app.services.export_service import ExportService
+        from app.utils.cache import invalidate_course_reports
+
+        agg_cursor = MagicMock()
+        agg_cursor.to_list = AsyncMock(return_value=[{"total": [{"count": 1}]}])
+        questions = MagicMock()
+        questions.aggregate = MagicMock(return_value=agg_cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+        service = ExportService()
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            first = await service.export_statistics_to_csv("course1")
+            assert await service.export_statistics_to_csv("course1") == first
+            assert questions.aggregate.call_count == 1
+
+            await service.export_statistics_to_csv("course1", class_id="A")
+            assert questions.aggregate.call_count == 2
+
+            invalidate_course_reports("course1")
+            await service.export_statistics_to_csv("course1")
+            await service.export_statistics_to_csv("course1", class_id="A")
+            assert questions.aggregate.call_count == 4
+
+    @pytest.mark.asyncio
+    async def test_clusters_csv_cached(self):
+        from app.services.export_service import ExportService
+
+        clusters = MagicMock()
+        clusters.find = MagicMock(side_effect=lambda *a, **k: make_cursor([{"_id": "c1", "topic_label": "A"}]))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=clusters)
+        service = ExportService()
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            first = await service.export_clusters_to_csv("course1")
+            second = await service.export_clusters_to_csv("course1")
+
+        assert first == second and "c1,A" in first
+        assert clusters.find.call_count == 1
+
+
+class TestStreamingExport:
+
+    @pytest.mark.asyncio
+    async def test_stream_questions_csv_yields_header_then_batches(self, monkeypatch):
+        """標題列先輸出，資料依批次分段輸出"""
+        from app.services import export_service as module
+
+        monkeypatch.setattr(module, "CSV_BATCH_SIZE", 2)
+        docs = [{"question_text": f"q{i}", "review_status": "approved"} for i in range(5)]
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor(docs))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            chunks = [c async for c in module.ExportService().stream_questions_csv("course1")]
+
+        assert chunks[0] == "學號,學生作答內容,批閱狀態,老師評語,AI 分群名稱,作答時間\r\n"
+        # 5 筆資料、每批 2 筆 -> 3 段
+        assert len(chunks) == 4
+        assert "".join(chunks[1:]).count("\r\n") == 5
+
+    @pytest.mark.asyncio
+    async def test_stream_qas_csv_yields_header_before_query(self):
+        """標題列在查詢資料庫之前輸出"""
+        from app.services import export_service as module
+
+        qas = MagicMock()
+        qas.find = MagicMock(return_value=make_cursor([]))
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor([]))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: {"qas": qas, "questions": questions}[name])
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            stream = module.ExportService().stream_qas_csv("course1")
+            header = await stream.__anext__()
+            qas.find.assert_not_called()
+            rest = [c async for c in stream]
+
+        assert header == "任務問題,核心觀念,學號,學生作答,批閱狀態,老師評語,作答時間\r\n"
+        assert rest == []
+
+    @pytest.mark.asyncio
+    async def test_stream_qas_csv_rows_match_csv_writer(self):
+        """Q&A 明細逐列組字串的結果與 csv.writer 相同"""
+        import csv
+        import io
+        from bson import ObjectId
+        from app.services import export_service as module
+
+        qa_id = ObjectId()
+        qa_docs = [
+            {"_id": qa_id, "question": 'Q "1", part a', "core_concept": "line\nbreak"},
+            {"_id": ObjectId(), "question": "Q2", "answer": "A2"},
+        ]
+        replies = [
+            {
+                "reply_to_qa_id": str(qa_id), "student_id": "111400000",
+                "question_text": "ans, with comma", "review_status": "rejected",
+                "feedback": 'say "why"', "created_at": datetime(2024, 1, 2, 3, 4, 5),
+            },
+            {"reply_to_qa_id": str(qa_id), "question_text": "plain", "review_status": "custom,status"},
+        ]
+        qas = MagicMock()
+        qas.find = MagicMock(return_value=make_cursor(qa_docs))
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor(replies))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: {"qas": qas, "questions": questions}[name])
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            csv_text = await module.ExportService().export_qas_to_csv("course1")
+
+        expected = io.StringIO()
+        csv.writer(expected).writerows([
+            module.QA_CSV_COLUMNS,
+            ['Q "1", part a', "line\nbreak", "111400000", "ans, with comma", "退回", 'say "why"', "2024-01-02 03:04:05"],
+            ['Q "1", part a', "line\nbreak", "", "plain", "custom,status", "", ""],
+            ["Q2", "A2", "", "（無學生回覆）", "", "", ""],
+        ])
+        assert csv_text == expected.getvalue()
+
+    @pytest.mark.asyncio
+    async def test_stream_qas_csv_queries_replies_per_qa_batch(self, monkeypatch):
+        """任務依批次處理，每批以一次 $in 查詢回覆，不先載入全部任務"""
+        from bson import ObjectId
+        from app.services import export_service as module
+
+        monkeypatch.setattr(module, "QA_BATCH_SIZE", 2)
+        qa_docs = [{"_id": ObjectId(), "question": f"Q{i}"} for i in range(5)]
+        qa_cursor = make_cursor(qa_docs)
+        qas = MagicMock()
+        qas.find = MagicMock(return_value=qa_cursor)
+        questions = MagicMock()
+        questions.find = MagicMock(side_effect=lambda *a, **k: make_cursor([]))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: {"qas": qas, "questions": questions}[name])
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            chunks = [c async for c in module.ExportService().stream_qas_csv("course1")]
+
+        qa_cursor.to_list.assert_not_called()
+        assert questions.find.call_count == 3
+        batch_ids = [c.args[0]["reply_to_qa_id"]["$in"] for c in questions.find.call_args_list]
+        assert batch_ids[0] == [str(qa_docs[0]["_id"]), str(qa_docs[1]["_id"])]
+        assert len(chunks) == 4
+        assert "".join(chunks[1:]).count("（無學生回覆）") == 5
+
+
+class TestExportClusters:
+
+    @pytest.mark.asyncio
+    async def test_cluster_keywords_column(self):
+        """關鍵字以逗號串接，缺少或空陣列時輸出空白"""
+        from bson import ObjectId
+        from app.services import export_service as module
+
+        ids = [ObjectId(), ObjectId(), ObjectId()]
+        docs = [
+            {"_id": ids[0], "topic_label": "A", "question_count": 3, "avg_difficulty": 0.5,
+             "keywords": ["迴圈", "陣列"], "is_locked": True},
+            {"_id": ids[1], "topic_label": "B", "keywords": []},
+            {"_id": ids[2], "topic_label": "C"},
+        ]
+        clusters = MagicMock()
+        clusters.find = MagicMock(return_value=make_cursor(docs))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=clusters)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            csv_text = await module.ExportService().export_clusters_to_csv("course1")
+
+        lines = csv_text.split("\r\n")
+        assert lines[1] == f'{ids[0]},A,,3,0.50,"迴圈, 陣列",是'
+        assert lines[2] == f"{ids[1]},B,,0,0.00,,否"
+        assert lines[3] == f"{ids[2]},C,,0,0.00,,否"
+
+
+class TestExportProjections:
+
+    @pytest.mark.asyncio
+    async def test_exports_project_only_output_fields(self):
+        """匯出查詢僅取輸出欄位"""
+        from bson import ObjectId
+        from app.services import export_service as module
+
+        clusters = MagicMock()
+        clusters.find = MagicMock(return_value=make_cursor([]))
+        qas = MagicMock()
+        qas.find = MagicMock(return_value=make_cursor([{"_id": ObjectId(), "question": "Q"}]))
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=make_cursor([]))
+        collections = {"clusters": clusters, "qas": qas, "questions": questions}
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: collections[name])
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            await module.ExportService().export_clusters_to_csv("course1")
+            await module.ExportService().export_qas_to_csv("course1")
+
+        assert clusters.find.call_args[0][1] == module.CLUSTER_EXPORT_PROJECTION
+        assert qas.find.call_args[0][1] == module.QA_EXPORT_PROJECTION
+        reply_projection = questions.find.call_args[0][1]
+        assert reply_projection["_id"] == 0
+        assert "reply_to_qa_id" in reply_projection and "question_text" in reply_projection
+
+
+class TestExportIndexHints:
+
+    @pytest.mark.parametrize("filters,expected", [
+        ({"qa_id": "qa1", "class_id": "A"}, "QUESTIONS_EXPORT_QA_INDEX"),
+        ({"cluster_id": "c1", "class_id": "A"}, "QUESTIONS_EXPORT_CLUSTER_INDEX"),
+        ({"class_id": "A"}, "QUESTIONS_EXPORT_CLASS_INDEX"),
+        ({}, "QUESTIONS_EXPORT_COURSE_INDEX"),
+    ])
+    @pytest.mark.asyncio
+    async def test_questions_export_hints_matching_index(self, filters, expected):
+        """依篩選條件 hint 等值欄位在前、created_at 在後的複合索引"""
+        from app import database
+        from app.services import export_service as module
+
+        cursor = make_cursor([])
+        questions = MagicMock()
+        questions.find = MagicMock(return_value=cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            await module.ExportService().export_questions_to_csv("course1", **filters)
+
+        index = getattr(database, expected)
+        cursor.hint.assert_called_once_with(index)
+        cursor.batch_size.assert_called_once_with(module.settings.MONGODB_EXPORT_CURSOR_BATCH_SIZE)
+        assert index[-1] == ("created_at", -1)
+
+    @pytest.mark.asyncio
+    async def test_qas_export_hints_course_created_index(self):
+        from app.database import QAS_EXPORT_COURSE_INDEX
+        from app.services import export_service as module
+
+        qa_cursor = make_cursor([])
+        qas = MagicMock()
+        qas.find = MagicMock(return_value=qa_cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=qas)
+
+        with patch("app.services.export_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            await module.ExportService().export_qas_to_csv("course1", class_id="A")
+
+        qa_cursor.hint.assert_called_once_with(QAS_EXPORT_COURSE_INDEX)
+        # 游標批次大小與每批 $in 查詢的任務數分開設定
+        qa_cursor.batch_size.assert_called_once_with(module.settings.MONGODB_EXPORT_CURSOR_BATCH_SIZE)
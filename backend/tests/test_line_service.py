@@ -0,0 +1,320 @@
+"""
+LINE 服務測試
+驗證回覆與推播共用 LINE API 客戶端，以及推播名單的分批讀取
+"""
+import pytest
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+
+
+class TestMessagingApiClient:
+
+    @pytest.mark.asyncio
+    async def test_replies_reuse_single_api_client_until_closed(self):
+        """多次回覆共用同一個 AsyncApiClient，關閉後才重新建立"""
+        from app.services import line_service as module
+
+        api_client = MagicMock()
+        api_client.close = AsyncMock()
+        messaging_api = MagicMock()
+        messaging_api.reply_message = AsyncMock()
+        service = module.LineService()
+
+        with patch.object(module.settings, "LINE_CHANNEL_ACCESS_TOKEN", "token"), \
+             patch.object(module, "AsyncApiClient", return_value=api_client) as client_cls, \
+             patch.object(module, "AsyncMessagingApi", return_value=messaging_api):
+            await service._reply_text("t1", "a")
+            await service._reply_text("t2", "b")
+            assert client_cls.call_count == 1
+            assert messaging_api.reply_message.await_count == 2
+
+            await service.aclose()
+            api_client.close.assert_awaited_once()
+
+            await service._reply_text("t3", "c")
+            assert client_cls.call_count == 2
+
+
+class TestBroadcast:
+
+    @pytest.mark.asyncio
+    async def test_students_streamed_into_multicast_batches(self):
+        """學生名單以游標串流，每滿 500 人送出一次 multicast"""
+        from app.services import line_service as module
+
+        users = [{"user_id": f"U{i}"} for i in range(501)] + [{}]
+
+        class Cursor:
+            def batch_size(self, n):
+                self.n = n
+                return self
+
+            def __aiter__(self):
+                return self._iter()
+
+            async def _iter(self):
+                for user in users:
+                    yield user
+
+        cursor = Cursor()
+        line_users = MagicMock()
+        line_users.find = MagicMock(return_value=cursor)
+        messaging_api = MagicMock()
+        messaging_api.multicast = AsyncMock()
+        service = module.LineService()
+
+        with patch.object(module.settings, "LINE_CHANNEL_ACCESS_TOKEN", "token"), \
+             patch.object(module, "db") as patched_db, \
+             patch.object(service, "_get_messaging_api", AsyncMock(return_value=messaging_api)):
+            patched_db.get_db.return_value = {"line_users": line_users}
+            await service.broadcast_announcement_to_course("course1", {"title": "t", "content": "c"})
+
+        assert line_users.find.call_args[0] == ({"current_course_id": "course1"}, {"_id": 0, "user_id": 1})
+        assert cursor.n == module.MULTICAST_BATCH_SIZE
+        sizes = [len(c[0][0].to) for c in messaging_api.multicast.call_args_list]
+        assert sizes == [500, 1]
+
+    @pytest.mark.asyncio
+    async def test_course_without_students_skips_api(self):
+        from app.services import line_service as module
+
+        cursor = MagicMock()
+        cursor.batch_size.return_value = cursor
+        cursor.__aiter__.return_value = []
+        service = module.LineService()
+
+        with patch.object(module.settings, "LINE_CHANNEL_ACCESS_TOKEN", "token"), \
+             patch.object(module, "db") as patched_db, \
+             patch.object(service, "_get_messaging_api", AsyncMock()) as get_api:
+            patched_db.get_db.return_value = {"line_users": MagicMock(find=MagicMock(return_value=cursor))}
+            await service.broadcast_qa_to_course("course1", {"question": "q"})
+
+        get_api.assert_not_called()
+
+
+class TestHandleTextMessage:
+
+    @staticmethod
+    def make_event(text, message_id="m1"):
+        event = MagicMock()
+        event.source.user_id = "U1"
+        event.message.text = text
+        event.message.id = message_id
+        event.reply_token = "token"
+        return event
+
+    @pytest.mark.asyncio
+    async def test_message_log_written_in_background(self):
+        """訊息紀錄於背景寫入，指令處理不等待寫入完成"""
+        import asyncio
+        from app.services import line_service as module
+
+        insert_started = asyncio.Event()
+        release_insert = asyncio.Event()
+
+        async def insert_many(docs, ordered=True):
+            insert_started.set()
+            await release_insert.wait()
+
+        messages = MagicMock()
+        messages.insert_many = insert_many
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=messages)
+
+        service = module.LineService()
+        with patch.object(module, "db") as patched_db, \
+             patch.object(service, "_handle_unbind_course", AsyncMock()) as unbind, \
+             patch.object(service, "notify_message_recorded") as notify:
+            patched_db.get_db.return_value = mock_db
+            await service.handle_text_message(self.make_event("解除綁定"))
+            unbind.assert_awaited_once_with("U1", "token")
+            notify.assert_not_called()
+
+            await insert_started.wait()
+            release_insert.set()
+            await service.aclose()
+
+        notify.assert_called_once()
+        assert notify.call_args[0][0] == "received"
+        assert not service._background_tasks
+
+    @pytest.mark.asyncio
+    async def test_burst_of_messages_written_in_one_insert_many(self):
+        """同一時段收到的多則訊息合併為一次 insert_many"""
+        from app.services import line_service as module
+
+        messages = MagicMock()
+        messages.insert_many = AsyncMock()
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=messages)
+
+        service = module.LineService()
+        with patch.object(module, "db") as patched_db, \
+             patch.object(service, "_handle_unbind_course", AsyncMock()), \
+             patch.object(service, "notify_message_recorded") as notify:
+            patched_db.get_db.return_value = mock_db
+            for i in range(3):
+                await service.handle_text_message(self.make_event("解除綁定", f"m{i}"))
+            await service.aclose()
+
+        messages.insert_many.assert_awaited_once()
+        docs = messages.insert_many.call_args[0][0]
+        assert [d["line_message_id"] for d in docs] == ["m0", "m1", "m2"]
+        assert messages.insert_many.call_args[1]["ordered"] is False
+        assert notify.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_partial_write_failure_notifies_written_messages_only(self):
+        """部分紀錄寫入失敗時，只對成功寫入的紀錄推送統計增量"""
+        from pymongo.errors import BulkWriteError
+        from app.services import line_service as module
+
+        error = BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}]})
+        messages = MagicMock()
+        messages.insert_many = AsyncMock(side_effect=error)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=messages)
+
+        service = module.LineService()
+        docs = [{"line_message_id": f"m{i}", "created_at": datetime(2026, 1, 1)} for i in range(3)]
+        with patch.object(module, "db") as patched_db, \
+             patch.object(service, "notify_message_recorded") as notify:
+            patched_db.get_db.return_value = mock_db
+            await service._record_received_messages(docs)
+
+        assert notify.call_count == 2
+
+
+class TestBindCourse:
+
+    @staticmethod
+    def make_db(courses):
+        line_users = MagicMock()
+        line_users.update_one = AsyncMock()
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(
+            side_effect=lambda name: {"courses": courses, "line_users": line_users}[name]
+        )
+        return mock_db
+
+    @pytest.mark.asyncio
+    async def test_repeated_binds_reuse_cached_course(self):
+        """同一課程代碼的綁定只查詢一次課程"""
+        from bson import ObjectId
+        from app.services import line_service as module
+
+        course_id = ObjectId()
+        courses = MagicMock()
+        courses.find_one = AsyncMock(return_value={"_id": course_id, "course_name": "電子商務"})
+        service = module.LineService()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(service, "_reply_text", AsyncMock()) as reply:
+            patched_db.get_db.return_value = self.make_db(courses)
+            await service._handle_bind_course("U1", f"綁定 {course_id} 111400000", "t1")
+            await service._handle_bind_course("U2", f"綁定 {course_id} 111400001", "t2")
+
+        assert courses.find_one.await_count == 1
+        assert courses.find_one.call_args[0][1] == {"course_name": 1}
+        assert "電子商務" in reply.call_args[0][1]
+
+    @pytest.mark.asyncio
+    async def test_missing_course_not_cached(self):
+        from app.services import line_service as module
+
+        courses = MagicMock()
+        courses.find_one = AsyncMock(return_value=None)
+        service = module.LineService()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(service, "_reply_text", AsyncMock()):
+            patched_db.get_db.return_value = self.make_db(courses)
+            assert await service._find_course_by_code("電子商務") is None
+            assert await service._find_course_by_code("電子商務") is None
+
+        assert courses.find_one.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_course_code_lookup_branches_on_objectid_validity(self):
+        """非 ObjectId 格式直接以名稱查詢；合法 ID 查無時改以名稱查詢"""
+        from bson import ObjectId
+        from app.services import line_service as module
+
+        course_id = ObjectId()
+        courses = MagicMock()
+        courses.find_one = AsyncMock(side_effect=[{"_id": course_id, "course_name": "113A"}, None, None])
+        service = module.LineService()
+
+        with patch.object(module, "db") as patched_db:
+            patched_db.get_db.return_value = self.make_db(courses)
+            assert (await service._find_course_by_code("113A"))["_id"] == course_id
+            assert courses.find_one.call_args_list[0][0][0] == {"course_name": "113A"}
+
+            missing_id = str(ObjectId())
+            assert await service._find_course_by_code(missing_id) is None
+
+        queries = [c[0][0] for c in courses.find_one.call_args_list[1:]]
+        assert queries == [{"_id": ObjectId(missing_id)}, {"course_name": missing_id}]
+
+
+class TestHandleQuestion:
+
+    @pytest.mark.asyncio
+    async def test_question_payload_built_from_binding_and_active_qa(self):
+        """作答資料由綁定資料與開放中的任務組成，交由 question_service 建立"""
+        from bson import ObjectId
+        from app.models.schemas import QuestionCreate
+        from app.services import line_service as module
+
+        qa_id = ObjectId()
+        collections = {
+            "line_users": MagicMock(find_one=AsyncMock(return_value={
+                "user_id": "U1", "current_course_id": "course1", "student_id": "111400000"
+            })),
+            "qas": MagicMock(find_one=AsyncMock(return_value={"_id": qa_id})),
+        }
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: collections[name])
+        service = module.LineService()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.question_service, "create_question", AsyncMock()) as create, \
+             patch.object(service, "_reply_text", AsyncMock()) as reply:
+            patched_db.get_db.return_value = mock_db
+            await service._handle_question("U1", "p1", "我的答案", "token", "m1")
+
+        question = create.call_args[0][0]
+        assert isinstance(question, QuestionCreate)
+        assert question.model_dump() == {
+            "course_id": "course1", "class_id": None, "line_user_id": "U1",
+            "student_id": "111400000", "question_text": "我的答案",
+            "original_message_id": "m1", "reply_to_qa_id": str(qa_id),
+        }
+        reply.assert_awaited_once_with("token", "✅ 已成功收到您的作答！")
+
+    @pytest.mark.asyncio
+    async def test_user_binding_cached_until_unbind(self):
+        """已綁定使用者的綁定資料重複使用，解除綁定後重新查詢"""
+        from app.services import line_service as module
+
+        line_users = MagicMock()
+        line_users.find_one = AsyncMock(return_value={"current_course_id": "course1", "student_id": "111400000"})
+        line_users.update_one = AsyncMock()
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=line_users)
+        service = module.LineService()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(service, "_reply_text", AsyncMock()):
+            patched_db.get_db.return_value = mock_db
+            await service._get_user_binding("U1")
+            await service._get_user_binding("U1")
+            assert line_users.find_one.await_count == 1
+            assert line_users.find_one.call_args[0][1] == {"_id": 0, "current_course_id": 1, "student_id": 1}
+
+            await service._handle_unbind_course("U1", "token")
+            line_users.find_one.return_value = {"current_course_id": None}
+            assert (await service._get_user_binding("U1"))["current_course_id"] is None
+            # 未綁定的結果不快取，其他 worker 上的綁定可立即生效
+            await service._get_user_binding("U1")
+            assert line_users.find_one.await_count == 3
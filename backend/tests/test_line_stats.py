@@ -0,0 +1,85 @@
+"""
+LINE 統計 API 測試
+驗證統計查詢同時送出並正確組裝回應
+"""
+import asyncio
+import pytest
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+
+
+class TestLoadLineStats:
+
+    @pytest.mark.asyncio
+    async def test_stats_queries_run_concurrently(self):
+        """所有 count_documents 須同時進行，任一查詢等待其他查詢開始後才返回"""
+        from app.api import line_integration
+
+        counts = {None: 10, "received": 6, "sent": 3, "failed": 1}
+        started = []
+        all_started = asyncio.Event()
+
+        async def count_documents(query):
+            started.append(query)
+            if len(started) == 5:
+                all_started.set()
+            await asyncio.wait_for(all_started.wait(), timeout=1)
+            if "course_id" in query:
+                return 2
+            return counts[query.get("direction")]
+
+        collection = MagicMock()
+        collection.count_documents = count_documents
+        collection.distinct = AsyncMock(return_value=["U1", "U2"])
+        collection.find_one = AsyncMock(return_value={"created_at": datetime(2024, 1, 2, 3, 4)})
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch.object(line_integration, "db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await line_integration._load_line_stats("course1")
+
+        assert result["data"] == {
+            "messages_count": 10,
+            "received_count": 6,
+            "sent_count": 3,
+            "failed_count": 1,
+            "users_count": 2,
+            "questions_from_line": 2,
+            "last_message_time": "2024-01-02T03:04:00",
+        }
+
+
+class TestLoadMessageStats:
+
+    @pytest.mark.asyncio
+    async def test_message_and_user_stats_share_single_facet(self):
+        """每日訊息與使用者統計以單一 $facet 聚合取得，日期區間只 $match 一次"""
+        from app.api import line_integration
+
+        facet_result = [{
+            "messages": [
+                {"_id": {"date": "2024-01-01", "direction": "received"}, "count": 4},
+                {"_id": {"date": "2024-01-01", "direction": "sent"}, "count": 2},
+            ],
+            "users": [{"_id": "2024-01-01", "users": 3}],
+        }]
+        agg_cursor = MagicMock()
+        agg_cursor.to_list = AsyncMock(return_value=facet_result)
+        collection = MagicMock()
+        collection.aggregate = MagicMock(return_value=agg_cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch.object(line_integration, "db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await line_integration._load_message_stats(7)
+
+        assert collection.aggregate.call_count == 1
+        pipeline = collection.aggregate.call_args[0][0]
+        assert "$match" in pipeline[0]
+        assert "$facet" in pipeline[2]
+        assert result["data"] == {
+            "daily_message_stats": [{"date": "2024-01-01", "received": 4, "sent": 2, "failed": 0}],
+            "daily_user_stats": {"2024-01-01": 3},
+        }
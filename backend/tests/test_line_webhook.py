@@ -0,0 +1,170 @@
+"""
+LINE Webhook 派發測試
+驗證事件依使用者分組：同一使用者依序處理、不同使用者並行處理，單一事件失敗不影響其他事件，
+以及事件於背景處理並依 webhook_event_id 去重
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi import BackgroundTasks
+
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+
+def make_text_event(user_id, text, event_id=None):
+    """建立可通過 isinstance 檢查的文字訊息事件"""
+    event = MagicMock(spec=MessageEvent)
+    event.webhook_event_id = event_id
+    event.source = MagicMock(user_id=user_id)
+    event.message = MagicMock(spec=TextMessageContent)
+    event.message.text = text
+    event.reply_token = f"token-{user_id}-{text}"
+    return event
+
+
+def make_request(body=b"{}"):
+    request = MagicMock()
+    request.body = AsyncMock(return_value=body)
+    return request
+
+
+async def run_webhook(line_integration, events):
+    """呼叫 webhook 並執行其排入的背景工作"""
+    background_tasks = BackgroundTasks()
+    with patch.object(line_integration, "parser") as mock_parser:
+        mock_parser.parse.return_value = events
+        result = await line_integration.line_webhook(
+            make_request(), background_tasks, x_line_signature="sig"
+        )
+    await background_tasks()
+    return result, background_tasks
+
+
+class TestWebhookDispatch:
+
+    @pytest.fixture(autouse=True)
+    def line_settings(self, monkeypatch):
+        monkeypatch.setattr("app.config.settings.LINE_CHANNEL_SECRET", "secret")
+        monkeypatch.setattr("app.config.settings.LINE_CHANNEL_ACCESS_TOKEN", "token")
+
+    @pytest.mark.asyncio
+    async def test_events_from_different_users_run_concurrently(self):
+        from app.api import line_integration
+
+        events = [make_text_event("U1", "a"), make_text_event("U2", "b")]
+        started = []
+        release = asyncio.Event()
+
+        async def handler(event):
+            started.append(event.source.user_id)
+            if len(started) == 2:
+                release.set()
+            await asyncio.wait_for(release.wait(), timeout=1)
+
+        with patch.object(line_integration.line_service, "handle_text_message", side_effect=handler):
+            result, _ = await run_webhook(line_integration, events)
+
+        assert result == {"success": True}
+        assert sorted(started) == ["U1", "U2"]
+
+    @pytest.mark.asyncio
+    async def test_same_user_events_keep_order_and_failures_are_isolated(self):
+        from app.api import line_integration
+
+        events = [
+            make_text_event("U1", "綁定 X 111400000"),
+            make_text_event("U2", "boom"),
+            make_text_event("U1", "answer"),
+        ]
+        handled = []
+
+        async def handler(event):
+            if event.message.text == "boom":
+                raise RuntimeError("boom")
+            await asyncio.sleep(0)
+            handled.append(event.message.text)
+
+        with patch.object(line_integration.line_service, "handle_text_message", side_effect=handler):
+            result, _ = await run_webhook(line_integration, events)
+
+        assert result == {"success": True}
+        assert handled == ["綁定 X 111400000", "answer"]
+
+    @pytest.mark.asyncio
+    async def test_rejected_answer_replied_through_shared_client(self):
+        """業務邏輯拒絕 (ValueError) 時以 line_service 的共用客戶端回覆，不另建連線"""
+        from app.api import line_integration
+
+        event = make_text_event("U1", "answer")
+        with patch.object(line_integration.line_service, "handle_text_message",
+                          AsyncMock(side_effect=ValueError("已達最高作答次數上限"))), \
+             patch.object(line_integration.line_service, "_reply_text", AsyncMock()) as reply:
+            await line_integration._dispatch_event(event)
+
+        reply.assert_awaited_once_with(event.reply_token, "⚠️ 已達最高作答次數上限")
+
+    @pytest.mark.asyncio
+    async def test_webhook_defers_work_and_skips_redelivered_events(self):
+        from app.api import line_integration
+
+        handler = AsyncMock()
+        with patch.object(line_integration.line_service, "handle_text_message", handler):
+            background_tasks = BackgroundTasks()
+            with patch.object(line_integration, "parser") as mock_parser:
+                mock_parser.parse.return_value = [make_text_event("U1", "a", event_id="evt-dup")]
+                result = await line_integration.line_webhook(
+                    make_request(), background_tasks, x_line_signature="sig"
+                )
+            # 回應時尚未處理事件
+            assert result == {"success": True}
+            handler.assert_not_awaited()
+            await background_tasks()
+            assert handler.await_count == 1
+
+            # LINE 重送相同事件時不再處理
+            _, retry_tasks = await run_webhook(
+                line_integration, [make_text_event("U1", "a", event_id="evt-dup")]
+            )
+            assert retry_tasks.tasks == []
+            assert handler.await_count == 1
+
+
+class TestSignatureValidation:
+
+    def test_parser_accepts_raw_bytes_body(self):
+        """parser 以原始 bytes 驗證簽章並解析事件，不需先 decode"""
+        from app.api.line_integration import BytesSignatureValidator, OrjsonWebhookParser
+
+        parser = OrjsonWebhookParser("secret")
+        parser.signature_validator = BytesSignatureValidator("secret")
+        event = {
+            "type": "message", "mode": "active", "timestamp": 1692251666727,
+            "webhookEventId": "evt-1", "deliveryContext": {"isRedelivery": False},
+            "source": {"type": "user", "userId": "U1"}, "replyToken": "token",
+            "message": {"type": "text", "id": "m1", "quoteToken": "q", "text": "作答內容"},
+        }
+        body = json.dumps({"destination": "x", "events": [event]}, ensure_ascii=False).encode("utf-8")
+        signature = base64.b64encode(hmac.new(b"secret", body, hashlib.sha256).digest()).decode()
+
+        events = parser.parse(body, signature)
+        assert len(events) == 1
+        assert isinstance(events[0], MessageEvent)
+        assert events[0].message.text == "作答內容"
+        assert events[0].webhook_event_id == "evt-1"
+        with pytest.raises(InvalidSignatureError):
+            parser.parse(body, "invalid")
+
+    def test_validator_reuses_base_hmac_across_requests(self):
+        """重複驗證不會污染預先建立的 HMAC 狀態"""
+        from app.api.line_integration import BytesSignatureValidator
+
+        validator = BytesSignatureValidator("secret")
+        for body in (b'{"events": []}', b'{"events": [], "destination": "y"}'):
+            signature = base64.b64encode(hmac.new(b"secret", body, hashlib.sha256).digest()).decode()
+            assert validator.validate(body, signature)
+            assert not validator.validate(body + b" ", signature)
@@ -69,6 +69,7 @@ class TestGetCoursesUsesAggregation:
 
         # Verify aggregate was called on questions and line_users (batch operation)
         mock_questions_coll.aggregate.assert_called_once()
+        assert mock_questions_coll.aggregate.call_args[1]["hint"] == "course_status"
         mock_line_users_coll.aggregate.assert_called_once()
 
         # Verify count_documents was NOT called (no N+1)
@@ -81,6 +82,27 @@ class TestGetCoursesUsesAggregation:
         assert result[1]["question_count"] == 3
         assert result[1]["student_count"] == 0
 
+    @pytest.mark.asyncio
+    async def test_get_courses_empty_page_skips_aggregation(self):
+        """沒有課程時不送出統計聚合"""
+        from app.services.course_service import CourseService
+
+        mock_cursor = MagicMock()
+        mock_cursor.skip = MagicMock(return_value=mock_cursor)
+        mock_cursor.limit = MagicMock(return_value=mock_cursor)
+        mock_cursor.to_list = AsyncMock(return_value=[])
+        mock_coll = MagicMock()
+        mock_coll.find = MagicMock(return_value=mock_cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=mock_coll)
+
+        with patch("app.services.course_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await CourseService().get_courses()
+
+        assert result == []
+        mock_coll.aggregate.assert_not_called()
+
 
 class TestExportQasUsesBulkQuery:
     """Req 6.2: export_qas_to_csv uses bulk query instead of per-QA find"""
@@ -104,14 +126,16 @@ class TestExportQasUsesBulkQuery:
             {"_id": ObjectId(), "reply_to_qa_id": str(qa2_id), "pseudonym": "s2", "question_text": "ans2", "created_at": datetime.utcnow()},
         ]
 
-        # Mock QA cursor
-        mock_qa_cursor = AsyncMock()
-        mock_qa_cursor.to_list = AsyncMock(return_value=qas)
+        # Mock QA cursor (iterated with async for)
+        mock_qa_cursor = MagicMock()
+        mock_qa_cursor.__aiter__.return_value = qas
         mock_qa_cursor.sort = MagicMock(return_value=mock_qa_cursor)
+        mock_qa_cursor.hint = MagicMock(return_value=mock_qa_cursor)
+        mock_qa_cursor.batch_size = MagicMock(return_value=mock_qa_cursor)
 
         # Mock replies cursor (single bulk query)
-        mock_replies_cursor = AsyncMock()
-        mock_replies_cursor.to_list = AsyncMock(return_value=replies)
+        mock_replies_cursor = MagicMock()
+        mock_replies_cursor.__aiter__.return_value = replies
         mock_replies_cursor.sort = MagicMock(return_value=mock_replies_cursor)
 
         mock_qa_coll = AsyncMock()
@@ -140,6 +164,7 @@ class TestExportQasUsesBulkQuery:
         # Verify the query uses $in operator
         find_call_args = mock_q_coll.find.call_args[0][0]
         assert "$in" in str(find_call_args)
+        assert "ans1" in csv_result and "ans2" in csv_result
 
 
 class TestBatchReviewUsesUpdateMany:
@@ -180,3 +205,141 @@ class TestBatchReviewUsesUpdateMany:
         assert "$in" in str(filter_query)
 
         assert result["modified_count"] == 3
+
+    @pytest.mark.asyncio
+    async def test_batch_reject_fetches_questions_once(self):
+        """批量退回以單次 $in 查詢取回作答，不再逐筆 get_question"""
+        from app.api import questions as module
+        from app.models.schemas import ReviewStatusBatchUpdate
+
+        q_ids = [ObjectId(), ObjectId()]
+        batch_data = ReviewStatusBatchUpdate(
+            question_ids=[str(q) for q in q_ids], review_status="rejected", feedback="請補充"
+        )
+        docs = [{"_id": q, "pseudonym": f"p{i}"} for i, q in enumerate(q_ids)]
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=docs)
+        mock_collection = MagicMock()
+        mock_collection.update_many = AsyncMock(return_value=MagicMock(modified_count=2))
+        mock_collection.find = MagicMock(return_value=cursor)
+        mock_database = MagicMock()
+        mock_database.__getitem__ = MagicMock(return_value=mock_collection)
+
+        notify = AsyncMock(side_effect=RuntimeError("lookup failed"))
+        with patch("app.database.db") as patched_db, \
+             patch.object(module.question_service, "get_question", AsyncMock()) as get_question, \
+             patch.object(module.question_service, "notify_rejections", notify):
+            patched_db.get_db.return_value = mock_database
+            result = await module.batch_update_review_status(batch_data)
+
+        # 通知失敗不影響批閱結果
+        assert result["modified_count"] == 2
+        mock_collection.find.assert_called_once_with({"_id": {"$in": q_ids}}, {"pseudonym": 1})
+        get_question.assert_not_called()
+        notify.assert_awaited_once_with(docs, "請補充")
+
+
+class TestSyncCoursesUsesBulkWrite:
+    """外部課程同步以單次 bulk_write upsert，不再逐筆 find_one + 寫入"""
+
+    @pytest.mark.asyncio
+    async def test_sync_courses_uses_single_bulk_write(self):
+        from pymongo import UpdateOne
+        from app.services.course_service import CourseService
+
+        courses_data = [
+            {"course_code": "EC101", "semester": "113-1", "course_name": "電子商務"},
+            {"course_code": "EC102", "semester": "113-1", "course_name": "網路行銷"},
+        ]
+        bulk_result = MagicMock(upserted_ids={1: ObjectId()}, matched_count=1)
+        mock_collection = MagicMock()
+        mock_collection.bulk_write = AsyncMock(return_value=bulk_result)
+        mock_collection.find_one = AsyncMock()
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=mock_collection)
+
+        with patch("app.services.course_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await CourseService().sync_courses_from_external(courses_data)
+
+        assert result == {"created": 1, "updated": 1}
+        mock_collection.find_one.assert_not_called()
+        mock_collection.bulk_write.assert_awaited_once()
+        operations = mock_collection.bulk_write.call_args[0][0]
+        assert mock_collection.bulk_write.call_args[1]["ordered"] is False
+        assert len(operations) == 2
+        assert all(isinstance(op, UpdateOne) for op in operations)
+        assert operations[0]._filter == {"course_code": "EC101", "semester": "113-1", "is_active": True}
+        assert operations[0]._upsert is True
+        assert "created_at" in operations[0]._doc["$setOnInsert"]
+
+    @pytest.mark.asyncio
+    async def test_sync_courses_empty_payload_skips_write(self):
+        from app.services.course_service import CourseService
+
+        with patch("app.services.course_service.db") as patched_db:
+            result = await CourseService().sync_courses_from_external([])
+
+        assert result == {"created": 0, "updated": 0}
+        patched_db.get_db.assert_not_called()
+
+
+class TestDeleteCourseCascade:
+    """刪除課程的四個級聯寫入同時送出"""
+
+    @staticmethod
+    def make_db(collections):
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: collections[name])
+        return mock_db
+
+    @pytest.mark.asyncio
+    async def test_cascade_writes_run_concurrently(self):
+        import asyncio
+        from app.services.course_service import CourseService
+
+        started = []
+        release = asyncio.Event()
+
+        def make_write(name):
+            async def write(*args, **kwargs):
+                started.append(name)
+                if len(started) == 4:
+                    release.set()
+                await asyncio.wait_for(release.wait(), timeout=1)
+            return write
+
+        collections = {}
+        for name, method in [("classes", "update_many"), ("questions", "update_many"),
+                             ("qas", "delete_many"), ("announcements", "delete_many")]:
+            coll = MagicMock()
+            setattr(coll, method, AsyncMock(side_effect=make_write(name)))
+            collections[name] = coll
+
+        service = CourseService()
+        with patch("app.services.course_service.db") as patched_db, \
+             patch.object(service, "update_course", AsyncMock(return_value={"_id": "c1"})):
+            patched_db.get_db.return_value = self.make_db(collections)
+            assert await service.delete_course("c1") is True
+
+        assert sorted(started) == ["announcements", "classes", "qas", "questions"]
+
+    @pytest.mark.asyncio
+    async def test_cascade_failure_raises_after_other_writes_finish(self):
+        from app.services.course_service import CourseService
+
+        collections = {name: MagicMock() for name in ("classes", "questions", "qas", "announcements")}
+        collections["classes"].update_many = AsyncMock()
+        collections["questions"].update_many = AsyncMock(side_effect=RuntimeError("write failed"))
+        collections["qas"].delete_many = AsyncMock()
+        collections["announcements"].delete_many = AsyncMock()
+
+        service = CourseService()
+        with patch("app.services.course_service.db") as patched_db, \
+             patch.object(service, "update_course", AsyncMock(return_value={"_id": "c1"})):
+            patched_db.get_db.return_value = self.make_db(collections)
+            with pytest.raises(RuntimeError, match="write failed"):
+                await service.delete_course("c1")
+
+        collections["qas"].delete_many.assert_awaited_once()
+        collections["announcements"].delete_many.assert_awaited_once()
@@ -0,0 +1,247 @@
+"""
+Q&A 服務測試
+驗證 Q&A 與公告的查詢投影、時間欄位與更新流程
+"""
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+
+class TestGetQasByCourse:
+
+    @pytest.mark.asyncio
+    async def test_list_excludes_related_question_ids(self):
+        """列表查詢排除關聯提問 ID 陣列"""
+        from bson import ObjectId
+        from app.services.qa_service import qa_service
+
+        qa_id = ObjectId()
+        cursor = MagicMock()
+        cursor.skip = MagicMock(return_value=cursor)
+        cursor.limit = MagicMock(return_value=cursor)
+        cursor.sort = MagicMock(return_value=cursor)
+        cursor.batch_size = MagicMock(return_value=cursor)
+        cursor.to_list = AsyncMock(return_value=[{"_id": qa_id, "question": "Q"}])
+        collection = MagicMock()
+        collection.find = MagicMock(return_value=cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch("app.services.qa_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            qas = await qa_service.get_qas_by_course(course_id="course1")
+
+        query, projection = collection.find.call_args[0]
+        assert query == {"course_id": "course1"}
+        assert projection == {"related_question_ids": 0}
+        assert qas == [{"_id": str(qa_id), "question": "Q"}]
+        # 整頁在第一批取回，不再額外 getMore
+        cursor.batch_size.assert_called_once_with(100)
+
+    @pytest.mark.asyncio
+    async def test_get_qa_passes_projection(self):
+        """單筆查詢可只取呼叫端需要的欄位"""
+        from bson import ObjectId
+        from app.services.qa_service import qa_service
+
+        qa_id = ObjectId()
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value={"_id": qa_id, "question": "Q"})
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch("app.services.qa_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            qa = await qa_service.get_qa(str(qa_id), {"question": 1})
+
+        assert collection.find_one.call_args[0] == ({"_id": qa_id}, {"question": 1})
+        assert qa == {"_id": str(qa_id), "question": "Q"}
+
+
+class TestTimestamps:
+
+    @pytest.mark.asyncio
+    async def test_update_qa_publish_date_matches_updated_at(self):
+        """同一次更新的 updated_at 與 publish_date 為同一個時間點"""
+        from bson import ObjectId
+        from app.services.qa_service import qa_service
+
+        qa_id = ObjectId()
+        collection = MagicMock()
+        collection.find_one_and_update = AsyncMock(return_value={"_id": qa_id, "is_published": True})
+        collection.find_one = AsyncMock()
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch("app.services.qa_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            qa = await qa_service.update_qa(str(qa_id), {"is_published": True})
+
+        fields = collection.find_one_and_update.call_args[0][1]["$set"]
+        assert fields["publish_date"] is fields["updated_at"]
+        # 更新後的文件由同一個操作取回，不再另外查詢
+        assert qa == {"_id": str(qa_id), "is_published": True}
+        collection.find_one.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_create_qa_document_fields(self):
+        """建立 Q&A 的文件含表單欄位與伺服器端欄位，截止時間由同一時間點推算"""
+        from datetime import timedelta
+        from bson import ObjectId
+        from app.models.schemas import QACreate
+        from app.services.qa_service import qa_service
+
+        qa_data = QACreate(
+            course_id=str(ObjectId()), question="Q", core_concept="C",
+            tags=["t"], allow_replies=True, duration_minutes=30,
+        )
+        collection = MagicMock()
+        collection.find_one = AsyncMock(return_value={"_id": ObjectId(qa_data.course_id)})
+        collection.insert_one = AsyncMock(return_value=MagicMock(inserted_id=ObjectId()))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch("app.services.qa_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            doc = await qa_service.create_qa(qa_data, "teacher1")
+
+        assert doc["question"] == "Q" and doc["tags"] == ["t"] and doc["max_attempts"] == 1
+        assert doc["created_by"] == "teacher1" and doc["related_question_ids"] == []
+        assert doc["expires_at"] - doc["created_at"] == timedelta(minutes=30)
+        assert doc["updated_at"] is doc["created_at"]
+        assert "_id" not in qa_data.__dict__
+
+
+class TestUpdateAnnouncement:
+
+    @staticmethod
+    def make_db(collection):
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+        return mock_db
+
+    @pytest.mark.asyncio
+    async def test_publishing_draft_updates_once_and_broadcasts(self):
+        """草稿轉發布以單次條件更新完成並觸發推播"""
+        from bson import ObjectId
+        from app.services import qa_service as module
+
+        doc = {"_id": ObjectId(), "course_id": "course1", "is_published": True}
+        collection = MagicMock()
+        collection.find_one_and_update = AsyncMock(return_value=doc)
+        collection.find_one = AsyncMock()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.line_service, "broadcast_announcement_to_course", AsyncMock()) as broadcast:
+            patched_db.get_db.return_value = self.make_db(collection)
+            result = await module.announcement_service.update_announcement(str(doc["_id"]), {"is_published": True})
+
+        collection.find_one_and_update.assert_awaited_once()
+        collection.find_one.assert_not_called()
+        query, update = collection.find_one_and_update.call_args[0]
+        assert query["is_published"] == {"$ne": True}
+        assert update["$set"]["sent_to_line"] is True
+        assert update["$set"]["publish_date"] is update["$set"]["updated_at"]
+        broadcast.assert_called_once_with("course1", result)
+
+    @pytest.mark.asyncio
+    async def test_republishing_does_not_broadcast_again(self):
+        """已發布的公告再次送出發布時只更新欄位，不重複推播"""
+        from bson import ObjectId
+        from app.services import qa_service as module
+
+        doc = {"_id": ObjectId(), "course_id": "course1", "is_published": True}
+        collection = MagicMock()
+        collection.find_one_and_update = AsyncMock(side_effect=[None, doc])
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.line_service, "broadcast_announcement_to_course", AsyncMock()) as broadcast:
+            patched_db.get_db.return_value = self.make_db(collection)
+            result = await module.announcement_service.update_announcement(str(doc["_id"]), {"is_published": True})
+
+        assert result["_id"] == str(doc["_id"])
+        fallback_update = collection.find_one_and_update.call_args_list[1][0][1]["$set"]
+        assert "sent_to_line" not in fallback_update
+        broadcast.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_missing_announcement_returns_none(self):
+        from bson import ObjectId
+        from app.services import qa_service as module
+
+        collection = MagicMock()
+        collection.find_one_and_update = AsyncMock(return_value=None)
+
+        with patch.object(module, "db") as patched_db:
+            patched_db.get_db.return_value = self.make_db(collection)
+            assert await module.announcement_service.update_announcement(str(ObjectId()), {"title": "t"}) is None
+
+        collection.find_one_and_update.assert_awaited_once()
+
+
+class TestLinkQuestionsToQa:
+
+    @pytest.mark.asyncio
+    async def test_link_writes_run_concurrently_and_return_updated_qa(self):
+        """Q&A 與提問的更新同時送出，直接回傳更新後的 Q&A 不再額外查詢"""
+        import asyncio
+        from bson import ObjectId
+        from pymongo import ReturnDocument
+        from app.services.qa_service import qa_service
+
+        qa_id, question_id = ObjectId(), ObjectId()
+        started = []
+        both_started = asyncio.Event()
+
+        def make_write(name, result):
+            async def write(*args, **kwargs):
+                started.append(name)
+                if len(started) == 2:
+                    both_started.set()
+                await asyncio.wait_for(both_started.wait(), timeout=1)
+                return result
+            return write
+
+        qas = MagicMock()
+        qas.find_one_and_update = AsyncMock(side_effect=make_write("qas", {"_id": qa_id, "question": "Q"}))
+        qas.find_one = AsyncMock()
+        questions = MagicMock()
+        questions.update_many = AsyncMock(side_effect=make_write("questions", MagicMock()))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: {"qas": qas, "questions": questions}[name])
+
+        with patch("app.services.qa_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await qa_service.link_questions_to_qa(str(qa_id), [str(question_id)])
+
+        assert sorted(started) == ["qas", "questions"]
+        assert result == {"_id": str(qa_id), "question": "Q"}
+        assert qas.find_one_and_update.call_args[1]["return_document"] == ReturnDocument.AFTER
+        assert questions.update_many.call_args[0][0] == {"_id": {"$in": [question_id]}}
+        qas.find_one.assert_not_called()
+
+
+class TestSearchQas:
+
+    @pytest.mark.asyncio
+    async def test_keyword_matched_literally(self):
+        """關鍵字中的正規表示式特殊字元以字面比對"""
+        from app.services.qa_service import qa_service
+
+        cursor = MagicMock()
+        for method in ("sort", "skip", "limit", "batch_size"):
+            setattr(cursor, method, MagicMock(return_value=cursor))
+        cursor.to_list = AsyncMock(return_value=[])
+        collection = MagicMock()
+        collection.find = MagicMock(return_value=cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=collection)
+
+        with patch("app.services.qa_service.db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            await qa_service.search_qas("course1", "C++ (a+)+")
+
+        query, projection = collection.find.call_args[0]
+        assert query["$or"][0] == {"question": {"$regex": r"C\+\+\ \(a\+\)\+", "$options": "i"}}
+        assert query["$or"][2] == {"tags": {"$in": ["C++ (a+)+"]}}
+        assert projection == {"related_question_ids": 0}
+        cursor.sort.assert_called_once_with("created_at", -1)
@@ -0,0 +1,306 @@
+"""
+作答紀錄服務測試
+驗證建立作答前的課程與作答次數檢查
+"""
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from bson import ObjectId
+
+
+def make_question(qa_id):
+    from app.models.schemas import QuestionCreate
+
+    return QuestionCreate.model_construct(
+        course_id="course1",
+        line_user_id="U1",
+        student_id="s1",
+        question_text="答案",
+        original_message_id="m1",
+        reply_to_qa_id=qa_id,
+    )
+
+
+async def insert_many(docs, ordered=True):
+    """模擬 insert_many：為每筆文件補上 _id"""
+    for doc in docs:
+        doc.setdefault("_id", ObjectId())
+
+
+def make_db(qas, questions):
+    mock_db = MagicMock()
+    mock_db.__getitem__ = MagicMock(side_effect=lambda name: {"qas": qas, "questions": questions}[name])
+    return mock_db
+
+
+class TestCreateQuestion:
+
+    @pytest.mark.asyncio
+    async def test_course_and_qa_settings_fetched_concurrently(self):
+        """課程與 Q&A 作答上限同時查詢"""
+        from app.services import question_service as module
+
+        started = []
+        release = asyncio.Event()
+
+        async def lookup(name, result):
+            started.append(name)
+            if len(started) == 2:
+                release.set()
+            await asyncio.wait_for(release.wait(), timeout=1)
+            return result
+
+        async def find_qa(*args, **kwargs):
+            return await lookup("qa", {"max_attempts": 2})
+
+        async def is_course_active(*args):
+            return await lookup("course", True)
+
+        qa_id = str(ObjectId())
+        qas = MagicMock()
+        qas.find_one = AsyncMock(side_effect=find_qa)
+        questions = MagicMock()
+        questions.count_documents = AsyncMock(return_value=0)
+        questions.insert_many = AsyncMock(side_effect=insert_many)
+
+        service = module.QuestionService()
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.course_service, "is_course_active", AsyncMock(side_effect=is_course_active)), \
+             patch.object(module, "invalidate_course_reports"):
+            patched_db.get_db.return_value = make_db(qas, questions)
+            doc = await service.create_question(make_question(qa_id))
+            await service.aclose()
+
+        assert sorted(started) == ["course", "qa"]
+        assert qas.find_one.call_args[0][1] == {"max_attempts": 1}
+        assert doc["reply_to_qa_id"] == qa_id
+        assert isinstance(doc["_id"], str)
+        questions.insert_many.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_attempt_limit_rejects_extra_answer(self):
+        """超過作答次數上限時拋出 ValueError，不寫入"""
+        from app.services import question_service as module
+
+        qas = MagicMock()
+        qas.find_one = AsyncMock(return_value={"max_attempts": 1})
+        questions = MagicMock()
+        questions.count_documents = AsyncMock(return_value=1)
+        questions.insert_many = AsyncMock()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.course_service, "is_course_active", AsyncMock(return_value=True)):
+            patched_db.get_db.return_value = make_db(qas, questions)
+            with pytest.raises(ValueError, match="最高作答次數上限"):
+                await module.question_service.create_question(make_question(str(ObjectId())))
+
+        questions.insert_many.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_inactive_course_rejected(self):
+        """課程停用時拋出 ValueError"""
+        from app.services import question_service as module
+
+        qas = MagicMock()
+        qas.find_one = AsyncMock(return_value=None)
+        questions = MagicMock()
+        questions.insert_many = AsyncMock()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.course_service, "is_course_active", AsyncMock(return_value=False)):
+            patched_db.get_db.return_value = make_db(qas, questions)
+            with pytest.raises(ValueError, match="課程不存在或已停用"):
+                await module.question_service.create_question(make_question(str(ObjectId())))
+
+        questions.insert_many.assert_not_called()
+
+
+class TestInsertBatching:
+
+    @staticmethod
+    def patch_lookups(module):
+        return patch.object(module.course_service, "is_course_active", AsyncMock(return_value=True))
+
+    @pytest.mark.asyncio
+    async def test_concurrent_answers_share_one_insert_many(self):
+        """前一批寫入期間排入的作答合併為下一次 insert_many"""
+        from app.services import question_service as module
+
+        first_insert_started = asyncio.Event()
+        release_first_insert = asyncio.Event()
+        batches = []
+
+        async def slow_insert_many(docs, ordered=True):
+            batches.append([d["original_message_id"] for d in docs])
+            await insert_many(docs)
+            if len(batches) == 1:
+                first_insert_started.set()
+                await release_first_insert.wait()
+
+        qas = MagicMock()
+        qas.find_one = AsyncMock(return_value=None)
+        questions = MagicMock()
+        questions.insert_many = AsyncMock(side_effect=slow_insert_many)
+
+        service = module.QuestionService()
+        with patch.object(module, "db") as patched_db, self.patch_lookups(module), \
+             patch.object(module, "invalidate_course_reports"):
+            patched_db.get_db.return_value = make_db(qas, questions)
+            first = asyncio.create_task(service.create_question(make_question(None)))
+            await first_insert_started.wait()
+            rest = []
+            for i in range(3):
+                data = make_question(None)
+                data.original_message_id = f"m{i + 2}"
+                rest.append(asyncio.create_task(service.create_question(data)))
+            # 等待三筆作答都排入佇列後才放行第一批
+            while service._insert_queue.qsize() < 3:
+                await asyncio.sleep(0)
+            release_first_insert.set()
+            docs = await asyncio.gather(first, *rest)
+            await service.aclose()
+
+        assert batches == [["m1"], ["m2", "m3", "m4"]]
+        assert all(isinstance(doc["_id"], str) for doc in docs)
+        assert questions.insert_many.call_args[1]["ordered"] is False
+
+    @pytest.mark.asyncio
+    async def test_failed_document_raises_only_for_its_caller(self):
+        """批次中單筆寫入失敗時，只有該筆作答的呼叫端收到錯誤"""
+        from pymongo.errors import BulkWriteError
+        from app.services import question_service as module
+
+        service = module.QuestionService()
+        ok_doc, bad_doc = {"question_text": "a"}, {"question_text": "b"}
+        loop = asyncio.get_running_loop()
+        batch = [(ok_doc, loop.create_future()), (bad_doc, loop.create_future())]
+
+        async def partial_insert_many(docs, ordered=True):
+            # _id 已在送出前配置，不依賴 insert_many 回填
+            assert all(isinstance(doc["_id"], ObjectId) for doc in docs)
+            raise BulkWriteError({"writeErrors": [{"index": 1, "code": 11000, "errmsg": "dup"}]})
+
+        questions = MagicMock()
+        questions.insert_many = AsyncMock(side_effect=partial_insert_many)
+        with patch.object(module, "db") as patched_db:
+            patched_db.get_db.return_value = make_db(MagicMock(), questions)
+            await service._insert_batch(batch)
+
+        assert batch[0][1].result() == ok_doc["_id"]
+        with pytest.raises(RuntimeError, match="dup"):
+            batch[1][1].result()
+
+
+class TestUpdates:
+
+    @pytest.mark.asyncio
+    async def test_review_status_update_returns_updated_document(self):
+        """批閱狀態以單次 find_one_and_update 更新並取回文件"""
+        from app.models.schemas import ReviewStatus
+        from app.services import question_service as module
+
+        question_id = ObjectId()
+        questions = MagicMock()
+        questions.find_one_and_update = AsyncMock(return_value={
+            "_id": question_id, "course_id": "course1", "review_status": "approved"
+        })
+        questions.find_one = AsyncMock()
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module, "invalidate_course_reports") as invalidate:
+            patched_db.get_db.return_value = make_db(MagicMock(), questions)
+            question = await module.question_service.update_review_status(
+                str(question_id), ReviewStatus.APPROVED, feedback="好"
+            )
+
+        assert question["_id"] == str(question_id)
+        update = questions.find_one_and_update.call_args[0][1]["$set"]
+        assert update["review_status"] == ReviewStatus.APPROVED and update["feedback"] == "好"
+        questions.find_one.assert_not_called()
+        invalidate.assert_called_once_with("course1")
+
+    @pytest.mark.asyncio
+    async def test_ai_analysis_update_for_missing_question_returns_none(self):
+        from app.models.schemas import AIAnalysisResult
+        from app.services import question_service as module
+
+        questions = MagicMock()
+        questions.find_one_and_update = AsyncMock(return_value=None)
+
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module, "invalidate_course_reports") as invalidate:
+            patched_db.get_db.return_value = make_db(MagicMock(), questions)
+            result = await module.question_service.update_ai_analysis(
+                str(ObjectId()), AIAnalysisResult(question_id="q", difficulty_score=0.8, keywords=[])
+            )
+
+        assert result is None
+        update = questions.find_one_and_update.call_args[0][1]["$set"]
+        assert update["difficulty_level"] == "hard"
+        invalidate.assert_not_called()
+
+
+class TestNotifyRejections:
+
+    @pytest.mark.asyncio
+    async def test_user_ids_resolved_once_and_pushes_bounded(self):
+        """所有學生以一次 $in 反查 user_id，推播共用 line_service 並限制同時數量"""
+        from app.services import question_service as module
+        from app.services.line_service import line_service
+
+        async def aggregate_cursor(docs):
+            for doc in docs:
+                yield doc
+
+        resolved = [{"_id": f"p{i}", "user_id": f"U{i}"} for i in range(20)]
+        line_messages = MagicMock()
+        line_messages.aggregate = MagicMock(return_value=aggregate_cursor(resolved))
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=line_messages)
+
+        active = peak = 0
+        pushed = []
+
+        async def push_text(user_id, text):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0)
+            active -= 1
+            if user_id == "U0":
+                raise RuntimeError("push failed")
+            pushed.append(user_id)
+
+        questions = [{"_id": ObjectId(), "pseudonym": f"p{i}"} for i in range(20)] + [{"_id": ObjectId()}]
+        with patch.object(module, "db") as patched_db, \
+             patch.object(module.settings, "LINE_CHANNEL_ACCESS_TOKEN", "token"), \
+             patch.object(line_service, "push_text", AsyncMock(side_effect=push_text)):
+            patched_db.get_db.return_value = mock_db
+            await module.question_service.notify_rejections(questions, "請補充")
+
+        line_messages.aggregate.assert_called_once()
+        match = line_messages.aggregate.call_args[0][0][0]["$match"]
+        assert sorted(match["pseudonym"]["$in"]) == sorted(f"p{i}" for i in range(20))
+        assert len(pushed) == 19
+        assert peak <= module.REJECTION_NOTIFY_CONCURRENCY
+
+class TestListRoutes:
+
+    def test_question_list_serializes_object_ids(self):
+        """列表路由直接以 orjson 序列化服務回傳的 ObjectId 與日期"""
+        from datetime import datetime
+        from fastapi.testclient import TestClient
+        from app.main import app
+        from app.services import question_service as module
+
+        question_id = ObjectId()
+        docs = [{"_id": question_id, "course_id": "c1", "created_at": datetime(2024, 1, 1, 8, 0)}]
+        with patch.object(module.question_service, "get_questions_by_course", AsyncMock(return_value=docs)):
+            response = TestClient(app).get("/questions/", params={"course_id": "c1"})
+
+        assert response.status_code == 200
+        assert response.json() == {
+            "success": True,
+            "data": [{"_id": str(question_id), "course_id": "c1", "created_at": "2024-01-01T08:00:00"}],
+            "total": 1,
+        }
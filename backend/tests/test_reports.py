@@ -0,0 +1,250 @@
+"""
+報表統計 API 測試
+驗證統計摘要以單一聚合取得並正確組裝回應
+"""
+import json
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+
+@pytest.fixture(autouse=True)
+def clear_report_cache():
+    """每個測試前後清空報表快取，避免測試間互相影響"""
+    from app.utils.cache import report_cache
+    report_cache.clear()
+    yield
+    report_cache.clear()
+
+
+def make_questions_collection(facet_result):
+    agg_cursor = MagicMock()
+    agg_cursor.to_list = AsyncMock(return_value=facet_result)
+    questions = MagicMock()
+    questions.aggregate = MagicMock(return_value=agg_cursor)
+    questions.count_documents = AsyncMock()
+    return questions
+
+
+class TestGetStatistics:
+
+    @pytest.mark.asyncio
+    async def test_statistics_single_facet_round_trip(self):
+        """總數、狀態與難度分布由單一 $facet 聚合取得"""
+        from app.api import reports
+
+        questions = make_questions_collection([{
+            "totals": [{"n": 6}],
+            "status": [
+                {"_id": "approved", "count": 3},
+                {"_id": "pending", "count": 2},
+                {"_id": None, "count": 1},
+            ],
+            "difficulty": [
+                {"_id": "EASY", "count": 2},
+                {"_id": "HARD", "count": 2},
+                {"_id": None, "count": 2},
+            ],
+            "avg": [{"_id": None, "avg": 0.5}],
+        }])
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch.object(reports, "db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await reports.get_statistics(course_id="course1")
+
+        assert questions.aggregate.call_count == 1
+        questions.count_documents.assert_not_called()
+        pipeline = questions.aggregate.call_args[0][0]
+        assert list(pipeline[0]) == ["$match"]
+        assert pipeline[1] == {
+            "$project": {"_id": 0, "review_status": 1, "difficulty_level": 1, "difficulty_score": 1}
+        }
+        assert "$facet" in pipeline[2]
+        assert pipeline[2]["$facet"]["status"] == [{"$sortByCount": "$review_status"}]
+
+        data = json.loads(result.body)["data"]
+        assert data["total_questions"] == 6
+        assert data["approved_questions"] == 3
+        assert data["pending_questions"] == 3
+        assert data["rejected_questions"] == 0
+        assert data["difficulty_distribution"] == {"easy": 2, "medium": 0, "hard": 2}
+        assert data["avg_difficulty_score"] == pytest.approx(0.5)
+
+    @pytest.mark.asyncio
+    async def test_statistics_cached_until_invalidated(self):
+        """同課程的重複請求命中快取，資料異動後重新查詢"""
+        from app.api import reports
+        from app.utils.cache import invalidate_course_reports
+
+        questions = make_questions_collection([{"totals": [{"n": 1}], "status": [], "difficulty": []}])
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch.object(reports, "db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            await reports.get_statistics(course_id="course1")
+            await reports.get_statistics(course_id="course1")
+            assert questions.aggregate.call_count == 1
+
+            invalidate_course_reports("course1")
+            await reports.get_statistics(course_id="course1")
+            assert questions.aggregate.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_statistics_empty_course(self):
+        from app.api import reports
+
+        questions = make_questions_collection([{"totals": [], "status": [], "difficulty": []}])
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=questions)
+
+        with patch.object(reports, "db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await reports.get_statistics(course_id="course1")
+
+        data = json.loads(result.body)["data"]
+        assert data["total_questions"] == 0
+        assert data["avg_difficulty_score"] == 0
+
+
+class TestExportRoutes:
+
+    @pytest.mark.asyncio
+    async def test_export_route_streams_csv_with_bom(self):
+        """匯出路由以 StreamingResponse 回應，第一段帶 UTF-8 BOM"""
+        from fastapi.responses import StreamingResponse
+        from app.api import reports
+
+        async def fake_stream(*args, **kwargs):
+            yield "a,b\r\n"
+            yield "1,2\r\n"
+
+        courses = MagicMock()
+        courses.find_one = AsyncMock(return_value={"course_name": "課程"})
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=courses)
+
+        with patch.object(reports, "db") as patched_db, \
+             patch.object(reports.export_service, "stream_qas_csv", side_effect=fake_stream):
+            patched_db.get_db.return_value = mock_db
+            response = await reports.export_qas_csv(
+                course_id="65d4a1b2c3d4e5f6a7b8c9d0", class_id=None, start_date=None, end_date=None
+            )
+            body = b"".join([chunk async for chunk in response.body_iterator])
+
+        assert isinstance(response, StreamingResponse)
+        assert response.media_type == "text/csv"
+        assert "attachment" in response.headers["content-disposition"]
+        assert response.headers["x-accel-buffering"] == "no"
+        assert body == "\ufeffa,b\r\n1,2\r\n".encode("utf-8")
+
+    @pytest.mark.asyncio
+    async def test_response_starts_after_header_and_query_error_ends_with_error_row(self):
+        """取得標題列後即開始回應，不等待查詢；之後的查詢錯誤以檔案最後的錯誤列呈現"""
+        from app.api import reports
+
+        query_started = False
+
+        async def failing_stream(*args, **kwargs):
+            nonlocal query_started
+            yield "a,b\r\n"
+            query_started = True
+            raise RuntimeError("bad hint")
+
+        courses = MagicMock()
+        courses.find_one = AsyncMock(return_value={"course_name": "課程"})
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=courses)
+
+        with patch.object(reports, "db") as patched_db, \
+             patch.object(reports.export_service, "stream_qas_csv", side_effect=failing_stream):
+            patched_db.get_db.return_value = mock_db
+            response = await reports.export_qas_csv(
+                course_id="65d4a1b2c3d4e5f6a7b8c9d0", class_id=None, start_date=None, end_date=None
+            )
+            assert query_started is False
+            body = b"".join([chunk async for chunk in response.body_iterator])
+
+        assert body == ("\ufeffa,b\r\n" + reports.EXPORT_ERROR_ROW).encode("utf-8")
+
+    @pytest.mark.asyncio
+    async def test_export_questions_name_lookups_run_concurrently(self):
+        """課程名稱與任務標籤同時查詢，任一查詢等待另一查詢開始後才返回"""
+        import asyncio
+        from urllib.parse import unquote
+        from app.api import reports
+
+        started = []
+        both_started = asyncio.Event()
+
+        def make_find_one(name, doc):
+            async def find_one(*args, **kwargs):
+                started.append(name)
+                if len(started) == 2:
+                    both_started.set()
+                await asyncio.wait_for(both_started.wait(), timeout=1)
+                return doc
+            return find_one
+
+        collections = {
+            "courses": MagicMock(find_one=make_find_one("courses", {"course_name": "課程"})),
+            "qas": MagicMock(find_one=make_find_one("qas", {"question": "什麼是電子商務"})),
+        }
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(side_effect=lambda name: collections[name])
+
+        async def fake_stream(*args, **kwargs):
+            yield "a\r\n"
+
+        with patch.object(reports, "db") as patched_db, \
+             patch.object(reports.export_service, "stream_questions_csv", side_effect=fake_stream):
+            patched_db.get_db.return_value = mock_db
+            response = await reports.export_questions_csv(
+                course_id="65d4a1b2c3d4e5f6a7b8c9d0", qa_id="65d4a1b2c3d4e5f6a7b8c9d1",
+                class_id=None, cluster_id=None, start_date=None, end_date=None
+            )
+
+        assert sorted(started) == ["courses", "qas"]
+        assert "課程_什麼是電子商務_作答明細_" in unquote(response.headers["content-disposition"])
+
+    def test_export_filename_shared_format(self):
+        """匯出檔名附加時間戳記，Content-Disposition 以 UTF-8 編碼中文"""
+        import re
+        from app.api import reports
+
+        filename = reports._export_filename("課程_QA紀錄")
+        assert re.fullmatch(r"課程_QA紀錄_\d{8}_\d{4}\.csv", filename)
+        assert reports._content_disposition("課程.csv") == "attachment; filename*=UTF-8''%E8%AA%B2%E7%A8%8B.csv"
+
+
+class TestClustersSummary:
+
+    @pytest.mark.asyncio
+    async def test_clusters_summary_projects_display_fields(self):
+        """只取儀表板顯示欄位，_id 於回應序列化時轉為字串"""
+        from bson import ObjectId
+        from app.api import reports
+
+        cluster_id = ObjectId()
+        cursor = MagicMock()
+        cursor.sort = MagicMock(return_value=cursor)
+        cursor.limit = MagicMock(return_value=cursor)
+        cursor.to_list = AsyncMock(return_value=[{"_id": cluster_id, "topic_label": "t", "question_count": 3}])
+        clusters = MagicMock()
+        clusters.find = MagicMock(return_value=cursor)
+        mock_db = MagicMock()
+        mock_db.__getitem__ = MagicMock(return_value=clusters)
+
+        with patch.object(reports, "db") as patched_db:
+            patched_db.get_db.return_value = mock_db
+            result = await reports.get_clusters_summary(course_id="course1")
+
+        projection = clusters.find.call_args[0][1]
+        assert projection == reports.CLUSTER_SUMMARY_PROJECTION
+        assert "topic_label" in projection and "question_count" in projection
+        cursor.sort.assert_called_once_with("question_count", -1)
+        assert json.loads(result.body) == {
+            "success": True,
+            "data": [{"_id": str(cluster_id), "topic_label": "t", "question_count": 3}],
+        }
@@ -0,0 +1,98 @@
+"""
+安全工具測試
+驗證去識別化代號的計算、快取、格式檢查、資料遮罩與 JWT token
+"""
+import hashlib
+from unittest.mock import patch
+
+
+class TestGeneratePseudonym:
+
+    def test_matches_salted_sha256(self):
+        from app.utils.security import generate_pseudonym
+
+        expected = hashlib.sha256("U123salt".encode("utf-8")).hexdigest()
+        assert generate_pseudonym("U123", salt="salt") == expected
+
+    def test_repeated_user_reuses_cached_hash(self):
+        """同一位使用者重複計算代號時只雜湊一次"""
+        from app.utils import security
+
+        security._hash_pseudonym.cache_clear()
+        with patch.object(security.hashlib, "sha256", wraps=hashlib.sha256) as sha256:
+            first = security.generate_pseudonym("U-repeat")
+            second = security.generate_pseudonym("U-repeat")
+
+        assert first == second
+        assert sha256.call_count == 1
+
+    def test_cache_is_keyed_by_salt(self):
+        """鹽值改變時重新計算，不沿用舊鹽值的結果"""
+        from app.utils import security
+
+        with patch.object(security.settings, "PSEUDONYM_SALT", "salt-a"):
+            a = security.generate_pseudonym("U1")
+        with patch.object(security.settings, "PSEUDONYM_SALT", "salt-b"):
+            b = security.generate_pseudonym("U1")
+
+        assert a != b
+        assert b == hashlib.sha256("U1salt-b".encode("utf-8")).hexdigest()
+
+
+class TestValidatePseudonym:
+
+    def test_accepts_full_and_short_pseudonyms(self):
+        from app.utils.security import generate_pseudonym, generate_short_pseudonym, validate_pseudonym
+
+        assert validate_pseudonym(generate_pseudonym("U1", salt="s"))
+        assert validate_pseudonym(generate_short_pseudonym("U1"))
+        assert validate_pseudonym("ABCDEF0123456789")
+
+    def test_rejects_non_hex_and_wrong_length(self):
+        from app.utils.security import validate_pseudonym
+
+        assert not validate_pseudonym("g" * 16)
+        assert not validate_pseudonym("a" * 32)
+        # int(x, 16) 會接受的符號、底線與前綴都不是有效的雜湊字元
+        assert not validate_pseudonym("+" + "a" * 15)
+        assert not validate_pseudonym("0x" + "a" * 14)
+        assert not validate_pseudonym("a_" + "a" * 14)
+        assert not validate_pseudonym("a" * 16 + "\n")
+
+
+class TestMasking:
+
+    def test_mask_email(self):
+        from app.utils.security import mask_email
+
+        assert mask_email("user@example.com") == "u***@example.com"
+        assert mask_email("ab@example.com") == "a*@example.com"
+        assert mask_email("a@example.com") == "a*@example.com"
+        assert mask_email("x" * 80 + "@example.com") == "x" + "*" * 79 + "@example.com"
+        assert mask_email("not-an-email") == "not-an-email"
+
+    def test_mask_line_user_id(self):
+        from app.utils.security import mask_line_user_id
+
+        assert mask_line_user_id("U1234567890abcdef") == "U123***"
+        assert mask_line_user_id("U12") == "U12"
+
+
+class TestAccessToken:
+
+    def test_round_trip_and_interop_with_plain_secret(self):
+        """以快取金鑰簽發的 token 與直接使用密鑰字串的結果相容"""
+        from jose import jwt
+        from app.utils.security import create_access_token, decode_access_token, settings
+
+        token = create_access_token({"sub": "admin"})
+        assert decode_access_token(token)["sub"] == "admin"
+        plain = jwt.decode(token, settings.JWT_SECRET_KEY, algorithms=[settings.JWT_ALGORITHM])
+        assert plain["sub"] == "admin"
+
+    def test_token_signed_with_other_secret_returns_none(self):
+        from jose import jwt
+        from app.utils.security import decode_access_token, settings
+
+        token = jwt.encode({"sub": "admin"}, "other-secret", algorithm=settings.JWT_ALGORITHM)
+        assert decode_access_token(token) is None
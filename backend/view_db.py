@@ -4,114 +4,173 @@ MongoDB 數據庫查看工具
 用於快速查看 courses_system 數據庫的內容
 """
 import asyncio
-from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime
 import sys
 import os
+from typing import Any, List
 
 # 添加 app 目錄到路徑
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'app'))
 
 from app.config import settings
+from app.database import db as database
+
+# 概覽每個集合顯示的樣本筆數
+SAMPLE_SIZE = 5
+
+# 概覽只印出部分欄位：以投影限制傳輸內容，長文字欄位在伺服器端先截成前 100 字
+PREVIEW_LENGTH = 100
+
+
+def _preview(field: str) -> dict:
+    return {"$substrCP": [{"$ifNull": [f"${field}", ""]}, 0, PREVIEW_LENGTH]}
+
+
+COURSE_PROJECTION = {"course_code": 1, "course_name": 1, "teacher_name": 1, "semester": 1, "created_at": 1}
+QUESTION_PROJECTION = {
+    "question_type": 1, "question_text": _preview("question_text"), "course_id": 1, "created_at": 1
+}
+QA_PROJECTION = {
+    "student_id": 1, "question": _preview("question"), "answer": _preview("answer"),
+    "status": 1, "created_at": 1
+}
+ANNOUNCEMENT_PROJECTION = {"title": 1, "content": _preview("content"), "course_id": 1, "created_at": 1}
+
+
+class OutputBuffer:
+    """收集輸出行，flush 時以單次 write 寫出，避免逐行 print 的系統呼叫"""
+    
+    def __init__(self):
+        self._lines: List[str] = []
+    
+    def emit(self, line: Any = "") -> None:
+        self._lines.append(str(line))
+    
+    def flush(self) -> None:
+        if self._lines:
+            sys.stdout.write("\n".join(self._lines) + "\n")
+            sys.stdout.flush()
+            self._lines.clear()
 
 
 async def view_database():
-    """查看數據庫內容"""
-    print("=" * 60)
-    print("MongoDB 數據庫內容查看工具")
-    print("=" * 60)
-    print(f"\n數據庫: {settings.MONGODB_DB_NAME}")
-    print(f"連接: {settings.MONGODB_URI}\n")
-    print("=" * 60)
-    
-    # 連接數據庫
-    client = AsyncIOMotorClient(settings.MONGODB_URI)
-    db = client[settings.MONGODB_DB_NAME]
+    """查看數據庫內容 (輸出先收集在緩衝區，分段一次寫出)"""
+    output = OutputBuffer()
+    emit = output.emit
+    
+    emit("=" * 60)
+    emit("MongoDB 數據庫內容查看工具")
+    emit("=" * 60)
+    emit(f"\n數據庫: {settings.MONGODB_DB_NAME}")
+    emit(f"連接: {settings.MONGODB_URI}\n")
+    emit("=" * 60)
+    output.flush()
+    
+    # 連接數據庫 (與應用程式共用同一組連線池設定)
+    await database.connect_db()
+    db = database.get_db()
     
     # 獲取所有集合
     collections = await db.list_collection_names()
     
-    print("\n所有集合 (Collections):")
-    print("-" * 60)
-    for collection_name in collections:
-        count = await db[collection_name].count_documents({})
-        print(f"  ✓ {collection_name} ({count} 筆資料)")
+    emit("\n所有集合 (Collections):")
+    emit("-" * 60)
+    # 各集合的筆數查詢互不相依，同時送出；不帶條件的總數直接讀取集合中繼資料
+    counts = await asyncio.gather(*(
+        db[collection_name].estimated_document_count() for collection_name in collections
+    ))
+    for collection_name, count in zip(collections, counts):
+        emit(f"  ✓ {collection_name} ({count} 筆資料)")
     
-    print("\n" + "=" * 60)
-    print("各集合詳細資料:")
-    print("=" * 60)
+    emit("\n" + "=" * 60)
+    emit("各集合詳細資料:")
+    emit("=" * 60)
+    
+    # 四個集合的樣本查詢互不相依，同時送出後再依序輸出
+    courses, questions, qas, announcements = await asyncio.gather(
+        db.courses.find({}, COURSE_PROJECTION).limit(SAMPLE_SIZE).to_list(SAMPLE_SIZE),
+        db.questions.find({}, QUESTION_PROJECTION).limit(SAMPLE_SIZE).to_list(SAMPLE_SIZE),
+        db.qas.find({}, QA_PROJECTION).limit(SAMPLE_SIZE).to_list(SAMPLE_SIZE),
+        db.announcements.find({}, ANNOUNCEMENT_PROJECTION).limit(SAMPLE_SIZE).to_list(SAMPLE_SIZE),
+    )
     
     # 顯示課程資料
-    print("\n課程 (courses):")
-    print("-" * 60)
-    async for course in db.courses.find().limit(5):
-        print(f"\nID: {course.get('_id')}")
-        print(f"課程代碼: {course.get('course_code')}")
-        print(f"課程名稱: {course.get('course_name')}")
-        print(f"教師姓名: {course.get('teacher_name')}")
-        print(f"學期: {course.get('semester')}")
-        print(f"建立時間: {course.get('created_at')}")
+    emit("\n課程 (courses):")
+    emit("-" * 60)
+    for course in courses:
+        emit(f"\nID: {course.get('_id')}")
+        emit(f"課程代碼: {course.get('course_code')}")
+        emit(f"課程名稱: {course.get('course_name')}")
+        emit(f"教師姓名: {course.get('teacher_name')}")
+        emit(f"學期: {course.get('semester')}")
+        emit(f"建立時間: {course.get('created_at')}")
     
     # 顯示問題資料
-    print("\n\n問題 (questions):")
-    print("-" * 60)
-    async for question in db.questions.find().limit(5):
-        print(f"\nID: {question.get('_id')}")
-        print(f"問題類型: {question.get('question_type')}")
-        print(f"問題文本: {question.get('question_text')[:100]}...")
-        print(f"課程ID: {question.get('course_id')}")
-        print(f"建立時間: {question.get('created_at')}")
+    emit("\n\n問題 (questions):")
+    emit("-" * 60)
+    for question in questions:
+        emit(f"\nID: {question.get('_id')}")
+        emit(f"問題類型: {question.get('question_type')}")
+        emit(f"問題文本: {question.get('question_text')}...")
+        emit(f"課程ID: {question.get('course_id')}")
+        emit(f"建立時間: {question.get('created_at')}")
     
     # 顯示問答資料
-    print("\n\n問答 (qas):")
-    print("-" * 60)
-    async for qa in db.qas.find().limit(5):
-        print(f"\nID: {qa.get('_id')}")
-        print(f"學生ID: {qa.get('student_id')}")
-        print(f"問題: {qa.get('question')[:100]}...")
+    emit("\n\n問答 (qas):")
+    emit("-" * 60)
+    for qa in qas:
+        emit(f"\nID: {qa.get('_id')}")
+        emit(f"學生ID: {qa.get('student_id')}")
+        emit(f"問題: {qa.get('question')}...")
         if qa.get('answer'):
-            print(f"回答: {qa.get('answer')[:100]}...")
-        print(f"狀態: {qa.get('status')}")
-        print(f"建立時間: {qa.get('created_at')}")
+            emit(f"回答: {qa.get('answer')}...")
+        emit(f"狀態: {qa.get('status')}")
+        emit(f"建立時間: {qa.get('created_at')}")
     
     # 顯示公告資料
-    print("\n\n公告 (announcements):")
-    print("-" * 60)
-    async for announcement in db.announcements.find().limit(5):
-        print(f"\nID: {announcement.get('_id')}")
-        print(f"標題: {announcement.get('title')}")
-        print(f"內容: {announcement.get('content')[:100]}...")
-        print(f"課程ID: {announcement.get('course_id')}")
-        print(f"建立時間: {announcement.get('created_at')}")
-    
-    print("\n" + "=" * 60)
-    print("查詢完成！")
-    print("\n提示：")
-    print("  • 使用 MongoDB Compass 可獲得更好的視覺化體驗")
-    print("  • 使用 mongosh 可進行互動式查詢")
-    print("  • 每個集合只顯示前 5 筆資料")
-    print("=" * 60)
+    emit("\n\n公告 (announcements):")
+    emit("-" * 60)
+    for announcement in announcements:
+        emit(f"\nID: {announcement.get('_id')}")
+        emit(f"標題: {announcement.get('title')}")
+        emit(f"內容: {announcement.get('content')}...")
+        emit(f"課程ID: {announcement.get('course_id')}")
+        emit(f"建立時間: {announcement.get('created_at')}")
+    
+    emit("\n" + "=" * 60)
+    emit("查詢完成！")
+    emit("\n提示：")
+    emit("  • 使用 MongoDB Compass 可獲得更好的視覺化體驗")
+    emit("  • 使用 mongosh 可進行互動式查詢")
+    emit(f"  • 每個集合只顯示前 {SAMPLE_SIZE} 筆資料")
+    emit("=" * 60)
+    
+    output.flush()
     
     # 關閉連接
-    client.close()
+    await database.close_db()
 
 
 async def view_specific_collection(collection_name: str, limit: int = 10):
     """查看特定集合的內容"""
-    client = AsyncIOMotorClient(settings.MONGODB_URI)
-    db = client[settings.MONGODB_DB_NAME]
+    output = OutputBuffer()
+    emit = output.emit
+    
+    await database.connect_db()
+    db = database.get_db()
     
-    print(f"\n集合: {collection_name}")
-    print("=" * 60)
+    emit(f"\n集合: {collection_name}")
+    emit("=" * 60)
     
-    count = await db[collection_name].count_documents({})
-    print(f"總筆數: {count}\n")
+    count = await db[collection_name].estimated_document_count()
+    emit(f"總筆數: {count}\n")
     
     async for doc in db[collection_name].find().limit(limit):
-        print(doc)
-        print("-" * 60)
+        emit(doc)
+        emit("-" * 60)
+    output.flush()
     
-    client.close()
+    await database.close_db()
 
 
 if __name__ == "__main__":